@@ -1,7 +1,9 @@
 ################################################
 # running the Budget App                       #
 ################################################
-from budget_aj_app import app
+from budget_aj_app import create_app
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run()
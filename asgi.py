@@ -0,0 +1,8 @@
+################################################
+# running the Budget App in asgi mode          #
+# uvicorn asgi:app                             #
+################################################
+from budget_aj_app import create_app
+from budget_aj_app.asgi import AsyncApp
+
+app = AsyncApp(create_app())
@@ -0,0 +1,203 @@
+################################################
+# asgi_throughput.py in benchmarks
+################################################
+#
+#   Description:
+#       compare the throughput of the two serving modes for many concurrent users of the read requests
+#       (dashboard summary, expense list, lookup and csv export). a sqlite database with synthetic users is
+#       served once by the flask app in a wsgi server with a fixed pool of threads (like `gunicorn --threads 8`
+#       of the Procfile) and once by asgi.py under uvicorn, each in its own process, and every simulated user
+#       sends its requests one after the other.
+#
+#       sqlite on the local disk answers without waiting on the network, with a remote database the queries
+#       keep a wsgi thread waiting much longer and the difference between the modes grows.
+#
+#   usage: python benchmarks/asgi_throughput.py [--users 40] [--concurrency 8,32,64] [--duration 10] [--threads 8]
+#
+################################################
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+PATHS = ('/dashboard/summary', '/api/expenses?limit=100', '/api/lookup/expenses?q=gr', '/expenses/export')
+CATEGORIES = ('shopping', 'housing', 'utility', 'insurance', 'medical', 'transportation', 'other')
+WORDS = ('grocery', 'rent', 'power', 'fuel', 'doctor', 'gift', 'phone', 'coffee')
+
+
+def app_config(path):
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'PURGE_IN_BACKGROUND': False}
+
+
+def build_database(path, users, expenses):
+    """
+        this method will fill a sqlite database with users that each have a selected budget, an income and
+        expenses over the last year
+        :return: list of session cookies, one per user
+    """
+    from budget_aj_app import create_app, db
+    from budget_aj_app.models import User, Budget, UserSelect, Income, Expenses
+    app = create_app(app_config(path))
+    rng = random.Random(7)
+    now = datetime.now()
+    cookies = []
+    with app.app_context():
+        db.create_all()
+        serializer = app.session_interface.get_signing_serializer(app)
+        for number in range(users):
+            user = User(f"user{number}@example.com", f"user{number}", 'password')
+            db.session.add(user)
+            db.session.flush()
+            budget = Budget(user.id, f"budget {number}")
+            db.session.add(budget)
+            db.session.flush()
+            db.session.add(UserSelect(user.id, budget.id))
+            db.session.add(Income(budget.id, rng.randint(2000, 9000), 'salary', 20))
+            db.session.add_all(Expenses(budget.id, f"{rng.choice(WORDS)} {rng.randint(1, 999)}",
+                                        rng.randint(1, 50000) / 100, rng.choice(CATEGORIES), 'one',
+                                        now - timedelta(days=rng.randint(0, 365)))
+                               for _ in range(expenses))
+            db.session.commit()
+            # the session of a logged in user, flask-login 0.4 and 0.5 keys
+            cookies.append(serializer.dumps({'user_id': str(user.id), '_user_id': str(user.id), '_fresh': True}))
+    return cookies
+
+
+def serve_wsgi(path, port, threads):
+    """
+        this method will serve the flask app with a fixed pool of threads, like gunicorn --threads
+    """
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.serving import BaseWSGIServer
+    from budget_aj_app import create_app
+
+    class PooledServer(BaseWSGIServer):
+        pool = ThreadPoolExecutor(threads)
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    from budget_aj_app.asgi import import_plotly
+    import_plotly()  # like the asgi app, so the first plots of the threads don't race on the imports
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # no line per request
+    PooledServer('127.0.0.1', port, create_app(app_config(path))).serve_forever()
+
+
+def serve_asgi(path, port):
+    import uvicorn
+    from budget_aj_app import create_app
+    from budget_aj_app.asgi import AsyncApp
+    uvicorn.run(AsyncApp(create_app(app_config(path))), host='127.0.0.1', port=port, log_level='warning')
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+async def get(port, path, cookie):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nCookie: session={cookie}\r\n"
+                 f"Connection: close\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+async def load(port, cookies, concurrency, duration):
+    """
+        this method will run the simulated users against a server for a while
+        :return: tuple of (requests per second, p50 ms, p95 ms, errors)
+    """
+    latencies = []
+    errors = 0
+    stop = time.perf_counter() + duration
+
+    async def user(number):
+        nonlocal errors
+        cookie = cookies[number % len(cookies)]
+        request = number
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            try:
+                status = await get(port, PATHS[request % len(PATHS)], cookie)
+            except OSError:
+                status = None
+            if status != 200:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+            request += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(number) for number in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return (len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)],
+            errors)
+
+
+async def wait_for(port, timeout=60):
+    stop = time.monotonic() + timeout
+    while True:
+        try:
+            await asyncio.open_connection('127.0.0.1', port)
+            return
+        except OSError:
+            if time.monotonic() > stop:
+                raise
+            await asyncio.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wsgi vs asgi throughput of the read requests')
+    parser.add_argument('--users', type=int, default=40, help='users in the database')
+    parser.add_argument('--expenses', type=int, default=500, help='expenses per user')
+    parser.add_argument('--concurrency', default='8,32,64', help='simulated users sending requests at once')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per mode and concurrency')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the wsgi server')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'bench.sqlite')
+    started = time.perf_counter()
+    cookies = build_database(path, args.users, args.expenses)
+    print(f"{args.users} users x {args.expenses} expenses built in {time.perf_counter() - started:.1f} s")
+
+    spawn = multiprocessing.get_context('spawn')
+    for mode, target, extra in (('wsgi', serve_wsgi, (args.threads,)), ('asgi', serve_asgi, ())):
+        port = free_port()
+        server = spawn.Process(target=target, args=(path, port) + extra, daemon=True)
+        server.start()
+        try:
+            asyncio.run(wait_for(port))
+            asyncio.run(load(port, cookies, 4, 2))  # warm up: imports, plotly, connections
+            for concurrency in (int(value) for value in args.concurrency.split(',')):
+                rate, p50, p95, errors = asyncio.run(load(port, cookies, concurrency, args.duration))
+                print(f"{mode} {concurrency:4d} users: {rate:7.1f} req/s, p50 {p50:7.1f} ms, p95 {p95:7.1f} ms"
+                      + (f", {errors} errors" if errors else ""))
+        finally:
+            server.terminate()
+            server.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
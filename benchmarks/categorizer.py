@@ -0,0 +1,101 @@
+################################################
+# categorizer.py in benchmarks
+################################################
+#
+#   Description:
+#       time the category suggestions (budget_aj_app/categorizer.py) on a synthetic user: the training of the
+#       model, one suggestion at a time and a batch of suggestions, and fail when a suggestion takes more than
+#       the time budget per row.
+#
+#   usage: python benchmarks/categorizer.py [--expenses 20000] [--rows 1000] [--budget-ms 1]
+#
+################################################
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+from budget_aj_app.categorizer import CategoryModel  # noqa: E402
+
+# category -> words the descriptions of that category are made of
+WORDS = {
+    'shopping': ('grocery', 'market', 'store', 'amazon', 'clothes', 'shoes', 'target', 'walmart'),
+    'housing': ('rent', 'mortgage', 'hoa', 'repair', 'plumber', 'furniture'),
+    'utility': ('electric', 'water', 'gas', 'internet', 'phone', 'trash'),
+    'insurance': ('car', 'home', 'life', 'health', 'premium', 'policy'),
+    'medical': ('doctor', 'dentist', 'pharmacy', 'hospital', 'copay', 'glasses'),
+    'transportation': ('fuel', 'parking', 'toll', 'bus', 'train', 'uber'),
+    'investing_debt': ('loan', 'credit', 'card', 'ira', 'brokerage', 'payment'),
+    'other': ('gift', 'donation', 'movie', 'restaurant', 'coffee', 'gym'),
+}
+
+
+def synthetic_expenses(count, rng):
+    """
+        this method will make expenses whose description is 1-3 words of their category and sometimes a word of
+        another one
+        :return: list of (description, amount_cents, category)
+    """
+    categories = list(WORDS)
+    rows = []
+    for _ in range(count):
+        category = rng.choice(categories)
+        words = rng.sample(WORDS[category], rng.randint(1, 3))
+        if rng.random() < 0.2:
+            words.append(rng.choice(WORDS[rng.choice(categories)]))
+        rows.append((' '.join(words), rng.randint(100, 300000), category))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='category suggestion benchmark')
+    parser.add_argument('--expenses', type=int, default=20000, help='expenses the model is trained on')
+    parser.add_argument('--rows', type=int, default=1000, help='expenses to suggest a category for')
+    parser.add_argument('--budget-ms', type=float, default=1, help='fail when a suggestion takes more than this')
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    training = synthetic_expenses(args.expenses, rng)
+    queries = synthetic_expenses(args.rows, rng)
+
+    started = time.perf_counter()
+    model = CategoryModel()
+    for description, amount_cents, category in training:
+        model.learn(description, amount_cents, category)
+    train_ms = (time.perf_counter() - started) * 1000
+
+    single = []
+    for description, amount_cents, _ in queries:
+        started = time.perf_counter()
+        model.suggest(description, amount_cents)
+        single.append((time.perf_counter() - started) * 1000)
+    single.sort()
+
+    started = time.perf_counter()
+    suggestions = [model.suggest(description, amount_cents) for description, amount_cents, _ in queries]
+    batch_ms = (time.perf_counter() - started) * 1000
+    correct = sum(suggested == category for (suggested, _), (_, _, category) in zip(suggestions, queries))
+
+    started = time.perf_counter()
+    for description, amount_cents, category in queries[:100]:
+        model.learn(description, amount_cents, category)
+        model.learn(description, amount_cents, category, -1)
+    update_ms = (time.perf_counter() - started) * 1000 / 200
+
+    p99 = single[int(len(single) * 0.99) - 1]
+    print(f"training on {args.expenses} expenses: {train_ms:.1f} ms")
+    print(f"single: median {single[len(single) // 2]:.3f} ms, p99 {p99:.3f} ms per row")
+    print(f"batch of {args.rows}: {batch_ms:.1f} ms, {batch_ms / args.rows:.3f} ms per row")
+    print(f"incremental update: {update_ms:.3f} ms, accuracy {correct / args.rows:.0%}")
+    if p99 > args.budget_ms or batch_ms / args.rows > args.budget_ms:
+        print(f"FAIL: a suggestion takes more than {args.budget_ms} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+################################################
+# currency_summary.py in benchmarks
+################################################
+#
+#   Description:
+#       time the dashboard summary queries (budget_aj_app/reads.py) of a budget whose amounts are all in its
+#       own currency against a budget with the same amounts spread over several currencies, converted by the
+#       joins of rates.py, and fail when the converted summary is much slower. also times the cached single
+#       amount conversions of the forms and /api/rates.
+#
+#   usage: python benchmarks/currency_summary.py [--expenses 50000] [--months 24] [--max-ratio 1.5]
+#
+################################################
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+from budget_aj_app import create_app, db  # noqa: E402
+from budget_aj_app.config import TestConfig  # noqa: E402
+from budget_aj_app.models import User, Budget, Income, Expenses  # noqa: E402
+from budget_aj_app.rates import load_rates, convert  # noqa: E402
+from budget_aj_app.reads import summary_queries, dashboard_summary  # noqa: E402
+from budget_aj_app.rollup import rebuild_rollup  # noqa: E402
+
+CATEGORIES = ('shopping', 'housing', 'utility', 'insurance', 'medical', 'transportation', 'investing_debt', 'other')
+CURRENCIES = {'USD': 1, 'EUR': 0.92, 'GBP': 0.79, 'CAD': 1.36}
+
+
+def month_start(index):
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def write_rates(path, months, today):
+    """
+        this method will write a rate file with a few rates per month of every currency
+    """
+    rng = random.Random(3)
+    last = today.year * 12 + today.month - 1
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('date,currency,rate\n')
+        for index in range(last - months, last + 1):
+            for currency, rate in CURRENCIES.items():
+                for day in (5, 15, 25):
+                    file.write(f"{month_start(index).replace(day=day)},{currency},"
+                               f"{rate * rng.uniform(0.97, 1.03):.6f}\n")
+
+
+def fill_budget(budget_id, currencies, expenses, months, today):
+    """
+        this method will insert the incomes and the expenses of a budget straight into the tables, the rollup
+        is rebuilt once afterwards
+    """
+    rng = random.Random(budget_id)
+    last = today.year * 12 + today.month - 1
+    for currency in currencies:
+        db.session.add(Income(budget_id, 3000, f"income {currency}", 20, currency=currency))
+    rows = []
+    for _ in range(expenses):
+        day = month_start(last - rng.randint(0, months - 1)).replace(day=rng.randint(1, 28))
+        rows.append({'budget_id': budget_id, 'expense_description': 'expense', 'currency': rng.choice(currencies),
+                     'expense_amount_cents': rng.randint(100, 50000), 'category': rng.choice(CATEGORIES),
+                     'expense_type': 'one', 'transaction_date': datetime(day.year, day.month, day.day),
+                     'creation_date': datetime.utcnow()})
+    db.session.execute(Expenses.__table__.insert(), rows)
+    db.session.commit()
+
+
+def time_summary(budget_id, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = {name: db.session.execute(query).fetchall() for name, query in summary_queries(budget_id).items()}
+        dashboard_summary(budget_id, rows)
+        timings.append((time.perf_counter() - started) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='multi currency dashboard summary benchmark')
+    parser.add_argument('--expenses', type=int, default=50000, help='expenses of each budget')
+    parser.add_argument('--months', type=int, default=24, help='months the expenses are spread over')
+    parser.add_argument('--repeat', type=int, default=21, help='summaries per budget, the median is kept')
+    parser.add_argument('--lookups', type=int, default=100000, help='cached single amount conversions')
+    parser.add_argument('--max-ratio', type=float, default=1.5,
+                        help='fail when the multi currency summary takes more than this times the single one')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+
+    class BenchmarkConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'benchmark.sqlite')
+
+    today = date.today()
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        write_rates(os.path.join(directory, 'rates.csv'), args.months, today)
+        load_rates(os.path.join(directory, 'rates.csv'), today)
+        user = User('benchmark@example.com', 'benchmark', 'benchmark')
+        db.session.add(user)
+        db.session.commit()
+        single, multi = Budget(user.id, 'single'), Budget(user.id, 'multi')
+        db.session.add_all([single, multi])
+        db.session.commit()
+        fill_budget(single.id, ['USD'], args.expenses, args.months, today)
+        fill_budget(multi.id, list(CURRENCIES), args.expenses, args.months, today)
+        rebuild_rollup()
+        time_summary(single.id, 2)  # warm up the connection and the page cache
+        single_ms = time_summary(single.id, args.repeat)
+        multi_ms = time_summary(multi.id, args.repeat)
+
+        days = [month_start(today.year * 12 + today.month - 1 - k) for k in range(args.months)]
+        started = time.perf_counter()
+        for index in range(args.lookups):
+            convert(12345, 'EUR', 'GBP', days[index % len(days)])
+        lookup_us = (time.perf_counter() - started) * 1e6 / args.lookups
+
+    ratio = multi_ms / single_ms if single_ms else 0
+    print(f"{args.expenses} expenses over {args.months} months, summary median: one currency {single_ms:.2f} ms, "
+          f"{len(CURRENCIES)} currencies {multi_ms:.2f} ms ({ratio:.2f}x, max {args.max_ratio}x)")
+    print(f"cached conversion: {lookup_us:.2f} us per amount")
+    if ratio > args.max_ratio:
+        print(f"FAIL: the converted summary is over {args.max_ratio}x the one currency summary")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
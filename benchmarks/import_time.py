@@ -0,0 +1,77 @@
+################################################
+# import_time.py in benchmarks
+################################################
+#
+#   Description:
+#       measure the cold start of a worker (importing the app module and building the app)
+#       with `python -X importtime` and fail when it goes over the time budget.
+#
+#   usage: python benchmarks/import_time.py [--budget-ms 600] [--top 15] [--runs 3]
+#
+################################################
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# modules that must stay out of the cold start path, they are imported on first use instead
+LAZY_MODULES = ('plotly', 'dateutil', 'alembic', 'numpy')
+
+# code run in the child interpreter, this is what a gunicorn worker does on boot
+WORKER_BOOT = f"import sys; from app import app; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+
+
+def run_once():
+    """
+        this method will boot the app once in a fresh interpreter and parse the importtime report
+        :return: tuple of (total microseconds, list of (cumulative us, module) rows, eagerly loaded lazy modules)
+    """
+    env = dict(os.environ)
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', WORKER_BOOT], cwd=ROOT, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    rows = []
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        cumulative = int(cumulative)
+        rows.append((cumulative, name.rstrip()))
+        if not name[1:].startswith(' '):  # top level import, its cumulative time includes all of its children
+            total += cumulative
+    loaded = [m for m in proc.stdout.strip().split(',') if m]
+    return total, rows, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='worker cold start import time benchmark')
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('IMPORT_BUDGET_MS', 600)),
+                        help='fail when the best boot time is over this many milliseconds')
+    parser.add_argument('--top', type=int, default=15, help='how many of the slowest imports to print')
+    parser.add_argument('--runs', type=int, default=3, help='boot the app this many times and keep the best run')
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    best_total, best_rows, loaded = min(runs, key=lambda run: run[0])
+
+    print(f"cold start import time: best {best_total / 1000:.1f} ms over {args.runs} runs "
+          f"(budget {args.budget_ms:.0f} ms)")
+    print("slowest imports (cumulative):")
+    for cumulative, name in sorted(best_rows, reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:9.1f} ms  {name.strip()}")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: {', '.join(loaded)} imported at boot, these must be imported lazily")
+        failed = True
+    if best_total / 1000 > args.budget_ms:
+        print(f"FAIL: cold start is over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+################################################
+# login_storm.py in benchmarks
+################################################
+#
+#   Description:
+#       dashboard latency during a login storm. the flask app runs in a wsgi server with a fixed pool of
+#       threads (like `gunicorn --threads 8` of the Procfile) while a few users keep loading their dashboard
+#       summary, first alone and then next to many clients that log in over and over.
+#
+#       the app runs twice: once with the password hashes in every request thread at once (a pool as big as
+#       the server threads with an open queue, like before credentials.py), and once with the default
+#       bounded pool. the dashboard p99 should stay close to the quiet one with the bounded pool, the logins
+#       over the queue are answered with a 503 right away instead of taking the cpu and the threads.
+#
+#   usage: python benchmarks/login_storm.py [--dashboards 4] [--logins 32] [--duration 10] [--threads 8]
+#
+################################################
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+CATEGORIES = ('shopping', 'housing', 'utility', 'insurance', 'medical', 'transportation', 'other')
+PASSWORD = 'storm password'
+MODES = {
+    'unbounded': lambda threads: {'CREDENTIAL_WORKERS': threads, 'CREDENTIAL_QUEUE': 1000, 'CREDENTIAL_NICE': 0},
+    'pool': lambda threads: {},
+}
+
+
+def app_config(path, extra=None):
+    return dict({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'PURGE_IN_BACKGROUND': False,
+                 'WTF_CSRF_ENABLED': False, 'LOGIN_ADDRESS_ATTEMPTS': 10 ** 9}, **(extra or {}))
+
+
+def build_database(path, users, expenses):
+    """
+        this method will fill a sqlite database with users that each have a selected budget, an income and
+        expenses over the last year, all with the same password
+        :return: tuple of (list of emails, list of session cookies)
+    """
+    from budget_aj_app import create_app, db
+    from budget_aj_app.models import User, Budget, UserSelect, Income, Expenses
+    app = create_app(app_config(path))
+    rng = random.Random(7)
+    now = datetime.now()
+    emails, cookies = [], []
+    with app.app_context():
+        db.create_all()
+        serializer = app.session_interface.get_signing_serializer(app)
+        for number in range(users):
+            user = User(f"user{number}@example.com", f"user{number}", PASSWORD)
+            db.session.add(user)
+            db.session.flush()
+            budget = Budget(user.id, f"budget {number}")
+            db.session.add(budget)
+            db.session.flush()
+            db.session.add(UserSelect(user.id, budget.id))
+            db.session.add(Income(budget.id, rng.randint(2000, 9000), 'salary', 20))
+            db.session.add_all(Expenses(budget.id, f"expense {rng.randint(1, 999)}", rng.randint(1, 50000) / 100,
+                                        rng.choice(CATEGORIES), 'one', now - timedelta(days=rng.randint(0, 365)))
+                               for _ in range(expenses))
+            db.session.commit()
+            emails.append(user.email)
+            # the session of a logged in user, flask-login 0.4 and 0.5 keys
+            cookies.append(serializer.dumps({'user_id': str(user.id), '_user_id': str(user.id), '_fresh': True}))
+    return emails, cookies
+
+
+def serve(path, port, threads, mode):
+    """
+        this method will serve the flask app with a fixed pool of threads, like gunicorn --threads
+    """
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.serving import BaseWSGIServer
+    from budget_aj_app import create_app
+    from budget_aj_app.asgi import import_plotly
+
+    class PooledServer(BaseWSGIServer):
+        pool = ThreadPoolExecutor(threads)
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    import_plotly()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    PooledServer('127.0.0.1', port, create_app(app_config(path, MODES[mode](threads)))).serve_forever()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+async def send(port, request):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(request)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ', 2)[1])
+
+
+def dashboard_request(cookie):
+    return (f"GET /dashboard/summary HTTP/1.1\r\nHost: localhost\r\nCookie: session={cookie}\r\n"
+            f"Connection: close\r\n\r\n").encode()
+
+
+def login_request(email):
+    body = urlencode({'user_login_id': email, 'login_password': PASSWORD, 'submit': 'Log In'})
+    return (f"POST /login HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n{body}").encode()
+
+
+async def load(port, cookies, emails, dashboards, logins, duration):
+    """
+        this method will run the dashboard users, and the login clients when logins > 0, for a while
+        :return: tuple of (sorted dashboard latencies in ms, Counter of login statuses, seconds)
+    """
+    latencies = []
+    statuses = Counter()
+    stop = time.perf_counter() + duration
+
+    async def dashboard(number):
+        request = dashboard_request(cookies[number % len(cookies)])
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            try:
+                status = await send(port, request)
+            except OSError:
+                status = None
+            latencies.append((time.perf_counter() - started) * 1000 if status == 200 else float('inf'))
+
+    async def login(number):
+        request = login_request(emails[number % len(emails)])
+        while time.perf_counter() < stop:
+            try:
+                status = await send(port, request)
+            except OSError:
+                status = None
+            statuses[status] += 1
+            if status == 503:
+                await asyncio.sleep(0.05)  # a browser doesn't resubmit at once either
+
+    started = time.perf_counter()
+    await asyncio.gather(*[dashboard(number) for number in range(dashboards)],
+                         *[login(number) for number in range(logins)])
+    return sorted(latencies), statuses, time.perf_counter() - started
+
+
+async def wait_for(port, timeout=60):
+    stop = time.monotonic() + timeout
+    while True:
+        try:
+            await asyncio.open_connection('127.0.0.1', port)
+            return
+        except OSError:
+            if time.monotonic() > stop:
+                raise
+            await asyncio.sleep(0.2)
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='dashboard latency during a login storm')
+    parser.add_argument('--users', type=int, default=40, help='users in the database')
+    parser.add_argument('--expenses', type=int, default=300, help='expenses per user')
+    parser.add_argument('--dashboards', type=int, default=4, help='users loading their dashboard at once')
+    parser.add_argument('--logins', type=int, default=32, help='clients logging in at once')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the wsgi server')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'bench.sqlite')
+    started = time.perf_counter()
+    emails, cookies = build_database(path, args.users, args.expenses)
+    print(f"{args.users} users x {args.expenses} expenses built in {time.perf_counter() - started:.1f} s")
+
+    spawn = multiprocessing.get_context('spawn')
+    for mode in MODES:
+        port = free_port()
+        server = spawn.Process(target=serve, args=(path, port, args.threads, mode), daemon=True)
+        server.start()
+        try:
+            asyncio.run(wait_for(port))
+            asyncio.run(load(port, cookies, emails, 2, 2, 2))  # warm up: imports, plotly, connections
+            for logins in (0, args.logins):
+                latencies, statuses, elapsed = asyncio.run(load(port, cookies, emails, args.dashboards, logins,
+                                                                args.duration))
+                line = (f"{mode:9} {logins:3d} logins: dashboard p50 {percentile(latencies, 0.5):7.1f} ms, "
+                        f"p99 {percentile(latencies, 0.99):7.1f} ms, {len(latencies) / elapsed:5.1f} req/s")
+                if logins:
+                    line += (f", logins {statuses[302] / elapsed:5.1f}/s ok, "
+                             f"{statuses[503] / elapsed:5.1f}/s turned away")
+                print(line)
+        finally:
+            server.terminate()
+            server.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
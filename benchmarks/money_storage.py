@@ -0,0 +1,114 @@
+################################################
+# money_storage.py in benchmarks
+################################################
+#
+#   Description:
+#       compare money stored as REAL (float) against INTEGER cents in sqlite: aggregate speed of the
+#       dashboard style SUMs, size on disk and the rounding error collected by the float sums.
+#
+#   usage: python benchmarks/money_storage.py [--rows 500000] [--budgets 50] [--repeat 5]
+#
+################################################
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from decimal import Decimal
+
+CATEGORIES = ('shopping', 'housing', 'utility', 'insurance', 'medical', 'transportation', 'investing_debt', 'other')
+
+SCHEMA = """
+CREATE TABLE expenses (
+    id INTEGER PRIMARY KEY,
+    budget_id INTEGER NOT NULL,
+    category VARCHAR(64) NOT NULL,
+    transaction_date DATETIME NOT NULL,
+    amount {amount_type} NOT NULL
+);
+CREATE INDEX ix_expenses_budget ON expenses (budget_id);
+"""
+
+QUERIES = {
+    'category totals': "SELECT category, SUM(amount) FROM expenses WHERE budget_id = ? GROUP BY category",
+    'monthly totals': "SELECT strftime('%Y', transaction_date), strftime('%m', transaction_date), SUM(amount) "
+                      "FROM expenses WHERE budget_id = ? GROUP BY 1, 2",
+    'budget total': "SELECT SUM(amount) FROM expenses WHERE budget_id = ?",
+}
+
+
+def make_rows(count, budgets):
+    """
+        this method will generate random expenses with amounts that have exactly two decimal places
+        :return: list of (budget_id, category, transaction_date, cents)
+    """
+    rng = random.Random(42)
+    rows = []
+    for _ in range(count):
+        rows.append((rng.randint(1, budgets), rng.choice(CATEGORIES),
+                     f"20{rng.randint(18, 26)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 00:00:00",
+                     rng.randint(1, 250000)))
+    return rows
+
+
+def build(path, amount_type, rows):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA.format(amount_type=amount_type))
+    if amount_type == 'REAL':
+        data = ((b, c, d, cents / 100) for b, c, d, cents in rows)
+    else:
+        data = rows
+    connection.executemany("INSERT INTO expenses (budget_id, category, transaction_date, amount) VALUES (?, ?, ?, ?)",
+                           data)
+    connection.commit()
+    connection.execute("VACUUM")
+    return connection
+
+
+def time_query(connection, sql, budgets, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for budget_id in range(1, budgets + 1):
+            connection.execute(sql, (budget_id,)).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='float vs integer cents money storage benchmark')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--budgets', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.budgets)
+    folder = tempfile.mkdtemp()
+    databases = {}
+    for label, amount_type in (('float', 'REAL'), ('cents', 'INTEGER')):
+        path = os.path.join(folder, f"{label}.sqlite")
+        databases[label] = (build(path, amount_type, rows), path)
+
+    print(f"{args.rows} expenses over {args.budgets} budgets")
+    print(f"{'':18}{'float':>12}{'cents':>12}")
+    sizes = {label: os.path.getsize(path) for label, (_, path) in databases.items()}
+    print(f"{'size on disk':18}{sizes['float'] / 1024:>10.0f}KB{sizes['cents'] / 1024:>10.0f}KB")
+    for name, sql in QUERIES.items():
+        float_time = time_query(databases['float'][0], sql, args.budgets, args.repeat)
+        cents_time = time_query(databases['cents'][0], sql, args.budgets, args.repeat)
+        print(f"{name:18}{float_time * 1000:>10.2f}ms{cents_time * 1000:>10.2f}ms   (per budget)")
+
+    # rounding error: the exact total is known from the generated cents
+    exact = Decimal(sum(row[3] for row in rows)) / 100
+    float_total = databases['float'][0].execute("SELECT SUM(amount) FROM expenses").fetchone()[0]
+    cents_total = Decimal(databases['cents'][0].execute("SELECT SUM(amount) FROM expenses").fetchone()[0]) / 100
+    print(f"{'grand total':18}{float_total!r:>24} (float)")
+    print(f"{'':18}{str(cents_total):>24} (cents)")
+    print(f"{'':18}{str(exact):>24} (exact)")
+    print(f"float error: {Decimal(repr(float_total)) - exact}, cents error: {cents_total - exact}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+################################################
+# scenarios.py in benchmarks
+################################################
+#
+#   Description:
+#       time the what-if scenario engine (budget_aj_app/scenarios.py) on a synthetic budget for a grid of
+#       variants and monte carlo simulations, and fail when a run goes over the time budget.
+#
+#   usage: python benchmarks/scenarios.py [--variants 1000] [--simulations 5000] [--months 24] [--budget-ms 500]
+#
+################################################
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+from budget_aj_app import create_app  # noqa: E402
+from budget_aj_app.config import TestConfig  # noqa: E402
+from budget_aj_app.scenarios import Baseline, run_scenarios, scenario_grid  # noqa: E402
+
+CATEGORIES = ('shopping', 'housing', 'utility', 'insurance', 'medical', 'transportation', 'investing_debt', 'other')
+
+
+def synthetic_baseline(incomes=3):
+    """
+        this method will make a budget with a few incomes, bills in every category and a noisy one time spend
+        :return: Baseline
+    """
+    rng = np.random.default_rng(7)
+    return Baseline(rng.integers(200000, 600000, incomes), rng.uniform(0.1, 0.3, incomes), CATEGORIES,
+                    rng.integers(0, 80000, len(CATEGORIES)), rng.integers(5000, 60000, len(CATEGORIES)),
+                    rng.integers(1000, 30000, len(CATEGORIES)), 12)
+
+
+def grid_values(variants):
+    """
+        this method will split the number of variants over the 4 changes of the grid
+        :return: tuple of 4 lists whose product has about that many entries
+    """
+    side = max(1, round(variants ** 0.25))
+    return (list(np.linspace(0, 10, side)), list(np.linspace(-2, 2, side)), list(np.linspace(0, 500, side)),
+            list(np.linspace(-30, 30, max(1, variants // side ** 3))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='what-if scenario engine benchmark')
+    parser.add_argument('--variants', type=int, default=1000, help='about how many variants to compare')
+    parser.add_argument('--simulations', type=int, default=5000, help='monte carlo runs')
+    parser.add_argument('--months', type=int, default=24, help='months projected')
+    parser.add_argument('--repeat', type=int, default=5, help='runs, the best one is kept')
+    parser.add_argument('--budget-ms', type=float, default=500, help='fail when the best run is over this')
+    args = parser.parse_args()
+
+    app = create_app(TestConfig)
+    with app.app_context():
+        baseline = synthetic_baseline()
+        grid = scenario_grid(*grid_values(args.variants))
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            result = run_scenarios(baseline, grid, args.months, args.simulations, seed=1)
+            timings.append((time.perf_counter() - started) * 1000)
+    best = min(timings)
+    print(f"{len(result)} variants x {args.simulations} simulations x {args.months} months: "
+          f"best {best:.1f} ms, median {sorted(timings)[len(timings) // 2]:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    if best > args.budget_ms:
+        print(f"FAIL: the scenario run is over the {args.budget_ms:.0f} ms budget")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
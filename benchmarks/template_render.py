@@ -0,0 +1,147 @@
+################################################
+# template_render.py in benchmarks
+################################################
+#
+#   Description:
+#       time the dashboard, create budget and edit budget pages with the {% cache %} blocks of templating.py
+#       turned on and off, and split every request into the template render (before_render_template to
+#       template_rendered, the charts and tables are built there since the views defer them) and the rest of
+#       the view. also times loading every template into a new jinja environment compiled from the sources
+#       against loaded from the bytecode cache, what a new worker process pays.
+#
+#   usage: python benchmarks/template_render.py [--expenses 2000] [--repeat 21]
+#
+################################################
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT)
+
+from flask import before_render_template, template_rendered  # noqa: E402
+from jinja2 import Environment, FileSystemLoader  # noqa: E402
+from budget_aj_app import create_app, db  # noqa: E402
+from budget_aj_app.config import TestConfig  # noqa: E402
+from budget_aj_app.models import Budget, Income, Expenses  # noqa: E402
+from budget_aj_app.rollup import rebuild_rollup  # noqa: E402
+from budget_aj_app.templating import FragmentCacheExtension, bytecode_cache  # noqa: E402
+
+CATEGORIES = ('shopping', 'housing', 'utility', 'insurance', 'medical', 'transportation', 'investing_debt', 'other')
+PAGES = ('/dashboard', '/budget', '/edit')
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def build_app(directory, fragments, expenses):
+    """
+        this method will create an app on its own database with one logged in user and a budget of expenses
+        :return: (app, logged in test client)
+    """
+
+    class BenchmarkConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, f"benchmark{fragments}.sqlite")
+        FRAGMENT_CACHE_SIZE = fragments
+        TEMPLATE_BYTECODE_DIR = os.path.join(directory, 'jinja')
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    client.post('/create', data=dict(email='bench@example.com', user_name='bench', password='pw', pass_confirm='pw',
+                                     disclaimer_checkin='y'))
+    client.post('/login', data=dict(user_login_id='bench@example.com', login_password='pw'))
+    client.post('/budget', data=dict(budget_name='benchmark', budget_description='benchmark', submit='Create'))
+    with app.app_context():
+        budget_id = Budget.query.first().id
+        db.session.add(Income(budget_id, 5000, 'salary', 20))
+        rng = random.Random(5)
+        now = datetime.utcnow()
+        db.session.execute(Expenses.__table__.insert(), [
+            {'budget_id': budget_id, 'expense_description': f"expense {index}", 'currency': 'USD',
+             'expense_amount_cents': rng.randint(100, 50000), 'category': rng.choice(CATEGORIES),
+             'expense_type': 'one', 'transaction_date': now - timedelta(days=rng.randint(0, 60)),
+             'creation_date': now} for index in range(expenses)])
+        db.session.commit()
+        rebuild_rollup()
+    return app, client
+
+
+def time_pages(app, client, repeat):
+    """
+        this method will request every page repeat times
+        :return: dict of page -> (median ms of the request, median ms of its template render)
+    """
+    render = {}
+
+    def started(sender, template, context, **extra):
+        render['start'] = time.perf_counter()
+
+    def rendered(sender, template, context, **extra):
+        render['ms'] = (time.perf_counter() - render['start']) * 1000
+
+    before_render_template.connect(started, app)
+    template_rendered.connect(rendered, app)
+    results = {}
+    try:
+        for page in PAGES:
+            client.get(page)  # the first request fills the blocks, the bytecode cache and the plotly imports
+            totals, renders = [], []
+            for _ in range(repeat):
+                begin = time.perf_counter()
+                response = client.get(page)
+                totals.append((time.perf_counter() - begin) * 1000)
+                renders.append(render['ms'])
+                if response.status_code != 200:
+                    raise SystemExit(f"{page} answered {response.status_code}")
+            results[page] = (median(totals), median(renders))
+    finally:
+        before_render_template.disconnect(started, app)
+        template_rendered.disconnect(rendered, app)
+    return results
+
+
+def time_loading(folder, cache):
+    """
+        this method will load every template into a new environment, compiled or from the bytecode cache
+        :return: ms
+    """
+    environment = Environment(loader=FileSystemLoader(folder), extensions=[FragmentCacheExtension],
+                              bytecode_cache=cache)
+    begin = time.perf_counter()
+    for name in environment.list_templates():
+        environment.get_template(name)
+    return (time.perf_counter() - begin) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='template render and fragment cache benchmark')
+    parser.add_argument('--expenses', type=int, default=2000, help='expenses of the budget shown on the pages')
+    parser.add_argument('--repeat', type=int, default=21, help='requests per page, the median is kept')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    for label, fragments in (('no fragment cache', 0), ('fragment cache', TestConfig.FRAGMENT_CACHE_SIZE)):
+        app, client = build_app(directory, fragments, args.expenses)
+        print(f"{label}:")
+        for page, (total, render) in time_pages(app, client, args.repeat).items():
+            print(f"  {page:<11} request {total:8.2f} ms, template render {render:8.2f} ms, "
+                  f"rest of the view {total - render:8.2f} ms")
+
+    templates = os.path.join(ROOT, 'budget_aj_app', 'templates')
+    compiled = median([time_loading(templates, None) for _ in range(5)])
+    cache = bytecode_cache(os.path.join(directory, 'loading'))
+    time_loading(templates, cache)  # writes the bytecode
+    loaded = median([time_loading(templates, cache) for _ in range(5)])
+    print(f"all templates into a new environment: compiled {compiled:.2f} ms, from the bytecode cache {loaded:.2f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,29 @@
 ################################################
 # __init__.py in budget_aj_app
 ################################################
-import os
+import sqlite3
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
-
-app = Flask(__name__)
-
-
-"""""
-CONFIGURATION
-"""""
-app.config['SECRET_KEY'] = 'thesecretkey'
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from budget_aj_app.sharding import ShardedSQLAlchemy, init_sharding
 
 
 """""
-DATABASE SETUP
+EXTENSIONS
 """""
-basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'data.sqlite')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# extensions are created unbound here and attached to every app built by create_app()
+# the session sends the budget data of each user to the user's shard, see sharding.py
+db = ShardedSQLAlchemy()
 
 
-db = SQLAlchemy(app)
-Migrate(app, db)
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # sqlite ignores the foreign keys (and their ON DELETE CASCADE) unless it's turned on for every connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 
 """""
@@ -34,23 +32,92 @@ LOGIN CONFIG
 
 login_manager = LoginManager()
 
-# We can now pass in our app to the login manager
-login_manager.init_app(app)
-
 # Tell users what view to go to when they need to login.
 login_manager.login_view = "users.login"
 
 
-
-
 """""
-BLUEPRINT CONFIGS
+APPLICATION FACTORY
 """""
-# import all views here
-from budget_aj_app.core.views import core
-from budget_aj_app.users.views import users
 
 
-# register views blueprint
-app.register_blueprint(core)
-app.register_blueprint(users)
+def create_app(config=None):
+    """
+        this method will build a new Budget App instance, bind the extensions and register the blueprints
+        :param: config optional config class, import string or dict applied on top of the default Config
+        :return: the configured flask application
+    """
+    app = Flask(__name__)
+
+    # CONFIGURATION
+    app.config.from_object('budget_aj_app.config.Config')
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    # the client address and scheme from the proxies in front of the app (request.remote_addr)
+    if app.config['PROXY_FIX_FOR']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_FOR'], x_proto=app.config['PROXY_FIX_FOR'])
+
+    # DATABASE SETUP
+    db.init_app(app)
+    init_sharding(app)
+    if app.config.get('MIGRATIONS_ENABLED'):
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+    # pub/sub for the live dashboard
+    from budget_aj_app.live import init_live
+    init_live(app)
+
+    # We can now pass in our app to the login manager
+    login_manager.init_app(app)
+    # password hashing pool and login throttles
+    from budget_aj_app.credentials import init_credentials
+    init_credentials(app)
+    # exchange rate lookups of this process
+    from budget_aj_app.rates import init_rates
+    init_rates(app)
+    # {% cache %} blocks and the bytecode cache of the templates
+    from budget_aj_app.templating import init_templates
+    init_templates(app)
+
+    # BLUEPRINT CONFIGS
+    # views, forms and models are imported here and not at package import time, so a worker
+    # only pays for them when it actually builds the app
+    from budget_aj_app import models  # registers the login user loader
+    from budget_aj_app.core.views import core
+    from budget_aj_app.users.views import users
+    from budget_aj_app.api.views import api  # also registers the change log and category model listeners
+
+    # register views blueprint
+    app.register_blueprint(core)
+    app.register_blueprint(users)
+    app.register_blueprint(api)
+
+    # request profiling for the admins, not even imported when it is off
+    if app.config['PROFILER_ENABLED']:
+        from budget_aj_app.profiler import init_profiler
+        init_profiler(app)
+
+    # COMMAND LINE JOBS
+    from budget_aj_app.purge import purge_budgets_command
+    from budget_aj_app.sharding import shards_command
+    from budget_aj_app.changes import changes_command
+    from budget_aj_app.rollup import rollup_command  # also registers the spend rollup write hooks
+    from budget_aj_app.archive import archive_command
+    from budget_aj_app.statements import statements_command
+    from budget_aj_app.ledger import ledger_command  # also registers the ledger write hooks
+    from budget_aj_app.rates import rates_command
+    app.cli.add_command(purge_budgets_command)
+    app.cli.add_command(shards_command)
+    app.cli.add_command(changes_command)
+    app.cli.add_command(rollup_command)
+    app.cli.add_command(archive_command)
+    app.cli.add_command(statements_command)
+    app.cli.add_command(ledger_command)
+    app.cli.add_command(rates_command)
+
+    return app
@@ -0,0 +1,311 @@
+################################################
+# views.py in budget_aj_app/api
+################################################
+#
+#   Description:
+#       json endpoints for clients that keep their own copy of the budgets (mobile, offline) and for the
+#       background requests of the pages
+#
+################################################
+from datetime import date
+from flask import Blueprint, current_app, jsonify, request, abort
+from flask_login import current_user, login_required
+from budget_aj_app import db
+from budget_aj_app.batch import BatchError, batch_expenses, batch_incomes, parse_amount, parse_date
+from budget_aj_app.categorizer import suggest_categories
+from budget_aj_app.ledger import LEDGERED, balance_as_of, audit_query, entry_json
+from budget_aj_app.changes import TRACKED, DELETE, changes_since
+from budget_aj_app.models import Budget
+from budget_aj_app.money import to_cents
+from budget_aj_app.rates import convert, rate_cache
+from budget_aj_app.reads import LOOKUPS, owned_budget_query, lookup_query, lookup_result, expense_list_query, \
+    expense_json
+from budget_aj_app.users.views import selected_budget, category_choice, budget_currency
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# columns sent for every mirrored table, the amounts are integer cents
+SYNC_COLUMNS = {
+    'budget': ('id', 'budget_name', 'budget_description', 'currency', 'creation_date'),
+    'income': ('id', 'budget_id', 'income_amount_month_cents', 'currency', 'income_description', 'income_tax_bp',
+               'effective_from', 'effective_to', 'creation_date'),
+    'expenses': ('id', 'budget_id', 'expense_description', 'expense_amount_cents', 'currency', 'category',
+                 'expense_type', 'due_date', 'transaction_date', 'creation_date'),
+}
+
+
+def sync_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def current_rows(table_name, row_ids):
+    """
+        this method will load the current version of the changed rows that still belong to the user
+        :param: table_name name of a mirrored table
+        :param: row_ids list of row ids
+        :return: dict of row id -> list of values in SYNC_COLUMNS order
+    """
+    model = TRACKED[table_name]
+    columns = [getattr(model, column) for column in SYNC_COLUMNS[table_name]]
+    if model is Budget:
+        query = Budget.active().with_entities(*columns).filter(Budget.user_id == current_user.id)
+    else:
+        query = model.query.with_entities(*columns).join(Budget, Budget.id == model.budget_id). \
+            filter(Budget.user_id == current_user.id, Budget.deleted_at.is_(None))
+    rows = query.filter(model.id.in_(row_ids)).all()
+    return {row[0]: [sync_value(value) for value in row] for row in rows}
+
+
+def gone_budget_ids(budget_ids):
+    """
+        this method will return which of the budget ids are deleted or don't belong to the user anymore
+        :param: budget_ids set of budget ids
+        :return: set of budget ids
+    """
+    if not budget_ids:
+        return set()
+    active = Budget.active().with_entities(Budget.id). \
+        filter(Budget.user_id == current_user.id, Budget.id.in_(budget_ids)).all()
+    return budget_ids - {row[0] for row in active}
+
+
+@api.route('/sync')
+@login_required
+def sync():
+    """
+        this view will return the rows changed since a version, the client sends back the returned version
+        on the next call. rows are in the compact form {columns: [...], rows: [[...], ...]} and the ids
+        of the deleted rows are in deleted. a deleted budget means all of its incomes and expenses are gone.
+        ?since=<version>&limit=<max changes>, keep calling while more is true
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', current_app.config['SYNC_BATCH_SIZE'], type=int),
+                current_app.config['SYNC_BATCH_SIZE'])
+    if since < 0 or limit < 1:
+        abort(400)
+    entries, version, more = changes_since(current_user.id, since, limit)
+
+    changed = {table_name: [] for table_name in TRACKED}
+    deleted = {table_name: [] for table_name in TRACKED}
+    # the rows of a deleted budget are covered by the budget tombstone, no need to list them one by one
+    gone_budgets = gone_budget_ids({entry.budget_id for entry in entries if entry.budget_id is not None})
+    deleted['budget'].extend(gone_budgets)
+    for entry in entries:
+        if entry.budget_id in gone_budgets:
+            continue
+        (deleted if entry.operation == DELETE else changed)[entry.table_name].append(entry.row_id)
+
+    tables = {}
+    for table_name, row_ids in changed.items():
+        rows = current_rows(table_name, row_ids) if row_ids else {}
+        # a row changed and then removed without a log entry (e.g. by the budget purge) is a delete too
+        deleted[table_name].extend(row_id for row_id in row_ids if row_id not in rows)
+        tables[table_name] = {'columns': SYNC_COLUMNS[table_name], 'rows': list(rows.values())}
+
+    return jsonify(version=version, more=more, tables=tables,
+                   deleted={table_name: row_ids for table_name, row_ids in deleted.items() if row_ids})
+
+
+def batch_request(run, filters, changes):
+    """
+        this method will run a batch request
+        body: {"ids": [...], "filter": {...}, "set": {...}} or {"ids": [...], "filter": {...}, "delete": true}
+        :param: run batch_expenses or batch_incomes
+        :param: filters names allowed in "filter"
+        :param: changes names allowed in "set"
+        :return: json response with the number of changed rows, or 400 with the error
+    """
+    body = request.get_json(silent=True)  # only application/json, a cross site form can't post it
+    if not isinstance(body, dict):
+        return jsonify(error='expected a json object'), 400
+    selection = body.get('filter') or {}
+    new_values = body.get('set') or {}
+    if not isinstance(selection, dict) or not isinstance(new_values, dict):
+        return jsonify(error='filter and set must be json objects'), 400
+    unknown = (set(selection) - set(filters)) | (set(new_values) - set(changes))
+    if unknown:
+        return jsonify(error=f"unknown fields: {', '.join(sorted(unknown))}"), 400
+    if 'ids' in body:
+        if not isinstance(body['ids'], list) or not all(isinstance(row_id, int) for row_id in body['ids']):
+            return jsonify(error='ids must be a list of integers'), 400
+        selection['ids'] = body['ids']
+    delete = body.get('delete') is True
+    try:
+        changed = run(current_user.id, selection, new_values, delete=delete)
+    except BatchError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(changed=changed, operation='delete' if delete else 'update')
+
+
+@api.route('/expenses/batch', methods=['POST'])
+@login_required
+def expenses_batch():
+    """
+        this view will change or delete many expenses at once, picked by "ids" and/or a "filter" of
+        budget_id, category, expense_type, date_from, date_to (YYYY-MM-DD, both included).
+        "set" takes category, expense_type and expense_amount
+    """
+    return batch_request(batch_expenses, ('budget_id', 'category', 'expense_type', 'date_from', 'date_to'),
+                         ('category', 'expense_type', 'expense_amount'))
+
+
+@api.route('/incomes/batch', methods=['POST'])
+@login_required
+def incomes_batch():
+    """
+        this view will change or delete many incomes at once, picked by "ids" and optionally a "filter" of
+        budget_id. "set" takes income_amount_month and income_tax
+    """
+    return batch_request(batch_incomes, ('budget_id',), ('income_amount_month', 'income_tax'))
+
+
+@api.route('/lookup/<kind>')
+@login_required
+def lookup(kind):
+    """
+        this view will find expenses or incomes of a budget for the id pickers of the edit page.
+        ?q=<id or start of the description>&budget_id=<default selected budget>&limit=&offset=
+        a number matches the id, text matches the start of the description (case insensitive)
+    """
+    if kind not in LOOKUPS:
+        abort(404)
+    budget_id = request.args.get('budget_id', type=int) or selected_budget()
+    text = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 20, type=int), current_app.config['LOOKUP_MAX_LIMIT']))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    if db.session.execute(owned_budget_query(current_user.id, budget_id)).first() is None:
+        return jsonify(results=[], more=False)
+    rows = db.session.execute(lookup_query(kind, budget_id, text, limit, offset)).fetchall()
+    return jsonify(results=[lookup_result(kind, row) for row in rows[:limit]], more=len(rows) > limit)
+
+
+def owned_budget_id():
+    # the budget_id argument or the selected budget, None when the user can't read it
+    budget_id = request.args.get('budget_id', type=int) or selected_budget()
+    if db.session.execute(owned_budget_query(current_user.id, budget_id)).first() is None:
+        return None
+    return budget_id
+
+
+@api.route('/expenses')
+@login_required
+def expenses_list():
+    """
+        this view will list the expenses of a budget, a page at a time, amounts in cents.
+        ?budget_id=<default selected budget>&category=&expense_type=&date_from=&date_to=&limit=&offset=
+    """
+    limit = max(1, min(request.args.get('limit', 100, type=int), current_app.config['EXPENSES_PAGE_MAX']))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    try:
+        date_from = parse_date(request.args.get('date_from') or None)
+        date_to = parse_date(request.args.get('date_to') or None)
+    except BatchError as error:
+        return jsonify(error=str(error)), 400
+    budget_id = owned_budget_id()
+    if budget_id is None:
+        return jsonify(expenses=[], more=False)
+    rows = db.session.execute(expense_list_query(budget_id, request.args.get('category'),
+                                                 request.args.get('expense_type'), date_from, date_to, limit,
+                                                 offset)).fetchall()
+    return jsonify(expenses=[expense_json(row) for row in rows[:limit]], more=len(rows) > limit)
+
+
+@api.route('/ledger/balance')
+@login_required
+def ledger_balance():
+    """
+        this view will return the spend to date of a budget at the end of a day, in total and by category, in
+        cents. ?budget_id=<default selected budget>&date=<YYYY-MM-DD, default today>
+    """
+    try:
+        day = parse_date(request.args.get('date') or None) or date.today()
+    except BatchError as error:
+        return jsonify(error=str(error)), 400
+    budget_id = owned_budget_id()
+    if budget_id is None:
+        abort(404)
+    balance = balance_as_of(budget_id, day)
+    return jsonify(budget_id=budget_id, date=day.isoformat(), spent_cents=balance.spent_cents,
+                   categories=balance.categories,
+                   snapshot=balance.snapshot.isoformat() if balance.snapshot else None, replayed=balance.replayed)
+
+
+@api.route('/rates')
+@login_required
+def rates():
+    """
+        this view will convert an amount with the active exchange rates of the month of a day, in cents.
+        ?currency=<code>&to=<code, default the currency of the selected budget>&date=<YYYY-MM-DD, default
+        today>&amount=<default 1>
+    """
+    try:
+        day = parse_date(request.args.get('date') or None) or date.today()
+        cents = to_cents(parse_amount(request.args.get('amount', '1')))
+    except BatchError as error:
+        return jsonify(error=str(error)), 400
+    currency = request.args.get('currency', '').upper()
+    target = (request.args.get('to') or budget_currency()).upper()
+    converted = convert(cents, currency, target, day)
+    if converted is None:
+        return jsonify(error=f"no {currency} to {target} rate in {day:%Y-%m}"), 404
+    return jsonify(currency=currency, to=target, date=day.isoformat(), version=rate_cache().active_version(),
+                   amount_cents=cents, converted_cents=converted)
+
+
+@api.route('/ledger/audit')
+@login_required
+def ledger_audit():
+    """
+        this view will list the ledger entries of a budget, newest first, a page at a time.
+        ?budget_id=<default selected budget>&kind=<expenses|income>&id=<row id>&before=<entry id>&limit=
+    """
+    kind = request.args.get('kind') or None
+    if kind is not None and kind not in LEDGERED:
+        return jsonify(error=f"kind must be one of {', '.join(LEDGERED)}"), 400
+    budget_id = owned_budget_id()
+    if budget_id is None:
+        return jsonify(entries=[], more=False)
+    limit = max(1, min(request.args.get('limit', 50, type=int), current_app.config['LEDGER_PAGE_MAX']))
+    rows = db.session.execute(audit_query(budget_id, kind, request.args.get('id', type=int),
+                                          request.args.get('before', type=int), limit)).fetchall()
+    return jsonify(entries=[entry_json(row) for row in rows[:limit]], more=len(rows) > limit)
+
+
+def suggestion_rows(rows):
+    """
+        this method will read the (description, amount) pairs of a suggestion request
+        :param: rows list of {"description": ..., "amount": ...}, the amount is optional
+        :return: list of (description, amount_cents)
+    """
+    parsed = []
+    for row in rows:
+        if not isinstance(row, dict) or not isinstance(row.get('description', ''), str):
+            raise BatchError('every row must be an object with a description')
+        amount = row.get('amount')
+        parsed.append((row.get('description', ''), to_cents(parse_amount(amount)) if amount not in (None, '') else 0))
+    return parsed
+
+
+@api.route('/categorize', methods=['GET', 'POST'])
+@login_required
+def categorize():
+    """
+        this view will suggest the category of new expenses from the expenses the user already has.
+        GET ?description=&amount= for one expense, POST {"rows": [{"description": ..., "amount": ...}, ...]} for many
+    """
+    if request.method == 'GET':
+        rows = [{'description': request.args.get('description', ''), 'amount': request.args.get('amount')}]
+    else:
+        body = request.get_json(silent=True)
+        rows = body.get('rows') if isinstance(body, dict) else None
+        if not isinstance(rows, list):
+            return jsonify(error='expected a json object with a list of rows'), 400
+        if len(rows) > current_app.config['CATEGORIZER_MAX_ROWS']:
+            return jsonify(error=f"at most {current_app.config['CATEGORIZER_MAX_ROWS']} rows at once"), 400
+    try:
+        parsed = suggestion_rows(rows)
+    except BatchError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(suggestions=[{'category': category, 'label': category_choice(category) if category else None,
+                                 'confidence': round(probability, 3)}
+                                for category, probability in suggest_categories(current_user.id, parsed)])
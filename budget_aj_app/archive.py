@@ -0,0 +1,350 @@
+################################################
+# archive.py in budget_aj_app
+################################################
+#
+#   Description:
+#       cold storage of closed months. the expenses of a month older than ARCHIVE_HORIZON_MONTHS are packed
+#       column by column into one compressed blob per budget and month (expense_archive) and removed from the
+#       expenses table, the month spend stays in the category_spend rollup. the archived expenses are still
+#       read by the expense report and the csv export through archived_expenses().
+#
+#       every month is archived (or restored) in its own short transaction and the remaining work is found
+#       from the data itself, so `flask archive run` and `flask archive restore` can be stopped and started again.
+#       the removed and restored expenses are written to the change log in the same transaction, for the clients
+#       of /api/sync and the cached blocks of the pages that are keyed by the change log.
+#
+################################################
+import json
+import zlib
+from datetime import date, datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, and_, extract
+from budget_aj_app import db
+from budget_aj_app.changes import INSERT, DELETE, log_entry, owner_ids, write_entries
+from budget_aj_app.models import Budget, Expenses, ExpenseArchive
+from budget_aj_app.money import Money, from_cents
+from budget_aj_app.sharding import all_shards, using_shard
+
+ARCHIVE_FORMAT = 1
+ARCHIVED_COLUMNS = ('id', 'expense_description', 'expense_amount_cents', 'currency', 'category', 'expense_type',
+                    'due_date', 'transaction_date', 'creation_date')
+DATE_COLUMNS = ('due_date', 'transaction_date', 'creation_date')
+
+
+"""""
+BLOBS
+"""""
+
+
+def pack_expenses(rows):
+    """
+        this method will pack expense rows into an archive blob, one list per column so the repeated
+        categories and types compress well
+        :param: rows list of dicts with the ARCHIVED_COLUMNS
+        :return: compressed bytes
+    """
+    columns = {}
+    for name in ARCHIVED_COLUMNS:
+        values = [row[name] for row in rows]
+        if name in DATE_COLUMNS:
+            values = [value.isoformat() if value is not None else None for value in values]
+        columns[name] = values
+    return zlib.compress(json.dumps(columns, separators=(',', ':')).encode(), 9)
+
+
+def unpack_expenses(data):
+    """
+        this method will read the expense rows back from an archive blob
+        :param: data compressed bytes written by pack_expenses()
+        :return: list of dicts with the ARCHIVED_COLUMNS
+    """
+    columns = json.loads(zlib.decompress(data).decode())
+    for name in DATE_COLUMNS:
+        columns[name] = [datetime.fromisoformat(value) if value is not None else None for value in columns[name]]
+    return [dict(zip(ARCHIVED_COLUMNS, values)) for values in zip(*(columns[name] for name in ARCHIVED_COLUMNS))]
+
+
+def remap_archived_ids(connection, row, id_maps):
+    """
+        this method will give the archived expenses of an archive row new ids in the shard its user is moved to,
+        their ledger entries follow them through id_maps. the ids are reserved like the ids of new expenses, by
+        inserting the expenses into the expenses table of the target shard, the move deletes them afterwards
+        :param: connection connection to the target shard in the transaction of the move
+        :param: row dict of the expense_archive columns with the budget id of the target shard, its data is
+                rewritten
+        :param: id_maps dict of table name -> {old id: new id} of the move, the archived expenses are added
+        :return: dict of table name -> ids of the inserted expenses
+    """
+    table = Expenses.__table__
+    mapped = id_maps.setdefault(table.name, {})
+    expenses = unpack_expenses(row['data'])
+    for expense in expenses:
+        values = {name: expense[name] for name in ARCHIVED_COLUMNS if name != 'id'}
+        new_id = connection.execute(table.insert().values(budget_id=row['budget_id'], **values)). \
+            inserted_primary_key[0]
+        # an id that a live expense got again keeps the mapping of the live row, their entries can't be told apart
+        mapped.setdefault(expense['id'], new_id)
+        expense['id'] = new_id
+    row['data'] = pack_expenses(expenses)
+    return {table.name: [expense['id'] for expense in expenses]}
+
+
+class ArchivedExpense(object):
+    """
+        a read only expense from an archive, it has the attributes of Expenses that the tables and the export use
+    """
+    __slots__ = ARCHIVED_COLUMNS + ('budget_id',)
+    archived = True
+
+    def __init__(self, budget_id, row):
+        self.budget_id = budget_id
+        for name in ARCHIVED_COLUMNS:
+            setattr(self, name, row[name])
+
+    @property
+    def expense_amount(self):
+        return from_cents(self.expense_amount_cents)
+
+    @property
+    def expense_money(self):
+        return Money(self.expense_amount_cents, self.currency)
+
+
+"""""
+ARCHIVE AND RESTORE
+"""""
+
+
+def archive_cutoff(horizon_months=None, today=None):
+    """
+        this method will return the first day of the oldest month that is kept in the expenses table
+        :param: horizon_months optional number of months to keep, ARCHIVE_HORIZON_MONTHS by default
+        :param: today optional date to count from
+        :return: date, the months before it are archived
+    """
+    horizon_months = horizon_months or current_app.config['ARCHIVE_HORIZON_MONTHS']
+    if horizon_months < 1:
+        raise ValueError("the current month is never archived, the horizon must be at least 1 month")
+    today = today or date.today()
+    months = today.year * 12 + today.month - 1 - horizon_months
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def log_expenses(budget_id, row_ids, operation):
+    """
+        this method will write the change log entries of archived or restored expenses in the transaction that
+        moves them
+        :param: budget_id integer budget id
+        :param: row_ids list of expense ids
+        :param: operation DELETE for archived expenses, INSERT for restored ones
+    """
+    user_id = owner_ids(db.session, {budget_id}).get(budget_id)
+    write_entries(db.session, [log_entry(user_id, budget_id, Expenses.__tablename__, row_id, operation)
+                               for row_id in row_ids])
+
+
+def month_range(year, month):
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return datetime(year, month, 1), datetime(next_month.year, next_month.month, 1)
+
+
+def months_to_archive(cutoff, budget_id=None):
+    """
+        this method will find the months before the cutoff that still have expenses in the current shard
+        :param: cutoff date returned by archive_cutoff()
+        :param: budget_id optional budget id
+        :return: list of (budget_id, year, month), oldest first
+    """
+    year = extract('year', Expenses.transaction_date)
+    month = extract('month', Expenses.transaction_date)
+    query = db.session.query(Expenses.budget_id, year, month). \
+        join(Budget, Budget.id == Expenses.budget_id).filter(Budget.deleted_at.is_(None)). \
+        filter(Expenses.transaction_date < datetime(cutoff.year, cutoff.month, 1))
+    if budget_id is not None:
+        query = query.filter(Expenses.budget_id == budget_id)
+    return [(budget, int(y), int(m)) for budget, y, m in
+            query.group_by(Expenses.budget_id, year, month).order_by(year, month, Expenses.budget_id).all()]
+
+
+def archive_month(budget_id, year, month):
+    """
+        this method will move the expenses of one month of a budget into its archive blob, in one transaction.
+        expenses added to a month that is already archived are merged into the blob
+        :param: budget_id integer budget id
+        :param: year integer year
+        :param: month integer month
+        :return: number of archived expenses
+    """
+    table = Expenses.__table__
+    start, end = month_range(year, month)
+    condition = and_(table.c.budget_id == budget_id, table.c.transaction_date >= start,
+                     table.c.transaction_date < end)
+    rows = [dict(row) for row in db.session.execute(
+        select([table.c[name] for name in ARCHIVED_COLUMNS]).where(condition).order_by(table.c.id))]
+    if not rows:
+        return 0
+    archive = ExpenseArchive.query.filter_by(budget_id=budget_id, year=year, month=month).first()
+    if archive is None:
+        archive = ExpenseArchive(budget_id=budget_id, year=year, month=month)
+        db.session.add(archive)
+        archived = rows
+    else:
+        archived = unpack_expenses(archive.data) + rows
+    archive.data = pack_expenses(archived)
+    archive.archive_format = ARCHIVE_FORMAT
+    archive.expense_count = len(archived)
+    archive.total_cents = sum(row['expense_amount_cents'] for row in archived)
+    archive.archived_at = datetime.utcnow()
+    # the month spend is already in the rollup, a set based delete leaves it alone
+    db.session.execute(table.delete().where(table.c.id.in_([row['id'] for row in rows])))
+    log_expenses(budget_id, [row['id'] for row in rows], DELETE)
+    db.session.commit()
+    return len(rows)
+
+
+def restore_month(budget_id, year, month):
+    """
+        this method will put the expenses of an archived month back into the expenses table, in one
+        transaction. an expense keeps its id unless the id was given to another row in the meantime, the ledger
+        then takes the amount back from the old id and posts it on the new one so the audit trail of the old id
+        stays with the other row
+        :param: budget_id integer budget id
+        :param: year integer year
+        :param: month integer month
+        :return: number of restored expenses
+    """
+    archive = ExpenseArchive.query.filter_by(budget_id=budget_id, year=year, month=month).first()
+    if archive is None:
+        return 0
+    rows = unpack_expenses(archive.data)
+    table = Expenses.__table__
+    taken = {row[0] for row in db.session.execute(
+        select([table.c.id]).where(table.c.id.in_([row['id'] for row in rows])))}
+    renumbered = []  # (old id, row)
+    for row in rows:
+        row['budget_id'] = budget_id
+        if row['id'] in taken:
+            renumbered.append((row.pop('id'), row))
+    kept = [row for row in rows if 'id' in row]
+    if kept:
+        db.session.execute(table.insert(), kept)
+    for _, row in renumbered:
+        # one by one to learn the new ids
+        row['id'] = db.session.execute(table.insert().values(**row)).inserted_primary_key[0]
+    if renumbered:
+        # ledger.py imports this module through rollup.py
+        from budget_aj_app.ledger import UPDATE, ledger_entry, write_entries as write_ledger
+        entries = []
+        for old_id, row in renumbered:
+            entries.append(ledger_entry(table.name, dict(row, id=old_id), UPDATE, -1, None))
+            entries.append(ledger_entry(table.name, row, UPDATE, 1, None, {'id': (old_id, row['id'])}))
+        write_ledger(db.session, entries)
+    db.session.delete(archive)
+    log_expenses(budget_id, [row['id'] for row in rows], INSERT)
+    db.session.commit()
+    return len(rows)
+
+
+def archived_months(budget_id=None):
+    """
+        this method will list the archived months of the current shard
+        :param: budget_id optional budget id
+        :return: list of (budget_id, year, month, expense_count)
+    """
+    query = db.session.query(ExpenseArchive.budget_id, ExpenseArchive.year, ExpenseArchive.month,
+                             ExpenseArchive.expense_count)
+    if budget_id is not None:
+        query = query.filter(ExpenseArchive.budget_id == budget_id)
+    return query.order_by(ExpenseArchive.year, ExpenseArchive.month, ExpenseArchive.budget_id).all()
+
+
+"""""
+READ
+"""""
+
+
+def archived_expenses(budget_id, category=None, expense_type=None, date_from=None, date_to=None):
+    """
+        this method will read the archived expenses of a budget, only the blobs of the months in the date
+        range are opened
+        :param: budget_id integer budget id
+        :param: category optional category key
+        :param: expense_type optional expense type
+        :param: date_from optional first transaction date (included)
+        :param: date_to optional last transaction date (included)
+        :return: list of ArchivedExpense ordered by transaction date
+    """
+    period = ExpenseArchive.year * 100 + ExpenseArchive.month
+    query = ExpenseArchive.query.filter_by(budget_id=budget_id)
+    if date_from is not None:
+        query = query.filter(period >= date_from.year * 100 + date_from.month)
+    if date_to is not None:
+        query = query.filter(period <= date_to.year * 100 + date_to.month)
+    return filter_archived(budget_id, [archive.data for archive in query], category, expense_type, date_from,
+                           date_to)
+
+
+def filter_archived(budget_id, blobs, category=None, expense_type=None, date_from=None, date_to=None):
+    """
+        this method will read the expenses of archive blobs that match the filters of archived_expenses()
+        :param: budget_id integer budget id the blobs belong to
+        :param: blobs list of archive blob data
+        :return: list of ArchivedExpense ordered by transaction date
+    """
+    expenses = []
+    for data in blobs:
+        for row in unpack_expenses(data):
+            if category and row['category'] != category:
+                continue
+            if expense_type and row['expense_type'] != expense_type:
+                continue
+            when = row['transaction_date'].date()
+            if (date_from is not None and when < date_from) or (date_to is not None and when > date_to):
+                continue
+            expenses.append(ArchivedExpense(budget_id, row))
+    expenses.sort(key=lambda expense: (expense.transaction_date, expense.id))
+    return expenses
+
+
+"""""
+COMMAND LINE
+"""""
+
+archive_command = AppGroup('archive', help='Move closed months of expenses to cold storage and back.')
+
+
+@archive_command.command('run')
+@click.option('--horizon', type=int, default=None, help='months kept in the expenses table')
+@click.option('--budget-id', type=int, default=None, help='only archive one budget')
+def run_archive_command(horizon, budget_id):
+    """Archive the expenses of the months older than the horizon."""
+    cutoff = archive_cutoff(horizon)
+    for shard in all_shards():
+        with using_shard(shard):
+            for budget, year, month in months_to_archive(cutoff, budget_id):
+                click.echo(f"budget {budget} {year}-{month:02d}: {archive_month(budget, year, month)} expenses archived")
+
+
+@archive_command.command('restore')
+@click.option('--budget-id', type=int, default=None, help='only restore one budget')
+@click.option('--since', default=None, help='only restore the months from YYYY-MM on')
+def restore_archive_command(budget_id, since):
+    """Put archived expenses back into the expenses table."""
+    first = tuple(int(part) for part in since.split('-', 1)) if since else (0, 0)
+    for shard in all_shards():
+        with using_shard(shard):
+            for budget, year, month, _ in archived_months(budget_id):
+                if (year, month) >= first:
+                    click.echo(f"budget {budget} {year}-{month:02d}: {restore_month(budget, year, month)} "
+                               f"expenses restored")
+
+
+@archive_command.command('status')
+def status_archive_command():
+    """Show the archived months."""
+    for shard in all_shards():
+        with using_shard(shard):
+            for budget, year, month, count in archived_months():
+                click.echo(f"{shard or 'default'}: budget {budget} {year}-{month:02d}: {count} expenses")
@@ -0,0 +1,460 @@
+################################################
+# asgi.py in budget_aj_app
+################################################
+#
+#   Description:
+#       asgi serving mode. under wsgi every request holds a worker thread until it is done, a dashboard that
+#       waits on its queries and then draws its plots keeps the thread the whole time. AsyncApp answers the
+#       read only requests of reads.py on an event loop instead:
+#           GET /dashboard/summary   figures and plots of the dashboard of the selected budget
+#           GET /api/expenses        one page of the expenses of a budget
+#           GET /api/lookup/<kind>   id pickers of the edit page
+#           GET /expenses/export     csv export of the expenses of the selected budget
+#       their queries go through an async driver (aiosqlite for sqlite, asyncpg for postgresql) with a small
+#       connection pool per database, and the plots, the cpu heavy part, are drawn in a bounded thread pool
+#       (ASGI_CPU_THREADS) so the loop keeps serving while they are serialized.
+#
+#       every other request, and a read request whose session has no user (login redirects, remember me
+#       cookies), is passed to the flask app, which runs in its own pool of ASGI_WSGI_THREADS threads.
+#
+#       the asgi app is in asgi.py next to app.py: `uvicorn asgi:app` or
+#       `gunicorn -k uvicorn.workers.UvicornWorker asgi:app`. benchmarks/asgi_throughput.py compares the two
+#       modes.
+#
+################################################
+import asyncio
+import csv
+import io
+import json
+import re
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.engine.url import make_url
+from budget_aj_app import reads
+from budget_aj_app.archive import filter_archived
+from budget_aj_app.batch import BatchError, parse_date
+from budget_aj_app.models import UserShard
+from budget_aj_app.sharding import ShardError
+
+EXPORT_CHUNK_ROWS = 500  # csv rows sent at once
+
+
+"""""
+ASYNC DATABASE
+"""""
+
+
+class AsyncDatabase(object):
+    """
+        async connections to one database. the queries are sqlalchemy core selects compiled for the database,
+        so the bind and result types (e.g. the dates of sqlite) are converted like the sync engine does
+    """
+
+    def __init__(self, uri, size):
+        uri, _, self.schema = uri.partition('#')
+        self.url = make_url(uri)
+        self.size = size
+        self.backend = self.url.get_backend_name()
+        if self.backend == 'sqlite':
+            if not self.url.database or self.url.database == ':memory:':
+                raise ShardError('an in-memory sqlite database is not shared with the async connections')
+            self.dialect = sqlite.dialect()
+        elif self.backend == 'postgresql':
+            self.dialect = postgresql.dialect(paramstyle='numeric')
+        else:
+            raise ShardError(f"no async driver for {self.backend} databases")
+        self.connections = None  # sqlite: queue of aiosqlite connections
+        self.pool = None  # postgresql: asyncpg pool
+        self.row_types = {}
+
+    async def connect(self):
+        if self.backend == 'sqlite':
+            import aiosqlite
+            self.connections = asyncio.Queue()
+            for _ in range(self.size):
+                self.connections.put_nowait(await aiosqlite.connect(self.url.database))
+        else:
+            import asyncpg
+            self.pool = await asyncpg.create_pool(
+                user=self.url.username, password=self.url.password, host=self.url.host, port=self.url.port,
+                database=self.url.database, min_size=1, max_size=self.size,
+                server_settings={'search_path': self.schema} if self.schema else None)
+
+    async def close(self):
+        if self.connections is not None:
+            while not self.connections.empty():
+                await self.connections.get_nowait().close()
+        if self.pool is not None:
+            await self.pool.close()
+
+    def statement(self, compiled):
+        """
+            this method will turn a compiled select into the sql and the positional parameters of the driver
+            :param: compiled select compiled for self.dialect
+            :return: tuple of (sql string, list of parameters)
+        """
+        values = compiled.construct_params()
+        processors = compiled._bind_processors
+        parameters = []
+        for name in compiled.positiontup:
+            processor = processors.get(name)
+            parameters.append(processor(values[name]) if processor else values[name])
+        sql = compiled.string
+        if self.backend == 'postgresql':
+            sql = re.sub(r':(\d+)', r'$\1', sql)  # numeric paramstyle :1 -> asyncpg $1
+        return sql, parameters
+
+    async def fetch_all(self, query):
+        """
+            this method will run a select
+            :param: query sqlalchemy core select
+            :return: list of named tuples, one per row
+        """
+        compiled = query.compile(dialect=self.dialect)
+        sql, parameters = self.statement(compiled)
+        if self.backend == 'sqlite':
+            connection = await self.connections.get()
+            try:
+                async with connection.execute(sql, parameters) as cursor:
+                    rows = await cursor.fetchall()
+            finally:
+                self.connections.put_nowait(connection)
+        else:
+            rows = await self.pool.fetch(sql, *parameters)
+        columns = compiled._result_columns
+        keys = tuple(key for key, _, _, _ in columns)
+        row_type = self.row_types.get(keys)
+        if row_type is None:
+            row_type = self.row_types[keys] = namedtuple('Row', keys, rename=True)
+        processors = [type_._cached_result_processor(self.dialect, None) for _, _, _, type_ in columns]
+        return [row_type(*[processor(value) if processor else value for processor, value in zip(processors, row)])
+                for row in rows]
+
+    async def fetch_one(self, query):
+        rows = await self.fetch_all(query)
+        return rows[0] if rows else None
+
+
+"""""
+APP
+"""""
+
+
+class Request(object):
+    """
+        a read request answered by the event loop
+    """
+
+    def __init__(self, scope, user_id, database):
+        self.path = scope['path']
+        self.args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+        self.user_id = user_id
+        self.db = database  # database of the shard of the user
+
+    def int_arg(self, name, default=None):
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+
+class AsyncApp(object):
+    """
+        the asgi app, the read requests of reads.py are answered on the event loop and the rest by the flask app
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.routes = {
+            '/dashboard/summary': self.dashboard_summary,
+            '/api/expenses': self.expenses_list,
+            '/api/lookup/expenses': self.lookup,
+            '/api/lookup/incomes': self.lookup,
+            '/expenses/export': self.expenses_export,
+        }
+        self.cpu_pool = ThreadPoolExecutor(self.config['ASGI_CPU_THREADS'], thread_name_prefix='asgi-cpu')
+        self.wsgi_pool = ThreadPoolExecutor(self.config['ASGI_WSGI_THREADS'], thread_name_prefix='asgi-wsgi')
+        self.directory = None
+        self.shards = None
+        self.started = None
+
+    async def startup(self):
+        """
+            this method will open the async connections, on the lifespan startup or on the first request
+        """
+        with self.app.app_context():
+            from budget_aj_app.sharding import router
+            size = self.config['ASGI_DB_POOL_SIZE']
+            self.directory = AsyncDatabase(self.config['SQLALCHEMY_DATABASE_URI'], size)
+            self.shards = {name: AsyncDatabase(uri, size) for name, uri in router().uris.items()}
+        await asyncio.gather(self.directory.connect(), *(database.connect() for database in self.shards.values()))
+        # plotly is imported once before the plot threads start, several threads importing it at the same
+        # time can see a half imported numpy
+        await asyncio.get_event_loop().run_in_executor(self.cpu_pool, import_plotly)
+
+    async def shutdown(self):
+        if self.started is not None:
+            await asyncio.gather(self.directory.close(), *(database.close() for database in self.shards.values()))
+        self.cpu_pool.shutdown(wait=False)
+        self.wsgi_pool.shutdown(wait=False)
+
+    async def ensure_started(self):
+        if self.started is None:
+            self.started = asyncio.ensure_future(self.startup())
+        await self.started
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return  # no websockets
+        handler = self.routes.get(scope['path']) if scope['method'] in ('GET', 'HEAD') else None
+        if handler is not None:
+            await self.ensure_started()
+            user_id = self.session_user_id(scope)
+            database = await self.user_database(user_id) if user_id is not None else None
+            if database is not None:
+                try:
+                    status, headers, body = await handler(Request(scope, user_id, database))
+                except Exception:
+                    self.app.logger.exception(f"async {scope['path']} failed")
+                    status, headers, body = json_response({'error': 'internal server error'}, 500)
+                return await send_response(send, status, headers, body, scope['method'] == 'HEAD')
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def session_user_id(self, scope):
+        """
+            this method will read the logged in user from the flask session cookie
+            :param: scope asgi scope of the request
+            :return: integer user id, None when the session has no user
+        """
+        cookies = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+        morsel = cookies.get(self.app.session_cookie_name)
+        if morsel is None:
+            return None
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        try:
+            session = serializer.loads(morsel.value,
+                                       max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+        user_id = session.get('_user_id', session.get('user_id'))  # the key of flask-login 0.5 and 0.4
+        try:
+            return int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+    async def user_database(self, user_id):
+        """
+            this method will find the database with the budgets of a user
+            :return: AsyncDatabase, None when the user has no shard yet (the flask app assigns one)
+        """
+        if not self.shards:
+            return self.directory
+        table = UserShard.__table__
+        row = await self.directory.fetch_one(select([table.c.shard]).where(table.c.user_id == user_id))
+        return self.shards.get(row.shard) if row is not None else None
+
+    # the read requests, each returns (status, headers, body)
+
+    async def selected_budget(self, request):
+        row = await request.db.fetch_one(reads.selected_budget_query(request.user_id))
+        return row.selected_budget_id if row is not None and row.selected_budget_id else 0
+
+    async def owned_budget(self, request):
+        budget_id = request.int_arg('budget_id') or await self.selected_budget(request)
+        row = await request.db.fetch_one(reads.owned_budget_query(request.user_id, budget_id))
+        return budget_id if row is not None else None
+
+    async def dashboard_summary(self, request):
+        from budget_aj_app.users.views import summary_charts
+        budget_id = await self.selected_budget(request)
+        queries = reads.summary_queries(budget_id)
+        results = await asyncio.gather(*(request.db.fetch_all(query) for query in queries.values()))
+        summary = reads.dashboard_summary(budget_id, dict(zip(queries, results)))
+        summary['pie'], summary['bar'] = await asyncio.get_event_loop().run_in_executor(
+            self.cpu_pool, summary_charts, summary)
+        return json_response(summary)
+
+    async def expenses_list(self, request):
+        limit = max(1, min(request.int_arg('limit', 100), self.config['EXPENSES_PAGE_MAX']))
+        offset = max(0, request.int_arg('offset', 0))
+        try:
+            date_from = parse_date(request.args.get('date_from') or None)
+            date_to = parse_date(request.args.get('date_to') or None)
+        except BatchError as error:
+            return json_response({'error': str(error)}, 400)
+        budget_id = await self.owned_budget(request)
+        if budget_id is None:
+            return json_response({'expenses': [], 'more': False})
+        rows = await request.db.fetch_all(reads.expense_list_query(
+            budget_id, request.args.get('category'), request.args.get('expense_type'), date_from, date_to, limit,
+            offset))
+        return json_response({'expenses': [reads.expense_json(row) for row in rows[:limit]],
+                              'more': len(rows) > limit})
+
+    async def lookup(self, request):
+        kind = request.path.rsplit('/', 1)[1]
+        text = request.args.get('q', '').strip()
+        limit = max(1, min(request.int_arg('limit', 20), self.config['LOOKUP_MAX_LIMIT']))
+        offset = max(0, request.int_arg('offset', 0))
+        budget_id = await self.owned_budget(request)
+        if budget_id is None:
+            return json_response({'results': [], 'more': False})
+        rows = await request.db.fetch_all(reads.lookup_query(kind, budget_id, text, limit, offset))
+        return json_response({'results': [reads.lookup_result(kind, row) for row in rows[:limit]],
+                              'more': len(rows) > limit})
+
+    async def expenses_export(self, request):
+        budget_id = await self.selected_budget(request)
+        category, expense_type = request.args.get('category'), request.args.get('expense_type')
+        expenses = await request.db.fetch_all(reads.report_query(budget_id, category, expense_type))
+        if request.args.get('archived') == '1':
+            blobs = [row.data for row in await request.db.fetch_all(reads.archive_query(budget_id))]
+            archived = await asyncio.get_event_loop().run_in_executor(
+                self.cpu_pool, filter_archived, budget_id, blobs, category or None, expense_type or None)
+            expenses = sorted(archived + expenses, key=lambda expense: expense.transaction_date)
+
+        async def chunks():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(reads.EXPORT_HEADER)
+            for start in range(0, len(expenses), EXPORT_CHUNK_ROWS):
+                writer.writerows(reads.export_row(expense) for expense in expenses[start:start + EXPORT_CHUNK_ROWS])
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue().encode()
+        return 200, [(b'content-type', b'text/csv; charset=utf-8'),
+                     (b'content-disposition', b'attachment; filename=expenses.csv')], chunks()
+
+    async def call_wsgi(self, scope, receive, send):
+        """
+            this method will run the flask app for a request in the wsgi thread pool, the response is sent
+            while the app produces it so the streamed responses (live dashboard, export) keep streaming
+        """
+        body = bytearray()
+        more = True
+        while more:
+            message = await receive()
+            body.extend(message.get('body', b''))
+            more = message.get('more_body', False)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.wsgi_pool, run_wsgi, self.app.wsgi_app, wsgi_environ(scope, bytes(body)),
+                                   lambda message: asyncio.run_coroutine_threadsafe(send(message), loop).result())
+
+
+def import_plotly():
+    import numpy  # noqa: F401 plotly imports it lazily while serializing
+    import plotly.graph_objects  # noqa: F401
+    import plotly.offline  # noqa: F401
+
+
+def json_response(payload, status=200):
+    return status, [(b'content-type', b'application/json')], json.dumps(payload).encode()
+
+
+async def send_response(send, status, headers, body, head=False):
+    """
+        this method will send a response, body is bytes or an async iterator of bytes
+    """
+    if isinstance(body, bytes):
+        headers = headers + [(b'content-length', str(len(body)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    if head:
+        await send({'type': 'http.response.body', 'body': b''})
+    elif isinstance(body, bytes):
+        await send({'type': 'http.response.body', 'body': body})
+    else:
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+def wsgi_environ(scope, body):
+    """
+        this method will build the wsgi environ of an asgi http request
+        :param: scope asgi scope
+        :param: body request body bytes
+        :return: dict
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    if body:
+        environ['CONTENT_LENGTH'] = str(len(body))  # the whole body is read, also when it came chunked
+    return environ
+
+
+def run_wsgi(wsgi_app, environ, send):
+    """
+        this method will run a wsgi app in the current thread and send its response through the asgi send
+        :param: wsgi_app wsgi callable
+        :param: environ dict returned by wsgi_environ()
+        :param: send blocking function that sends one asgi message
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def start():
+        if not response.get('started'):
+            send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            response['started'] = True
+
+    result = wsgi_app(environ, start_response)
+    try:
+        for chunk in result:
+            if chunk:
+                start()
+                send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    start()
+    send({'type': 'http.response.body', 'body': b''})
@@ -0,0 +1,245 @@
+################################################
+# batch.py in budget_aj_app
+################################################
+#
+#   Description:
+#       batch edit and delete of expenses and incomes. the rows are picked by ids or by a filter (category,
+#       type, date range) and changed with one set based UPDATE or DELETE. the ownership check (a budget of
+#       the user that is not deleted) is part of the same WHERE, so ids of somebody else are never touched.
+#
+################################################
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from flask import current_app
+from sqlalchemy import select, and_, literal_column
+from budget_aj_app import db
+from budget_aj_app.models import Budget, Income, Expenses
+from budget_aj_app.money import to_cents, to_basis_points
+from budget_aj_app.signals import rows_changed
+from budget_aj_app.ledger import LEDGERED
+from budget_aj_app.sharding import ShardError, refuse_if_moving
+
+EXPENSE_TYPES = ('one', 'month_bill')
+
+
+class BatchError(ValueError):
+    """
+        raised when a batch request is not valid, the message is shown to the user
+    """
+
+
+def parse_ids(text):
+    """
+        this method will read a list of ids like "3, 7, 10-14"
+        :param: text string of ids and id ranges separated by commas or spaces
+        :return: sorted list of integer ids
+    """
+    ids = set()
+    for part in text.replace(',', ' ').split():
+        try:
+            if '-' in part:
+                first, last = (int(value) for value in part.split('-', 1))
+                if last < first or last - first > 100000:
+                    raise BatchError(f"{part} is not a valid id range")
+                ids.update(range(first, last + 1))
+            else:
+                ids.add(int(part))
+        except ValueError:
+            raise BatchError(f"{part} is not a valid id")
+        check_id_count(ids)
+    return sorted(ids)
+
+
+def check_id_count(ids):
+    """
+        this method will refuse more ids than one batch may change, before they are put in a query
+        :param: ids list or set of ids
+    """
+    if len(ids) > current_app.config['BATCH_MAX_ROWS']:
+        raise BatchError(f"{len(ids)} ids picked, a batch can change at most {current_app.config['BATCH_MAX_ROWS']}")
+
+
+def ids_in(column, ids):
+    """
+        this method will build `column IN (ids)` with the ids written into the statement, one bound parameter
+        per id would go over the parameter limit of sqlite (999, 32766 since 3.32) for a big batch
+        :param: column id column
+        :param: ids list of integer ids
+        :return: sqlalchemy condition
+    """
+    check_id_count(ids)
+    return column.in_([literal_column(str(int(row_id))) for row_id in ids])
+
+
+def parse_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise BatchError(f"{value} is not a date (YYYY-MM-DD)")
+
+
+def parse_amount(value):
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        raise BatchError(f"{value} is not an amount")
+    if not amount.is_finite() or amount < 0:
+        raise BatchError(f"{value} is not an amount")
+    return amount
+
+
+def owned_budget_ids(user_id, budget_id=None):
+    """
+        this method will build the subquery of the budget ids the user may change
+        :param: user_id integer id of the current user
+        :param: budget_id optional id to narrow it down to one budget
+        :return: select of budget ids
+    """
+    query = select([Budget.id]).where(and_(Budget.user_id == user_id, Budget.deleted_at.is_(None)))
+    if budget_id is not None:
+        query = query.where(Budget.id == budget_id)
+    return query
+
+
+def expense_selection(user_id, ids=None, budget_id=None, category=None, expense_type=None, date_from=None,
+                      date_to=None):
+    """
+        this method will build the WHERE of a batch on expenses
+        :param: user_id integer id of the current user
+        :param: ids optional list of expense ids
+        :param: budget_id optional budget id
+        :param: category optional category key
+        :param: expense_type optional expense type
+        :param: date_from optional first transaction date (included)
+        :param: date_to optional last transaction date (included)
+        :return: sqlalchemy condition
+    """
+    conditions = []
+    if ids is not None:
+        conditions.append(ids_in(Expenses.id, ids))
+    if category:
+        conditions.append(Expenses.category == category)
+    if expense_type:
+        conditions.append(Expenses.expense_type == expense_type)
+    if date_from:
+        conditions.append(Expenses.transaction_date >= parse_date(date_from))
+    if date_to:
+        conditions.append(Expenses.transaction_date < parse_date(date_to) + timedelta(days=1))
+    if not conditions:
+        raise BatchError("pick the expenses by id or by a filter")
+    return and_(Expenses.budget_id.in_(owned_budget_ids(user_id, budget_id)), *conditions)
+
+
+def income_selection(user_id, ids=None, budget_id=None):
+    """
+        this method will build the WHERE of a batch on incomes
+        :param: user_id integer id of the current user
+        :param: ids list of income ids
+        :param: budget_id optional budget id
+        :return: sqlalchemy condition
+    """
+    if ids is None:
+        raise BatchError("pick the incomes by id")
+    return and_(Income.budget_id.in_(owned_budget_ids(user_id, budget_id)), ids_in(Income.id, ids))
+
+
+def expense_values(changes):
+    """
+        this method will turn the requested expense changes into column values
+        :param: changes dict with any of category, expense_type, expense_amount
+        :return: dict of column name -> value
+    """
+    from budget_aj_app.users.views import category_choice
+    values = {}
+    if changes.get('category'):
+        if changes['category'] not in [key for key, _ in category_choice() if key]:
+            raise BatchError(f"{changes['category']} is not a category")
+        values['category'] = changes['category']
+    if changes.get('expense_type'):
+        if changes['expense_type'] not in EXPENSE_TYPES:
+            raise BatchError(f"{changes['expense_type']} is not an expense type")
+        values['expense_type'] = changes['expense_type']
+    if changes.get('expense_amount') not in (None, ''):
+        values['expense_amount_cents'] = to_cents(parse_amount(changes['expense_amount']))
+    return values
+
+
+def income_values(changes):
+    """
+        this method will turn the requested income changes into column values
+        :param: changes dict with any of income_amount_month, income_tax
+        :return: dict of column name -> value
+    """
+    values = {}
+    if changes.get('income_amount_month') not in (None, ''):
+        values['income_amount_month_cents'] = to_cents(parse_amount(changes['income_amount_month']))
+    if changes.get('income_tax') not in (None, ''):
+        tax = parse_amount(changes['income_tax'])
+        if tax > 100:
+            raise BatchError(f"{tax} is not a tax %")
+        values['income_tax_bp'] = to_basis_points(tax)
+    return values
+
+
+def run_batch(model, user_id, condition, values=None, delete=False):
+    """
+        this method will apply one batch in the current transaction and commit it
+        :param: model Expenses or Income
+        :param: user_id integer id of the current user
+        :param: condition WHERE built by expense_selection() or income_selection()
+        :param: values dict of column -> value for an update
+        :param: delete True to delete the rows instead
+        :return: number of changed rows
+    """
+    if not delete and not values:
+        raise BatchError("nothing to change, pick a new value or delete")
+    # the UPDATE and DELETE below don't flush, so the shard move check of the session isn't run for them
+    try:
+        refuse_if_moving(user_id)
+    except ShardError as error:
+        raise BatchError(str(error))
+    table = model.__table__
+    # the rows are read in the same transaction for the change log, the spend rollup, the ledger and the
+    # live dashboards
+    columns = [table.c[name] for name in LEDGERED[table.name].columns]
+    rows = [dict(row) for row in db.session.execute(select(columns).where(condition))]
+    if not rows:
+        return 0
+    if len(rows) > current_app.config['BATCH_MAX_ROWS']:
+        raise BatchError(f"{len(rows)} rows match, a batch can change at most {current_app.config['BATCH_MAX_ROWS']}")
+    if delete:
+        changed = db.session.execute(table.delete().where(condition)).rowcount
+    else:
+        changed = db.session.execute(table.update().where(condition).values(**values)).rowcount
+    rows_changed.send(current_app._get_current_object(), session=db.session(), user_id=user_id,
+                      table_name=table.name, rows=rows, values=values or {}, deleted=delete)
+    db.session.commit()
+    return changed
+
+
+def batch_expenses(user_id, selection, changes=None, delete=False):
+    """
+        this method will batch edit or delete expenses
+        :param: user_id integer id of the current user
+        :param: selection dict of expense_selection() arguments
+        :param: changes dict of the new values (category, expense_type, expense_amount)
+        :param: delete True to delete the picked expenses
+        :return: number of changed expenses
+    """
+    condition = expense_selection(user_id, **selection)
+    return run_batch(Expenses, user_id, condition, None if delete else expense_values(changes or {}), delete)
+
+
+def batch_incomes(user_id, selection, changes=None, delete=False):
+    """
+        this method will batch edit or delete incomes
+        :param: user_id integer id of the current user
+        :param: selection dict of income_selection() arguments
+        :param: changes dict of the new values (income_amount_month, income_tax)
+        :param: delete True to delete the picked incomes
+        :return: number of changed incomes
+    """
+    condition = income_selection(user_id, **selection)
+    return run_batch(Income, user_id, condition, None if delete else income_values(changes or {}), delete)
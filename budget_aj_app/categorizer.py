@@ -0,0 +1,237 @@
+################################################
+# categorizer.py in budget_aj_app
+################################################
+#
+#   Description:
+#       category suggestions for new expenses. every user gets a small naive bayes model trained on the
+#       (description, amount) -> category pairs of their own expenses. the models are kept in memory in an
+#       LRU cache (CATEGORIZER_CACHE_SIZE users per process) and every committed add, edit or delete of an
+#       expense updates the cached model of its user instead of training it again. a model older than
+#       CATEGORIZER_MAX_AGE seconds is trained again so the changes made through other worker processes
+#       are picked up.
+#
+################################################
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+from budget_aj_app import db
+from budget_aj_app.models import Budget, Expenses
+from budget_aj_app.sharding import ShardedSession
+from budget_aj_app.signals import rows_changed, user_data_moved
+
+WORD = re.compile(r"[a-z]{2,}")
+
+
+def features(description, amount_cents):
+    """
+        this method will turn an expense into the tokens the model counts: the words of the description, the
+        whole description and the size of the amount
+        :param: description expense description
+        :param: amount_cents integer amount in cents
+        :return: list of tokens
+    """
+    text = (description or '').lower()
+    tokens = WORD.findall(text)
+    tokens.append('=' + ' '.join(text.split()))
+    tokens.append(f"#amount{len(str(abs(int(amount_cents or 0))))}")  # number of digits, 10x steps
+    return tokens
+
+
+class CategoryModel(object):
+    """
+        multinomial naive bayes with add-one smoothing. learn() with weight -1 takes an example back out,
+        which is how edits and deletes are applied
+    """
+
+    def __init__(self):
+        self.examples = Counter()  # category -> number of expenses
+        self.tokens = defaultdict(Counter)  # category -> token -> count
+        self.token_totals = Counter()  # category -> number of tokens
+        self.vocabulary = Counter()  # token -> count over all categories
+        self.built_at = time.time()
+        self.lock = threading.Lock()  # learn() of a commit can run while another request asks for suggestions
+
+    def learn(self, description, amount_cents, category, weight=1):
+        with self.lock:
+            self._learn(features(description, amount_cents), category, weight)
+
+    def _learn(self, tokens, category, weight):
+        self.examples[category] += weight
+        self.token_totals[category] += weight * len(tokens)
+        counts = self.tokens[category]
+        for token in tokens:
+            counts[token] += weight
+            self.vocabulary[token] += weight
+            if counts[token] <= 0:
+                del counts[token]
+            if self.vocabulary[token] <= 0:
+                del self.vocabulary[token]
+        if self.examples[category] <= 0:
+            del self.examples[category], self.tokens[category], self.token_totals[category]
+
+    def scores(self, description, amount_cents):
+        """
+            this method will return the probability of every known category for an expense
+            :return: list of (category, probability), most likely first
+        """
+        tokens = features(description, amount_cents)
+        with self.lock:
+            total = sum(self.examples.values())
+            if not total:
+                return []
+            size = len(self.vocabulary) + 1
+            logs = []
+            for category, examples in self.examples.items():
+                counts = self.tokens[category]
+                denominator = math.log(self.token_totals[category] + size)
+                score = math.log(examples / total)
+                for token in tokens:
+                    score += math.log(counts.get(token, 0) + 1) - denominator
+                logs.append((score, category))
+        best = max(score for score, _ in logs)
+        weights = [(math.exp(score - best), category) for score, category in logs]
+        norm = sum(weight for weight, _ in weights)
+        return sorted(((category, weight / norm) for weight, category in weights), key=lambda item: -item[1])
+
+    def suggest(self, description, amount_cents):
+        """
+            this method will return the most likely category of an expense
+            :return: tuple of (category, probability), (None, 0) when the model knows nothing yet
+        """
+        ranked = self.scores(description, amount_cents)
+        return ranked[0] if ranked else (None, 0.0)
+
+
+class ModelCache(object):
+    """
+        the models of the recently active users of this process, the least recently used one is dropped when
+        the cache is full
+    """
+
+    def __init__(self):
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+            this method will return the model of a user, trained from the database when it isn't cached or is
+            too old
+            :param: user_id integer user id
+            :return: CategoryModel
+        """
+        with self.lock:
+            model = self.models.get(user_id)
+            if model is not None and time.time() - model.built_at < current_app.config['CATEGORIZER_MAX_AGE']:
+                self.models.move_to_end(user_id)
+                return model
+        model = train_model(user_id)
+        with self.lock:
+            self.models[user_id] = model
+            self.models.move_to_end(user_id)
+            while len(self.models) > current_app.config['CATEGORIZER_CACHE_SIZE']:
+                self.models.popitem(last=False)
+        return model
+
+    def cached(self, user_id):
+        with self.lock:
+            return self.models.get(user_id)
+
+    def drop(self, user_id):
+        with self.lock:
+            self.models.pop(user_id, None)
+
+
+cache = ModelCache()
+
+
+def train_model(user_id):
+    """
+        this method will train the model of a user from the expenses of all of their budgets, with one query
+        :param: user_id integer user id
+        :return: CategoryModel
+    """
+    model = CategoryModel()
+    rows = db.session.query(Expenses.expense_description, Expenses.expense_amount_cents, Expenses.category). \
+        join(Budget, Budget.id == Expenses.budget_id). \
+        filter(Budget.user_id == user_id, Budget.deleted_at.is_(None))
+    for description, amount_cents, category in rows:
+        model.learn(description, amount_cents, category)
+    return model
+
+
+def suggest_categories(user_id, rows):
+    """
+        this method will suggest a category for every row
+        :param: user_id integer user id
+        :param: rows list of (description, amount_cents)
+        :return: list of (category, probability), category None when the user has no expenses yet
+    """
+    model = cache.get(user_id)
+    return [model.suggest(description, amount_cents) for description, amount_cents in rows]
+
+
+"""""
+INCREMENTAL UPDATES
+"""""
+
+
+def old_example(obj):
+    values = []
+    for attribute in ('expense_description', 'expense_amount_cents', 'category', 'budget_id'):
+        history = get_history(obj, attribute)
+        values.append(history.deleted[0] if history.deleted else getattr(obj, attribute))
+    return values
+
+
+@event.listens_for(ShardedSession, 'after_flush')
+def collect_examples(session, flush_context):
+    # (budget_id, description, amount, category, weight), applied to the cached models after the commit
+    examples = session.info.setdefault('categorizer_examples', [])
+    for obj in session.new:
+        if isinstance(obj, Expenses):
+            examples.append((obj.budget_id, obj.expense_description, obj.expense_amount_cents, obj.category, 1))
+    for obj in session.deleted:
+        if isinstance(obj, Expenses):
+            description, amount_cents, category, budget_id = old_example(obj)
+            examples.append((budget_id, description, amount_cents, category, -1))
+    for obj in session.dirty:
+        if isinstance(obj, Expenses) and session.is_modified(obj, include_collections=False):
+            description, amount_cents, category, budget_id = old_example(obj)
+            examples.append((budget_id, description, amount_cents, category, -1))
+            examples.append((obj.budget_id, obj.expense_description, obj.expense_amount_cents, obj.category, 1))
+    if examples:
+        from budget_aj_app.changes import owner_ids
+        session.info['categorizer_owners'] = owner_ids(session, {example[0] for example in examples})
+
+
+@event.listens_for(ShardedSession, 'after_commit')
+def learn_committed_examples(session):
+    examples = session.info.pop('categorizer_examples', None)
+    owners = session.info.pop('categorizer_owners', {})
+    for budget_id, description, amount_cents, category, weight in examples or ():
+        model = cache.cached(owners.get(budget_id))
+        if model is not None:
+            model.learn(description, amount_cents, category, weight)
+
+
+@event.listens_for(ShardedSession, 'after_rollback')
+def drop_examples(session):
+    session.info.pop('categorizer_examples', None)
+    session.info.pop('categorizer_owners', None)
+
+
+@rows_changed.connect
+def forget_batch_user(sender, user_id, table_name, **extra):
+    # a batch can change thousands of rows at once, the model is trained again on its next use
+    if table_name == Expenses.__tablename__:
+        cache.drop(user_id)
+
+
+@user_data_moved.connect
+def forget_moved_user(sender, user_id, **extra):
+    cache.drop(user_id)
@@ -0,0 +1,232 @@
+################################################
+# changes.py in budget_aj_app
+################################################
+#
+#   Description:
+#       every insert, update and delete of a budget, income or expense is written to the change_log
+#       table with a version that only goes up, so a client that mirrors the budgets can ask for
+#       the changes since the last version it has seen (/api/sync?since=<version>).
+#
+#       the rows are logged from the session flush, the writes that skip the session (moving a user
+#       to another shard, batch edits) send a signal that is logged here too.
+#
+#       the log lives in the shard of the user, in the transaction of the rows it describes. the versions
+#       are counted per user in change_counter, whose row stays locked by the writing transaction until it
+#       commits: two transactions of a user can't commit their versions out of order, so a client never
+#       skips a version that was still uncommitted when it synced past a bigger one.
+#
+################################################
+from datetime import datetime, timedelta
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import IntegrityError
+from budget_aj_app import db
+from budget_aj_app.models import Budget, Income, Expenses, ChangeLog, ChangeCounter
+from budget_aj_app.sharding import ShardedSession, all_shards, shard_for_user, using_shard
+from budget_aj_app.signals import user_data_moved, rows_changed
+
+INSERT = 'I'
+UPDATE = 'U'
+DELETE = 'D'
+
+# table name -> model of the tables clients can mirror
+TRACKED = {model.__tablename__: model for model in (Budget, Income, Expenses)}
+
+counter_table = ChangeCounter.__table__
+
+
+def owner_ids(session, budget_ids):
+    """
+        this method will return the user id of each budget id, budgets seen before in this session are cached
+        :param: session database session
+        :param: budget_ids set of budget ids
+        :return: dict of budget id -> user id
+    """
+    owners = session.info.setdefault('budget_owners', {})
+    missing = [budget_id for budget_id in budget_ids if budget_id not in owners]
+    if missing:
+        with session.no_autoflush:
+            owners.update(session.query(Budget.id, Budget.user_id).filter(Budget.id.in_(missing)).all())
+    return owners
+
+
+def log_entry(user_id, budget_id, table_name, row_id, operation):
+    return dict(user_id=user_id, budget_id=budget_id, table_name=table_name, row_id=row_id, operation=operation,
+                changed_at=datetime.utcnow())
+
+
+def counter_statement(dialect):
+    """
+        this method will build the insert of a change counter row that adds to the row instead when it is already
+        there, the first changes of a user written at the same time by two transactions would otherwise both miss
+        the row with their UPDATE and both insert it
+        :param: dialect sqlalchemy dialect of the shard
+        :return: statement with the user_id and version (number of new versions) parameters, None when the
+                 database has no INSERT ... ON CONFLICT
+    """
+    if dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(counter_table)
+        return statement.on_conflict_do_update(index_elements=['user_id'], set_=dict(
+            version=counter_table.c.version + statement.excluded.version))
+    if dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 24):
+        # sqlalchemy 1.3 has no sqlite on_conflict_do_update()
+        return text("INSERT INTO change_counter (user_id, version) VALUES (:user_id, :version) "
+                    "ON CONFLICT (user_id) DO UPDATE SET version = version + excluded.version")
+    return None
+
+
+def next_versions(session, user_id, count):
+    """
+        this method will hand out the next versions of a user, the counter row stays locked until the transaction
+        ends so the transactions of one user commit their versions in order
+        :param: session database session in the transaction that writes the entries
+        :param: user_id integer id of the user
+        :param: count number of versions
+        :return: list of versions
+    """
+    bind = session.get_bind(clause=counter_table.insert())  # the shard, the sqlite upsert is a text() without tables
+    upsert = counter_statement(bind.dialect)
+    if upsert is not None:
+        session.execute(upsert, dict(user_id=user_id, version=count), bind=bind)
+    else:
+        add = counter_table.update().where(counter_table.c.user_id == user_id). \
+            values(version=counter_table.c.version + count)
+        if not session.execute(add).rowcount:
+            try:
+                with session.begin_nested():
+                    session.execute(counter_table.insert().values(user_id=user_id, version=count))
+            except IntegrityError:
+                session.execute(add)
+    last = session.execute(select([counter_table.c.version]).where(counter_table.c.user_id == user_id)).scalar()
+    return list(range(last - count + 1, last + 1))
+
+
+def write_entries(session, entries):
+    """
+        this method will give the change log entries their versions and insert them, the users are locked in id
+        order so two transactions never wait for each other's counters
+        :param: session database session in the transaction of the logged rows
+        :param: entries list of dicts made by log_entry(), entries without a user are not logged
+    """
+    by_user = {}
+    for entry in entries:
+        if entry['user_id'] is not None:
+            by_user.setdefault(entry['user_id'], []).append(entry)
+    for user_id in sorted(by_user):
+        for entry, version in zip(by_user[user_id], next_versions(session, user_id, len(by_user[user_id]))):
+            entry['version'] = version
+    rows = [entry for user_id in sorted(by_user) for entry in by_user[user_id]]
+    if rows:
+        session.execute(ChangeLog.__table__.insert(), rows)
+
+
+@event.listens_for(ShardedSession, 'after_flush')
+def log_flushed_changes(session, flush_context):
+    changed = []
+    for operation, objects in ((INSERT, session.new), (UPDATE, session.dirty), (DELETE, session.deleted)):
+        for obj in objects:
+            if obj.__tablename__ not in TRACKED:
+                continue
+            if operation == UPDATE and not session.is_modified(obj, include_collections=False):
+                continue
+            if isinstance(obj, Budget):
+                budget_id = obj.id
+                if operation == UPDATE and obj.deleted_at is not None:
+                    operation = DELETE  # a soft deleted budget is gone for the clients
+            else:
+                budget_id = obj.budget_id
+            changed.append((obj, budget_id, operation))
+    if not changed:
+        return
+    owners = owner_ids(session, {budget_id for obj, budget_id, _ in changed if not isinstance(obj, Budget)})
+    rows = []
+    for obj, budget_id, operation in changed:
+        user_id = obj.user_id if isinstance(obj, Budget) else owners.get(budget_id)
+        rows.append(log_entry(user_id, budget_id, obj.__tablename__, obj.id, operation))
+    write_entries(session, rows)
+
+
+def log_changes(rows):
+    """
+        this method will write change log entries for changes made without the session, in the shard the rows
+        are in (the pinned shard or the shard of the logged in user)
+        :param: rows list of dicts made by log_entry()
+    """
+    if rows:
+        write_entries(db.session, rows)
+        db.session.commit()
+
+
+@user_data_moved.connect
+def log_moved_user(sender, user_id, removed, added, **extra):
+    # the rows get new ids in the new shard, for the clients that is a delete of the old rows and an
+    # insert of the new ones
+    rows = []
+    for operation, ids in ((DELETE, removed), (INSERT, added)):
+        for table_name, row_ids in ids.items():
+            if table_name in TRACKED:
+                rows.extend(log_entry(user_id, None, table_name, row_id, operation) for row_id in row_ids)
+    with using_shard(shard_for_user(user_id)):
+        log_changes(rows)
+
+
+@rows_changed.connect
+def log_batch_changes(sender, session, user_id, table_name, rows, values, deleted, **extra):
+    # written in the same transaction as the batch statement
+    if table_name in TRACKED:
+        operation = DELETE if deleted else UPDATE
+        write_entries(session, [log_entry(user_id, row['budget_id'], table_name, row['id'], operation) for row in rows])
+
+
+def changes_since(user_id, since, limit):
+    """
+        this method will return the latest change of every row changed after a version, in version order
+        :param: user_id integer id of the user the rows belong to
+        :param: since version the client already has
+        :param: limit maximum number of change log entries to read
+        :return: tuple (list of change log entries, version of the last entry read, True if there are more)
+    """
+    entries = ChangeLog.query.filter(ChangeLog.user_id == user_id, ChangeLog.version > since). \
+        order_by(ChangeLog.version).limit(limit + 1).all()
+    more = len(entries) > limit
+    entries = entries[:limit]
+    latest = {}
+    for entry in entries:
+        latest.pop((entry.table_name, entry.row_id), None)
+        latest[(entry.table_name, entry.row_id)] = entry  # keep only the last change of each row
+    version = entries[-1].version if entries else since
+    return list(latest.values()), version, more
+
+
+def compact_changes(before):
+    """
+        this method will delete the change log entries that a later entry of the same row replaces,
+        clients only ever need the last change of a row
+        :param: before only compact entries older than this datetime
+        :return: number of deleted entries
+    """
+    newer = db.aliased(ChangeLog)
+    superseded = db.session.query(ChangeLog.id).filter(ChangeLog.changed_at < before). \
+        filter(db.session.query(newer.version).filter(newer.table_name == ChangeLog.table_name,
+                                                      newer.row_id == ChangeLog.row_id,
+                                                      newer.user_id == ChangeLog.user_id,
+                                                      newer.version > ChangeLog.version).exists())
+    deleted = ChangeLog.query.filter(ChangeLog.id.in_(superseded.subquery())). \
+        delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+changes_command = AppGroup('changes', help='Manage the change log used by /api/sync.')
+
+
+@changes_command.command('compact')
+@click.option('--days', type=int, default=30, help='keep every entry of the last days')
+def compact_changes_command(days):
+    """Delete change log entries replaced by later changes of the same row."""
+    for shard in all_shards():
+        with using_shard(shard):
+            deleted = compact_changes(datetime.utcnow() - timedelta(days=days))
+        click.echo(f"{shard or 'main database'}: {deleted} change log entries deleted")
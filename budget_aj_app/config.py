@@ -0,0 +1,122 @@
+################################################
+# config.py in budget_aj_app
+################################################
+import os
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+class Config(object):
+    """
+        default configuration used by create_app() when no config is passed
+    """
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'thesecretkey')
+
+    # DATABASE SETUP
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'data.sqlite'))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # SHARDING, name -> database uri of the databases that keep the budget data of the users,
+    # e.g. {'shard0': 'sqlite:////srv/budget/shard0.sqlite', 'shard1': 'postgresql://db/budget#shard1'}
+    # empty keeps everything in SQLALCHEMY_DATABASE_URI
+    SHARDS = {}
+
+    # flask-migrate pulls in alembic, so only wire it up when running the flask command line (flask db ...)
+    MIGRATIONS_ENABLED = os.environ.get('FLASK_RUN_FROM_CLI') == 'true'
+
+    # BUDGET PURGE, deleted budgets are hidden right away and their rows removed in batches
+    PURGE_IN_BACKGROUND = True
+    PURGE_BATCH_SIZE = 1000
+
+    # PASSWORDS, method and cost of the new hashes: 'pbkdf2:<hash>:<iterations>' or 'scrypt:<n>:<r>:<p>',
+    # a login with a hash of other settings saves a new hash (credentials.py)
+    PASSWORD_HASH = os.environ.get('PASSWORD_HASH', 'pbkdf2:sha256:150000')
+    CREDENTIAL_WORKERS = None  # hashes running at once per worker process, half of the cpus by default
+    CREDENTIAL_QUEUE = 2  # hashes waiting for the pool, keep workers + queue well under the --threads of gunicorn
+    CREDENTIAL_QUEUE_WAIT = 0.2  # seconds a request waits for a place in a full queue before its 503
+    CREDENTIAL_NICE = 10  # nice value added to the hashing threads (linux), 0 keeps the request priority
+    LOGIN_ACCOUNT_ATTEMPTS = 5  # failed logins of one account in LOGIN_WINDOW before it is throttled
+    LOGIN_ADDRESS_ATTEMPTS = 50  # failed logins from one ip address in LOGIN_WINDOW
+    LOGIN_WINDOW = 900  # seconds
+
+    # PROXIES, number of proxies in front of the app that add themselves to X-Forwarded-For and X-Forwarded-Proto
+    # (1 behind the heroku router, see the Procfile). the login throttle of an ip address reads the client
+    # address from them, with 0 every client behind a proxy shares the proxy address. never set it higher than
+    # the proxies really there, the client could then pick its own address.
+    PROXY_FIX_FOR = int(os.environ.get('PROXY_FIX_FOR', 0))
+
+    # DELTA SYNC, most change log entries returned by one /api/sync call
+    SYNC_BATCH_SIZE = 500
+
+    # LIVE DASHBOARD, pub/sub for the server-sent events: 'memory' for one worker process, or a shared
+    # 'sqlite:////path/live.sqlite' when several worker processes run on the same machine
+    LIVE_BROKER = os.environ.get('LIVE_BROKER', 'memory')
+    LIVE_POLL_INTERVAL = 0.5  # seconds, sqlite broker only
+    LIVE_KEEPALIVE = 15  # seconds between keepalive comments on an idle stream
+    LIVE_RETRY_MS = 3000  # browser reconnect delay
+    LIVE_STREAM_SECONDS = 300  # an open stream holds a worker thread, it is closed after this and the browser reconnects
+    LIVE_MAX_STREAMS = 4  # open streams per worker process, more get a 503, keep it well under the --threads of gunicorn
+
+    # BATCH EDIT, most rows one batch edit or delete may change
+    BATCH_MAX_ROWS = 50000
+
+    # EDIT PAGE, the id pickers search /api/lookup instead of listing every row
+    LOOKUP_MAX_LIMIT = 100
+    EDIT_TABLE_ROWS = 100  # latest incomes and expenses shown in the tables of the edit page
+    EXPENSES_PAGE_MAX = 1000  # most expenses of one /api/expenses page
+    LEDGER_PAGE_MAX = 500  # most entries of one /api/ledger/audit page
+
+    # ARCHIVE, months of expenses kept in the expenses table, older ones are moved to cold storage
+    # by `flask archive run`
+    ARCHIVE_HORIZON_MONTHS = int(os.environ.get('ARCHIVE_HORIZON_MONTHS', 24))
+
+    # SCENARIOS, limits of one what-if run on the /scenarios page
+    SCENARIO_MAX_VARIANTS = 10000
+    SCENARIO_MAX_SIMULATIONS = 20000
+    SCENARIO_HISTORY_MONTHS = 12  # complete months the discretionary spend is averaged over
+
+    # MONTHLY STATEMENTS, `flask statements run` renders chunks of budgets in a pool of worker processes
+    STATEMENT_WORKERS = None  # one per cpu
+    STATEMENT_CHUNK_SIZE = 200  # budgets read and rendered together
+
+    # CATEGORY SUGGESTIONS, per user models kept in memory by every worker process
+    CATEGORIZER_CACHE_SIZE = 256  # users
+    CATEGORIZER_MAX_AGE = 600  # seconds before a cached model is trained again
+    CATEGORIZER_MAX_ROWS = 1000  # rows of one batch suggestion request
+
+    # PROFILER, sampling profiles of selected requests for the admins (profiler.py), nothing is hooked into
+    # the requests unless it is enabled
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED') == 'true'
+    PROFILER_ADMINS = set(filter(None, os.environ.get('PROFILER_ADMINS', '').split(',')))  # emails
+    PROFILER_HEADER = 'X-Profile'  # profiles a request of an admin that sends it
+    PROFILE_USERS = set()  # emails or ids of the users whose requests are all profiled
+    PROFILE_ROUTES = set()  # endpoints that are always profiled, e.g. {'users.dashboard'}
+    PROFILER_INTERVAL = 0.005  # seconds between samples
+    PROFILER_DIR = None  # instance/profiles by default
+    PROFILER_KEEP = 200  # newest profiles kept
+
+    # ASGI MODE, asgi.py answers the read requests on an event loop and runs the flask app for the rest
+    ASGI_DB_POOL_SIZE = 10  # async connections per database
+    ASGI_CPU_THREADS = 4  # threads drawing the dashboard plots
+    ASGI_WSGI_THREADS = 32  # threads running the flask app
+
+    # EXCHANGE RATES, loaded from a local file by `flask rates load` (rates.py), nothing is fetched
+    RATES_BASE = os.environ.get('RATES_BASE', 'USD')  # the rates of the files are units per one of it
+    RATES_CARRY_MONTHS = 3  # months after the load that the last rate of a currency is carried into
+    RATES_CACHE_SECONDS = 300  # seconds before a worker looks for a new active rate version
+
+    # TEMPLATE CACHE, rendered {% cache %} blocks of the pages kept by every worker process (templating.py),
+    # the blocks with budget data change key on every change log entry of the user
+    FRAGMENT_CACHE_SIZE = 2000  # blocks, 0 renders every block on every request
+    FRAGMENT_CACHE_SECONDS = 600  # also bounds how long a change outside the change log (archive runs) is unseen
+    TEMPLATE_BYTECODE_DIR = None  # compiled templates, instance/jinja by default, '' keeps them in memory only
+
+
+class TestConfig(Config):
+    """
+        configuration for local test runs and benchmarks, uses an in-memory database
+    """
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    PURGE_IN_BACKGROUND = False
@@ -0,0 +1,308 @@
+################################################
+# credentials.py in budget_aj_app
+################################################
+#
+#   Description:
+#       the password hashes of the users. hashing a password takes hundreds of milliseconds of cpu on
+#       purpose, so the hashes of the login, the account creation and the profile page don't run in the
+#       request thread but in a small pool of CREDENTIAL_WORKERS threads (hashlib lets go of the GIL while
+#       it hashes). at most CREDENTIAL_QUEUE hashes wait for the pool, when it's full a request waits
+#       CREDENTIAL_QUEUE_WAIT seconds for a place and is then turned away with a 503. a burst of logins
+#       can't take more than the pool's share of the cpu away from the dashboards, and on linux the pool threads
+#       run with a lower priority (CREDENTIAL_NICE) so the request threads get the cpu first.
+#
+#       PASSWORD_HASH picks the method and the cost of the new hashes:
+#           pbkdf2:<hash>:<iterations>   werkzeug's pbkdf2, e.g. pbkdf2:sha256:150000
+#           scrypt:<n>:<r>:<p>           hashlib's scrypt, e.g. scrypt:16384:8:1
+#       a successful login with a hash of other settings saves a new hash of the password, so changing
+#       the settings moves the users over as they log in.
+#
+#       failed logins are counted per account and per address in a window of LOGIN_WINDOW seconds, an
+#       account or an address over its limit can't try again (and costs no hash) until the window moves
+#       on. the counts are kept in the memory of every worker process.
+#
+################################################
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash, gen_salt
+from budget_aj_app import db
+
+SALT_LENGTH = 16
+SCRYPT_KEY_LENGTH = 32
+THROTTLE_MAX_KEYS = 100000  # accounts or addresses tracked before the stale ones are dropped
+
+
+class CredentialError(ValueError):
+    """
+        raised when a password can't be checked or hashed right now, the message is shown to the user
+    """
+    status = 503
+
+    def __init__(self, message, retry_after):
+        super(CredentialError, self).__init__(message)
+        self.retry_after = retry_after  # seconds
+
+
+class CredentialsBusy(CredentialError):
+    """
+        raised when the hashing queue is full
+    """
+
+
+class LoginThrottled(CredentialError):
+    """
+        raised when an account or an address has too many failed logins
+    """
+    status = 429
+
+
+"""""
+HASHES
+"""""
+
+
+def parse_method(method):
+    """
+        this method will check a PASSWORD_HASH setting
+        :param: method string like pbkdf2:sha256:150000 or scrypt:16384:8:1
+        :return: tuple of (name, parameters)
+    """
+    name, _, parameters = method.partition(':')
+    parameters = parameters.split(':')
+    if name == 'pbkdf2' and len(parameters) == 2 and parameters[0] in hashlib.algorithms_available \
+            and parameters[1].isdigit():
+        return name, (parameters[0], int(parameters[1]))
+    if name == 'scrypt' and len(parameters) == 3 and all(value.isdigit() for value in parameters):
+        return name, tuple(int(value) for value in parameters)
+    raise ValueError(f"unknown PASSWORD_HASH {method!r}, use pbkdf2:<hash>:<iterations> or scrypt:<n>:<r>:<p>")
+
+
+def generate_hash(password, method):
+    """
+        this method will hash a password, it takes the cpu time its settings ask for
+        :param: password string
+        :param: method PASSWORD_HASH setting
+        :return: string of "method$salt$hash"
+    """
+    name, parameters = parse_method(method)
+    if name == 'pbkdf2':
+        return generate_password_hash(password, method=method, salt_length=SALT_LENGTH)
+    salt = gen_salt(SALT_LENGTH)
+    return f"{method}${salt}${scrypt(password, salt, parameters, SCRYPT_KEY_LENGTH).hex()}"
+
+
+def verify_hash(password_hash, password):
+    """
+        this method will check a password against its hash, whatever the settings it was made with
+        :param: password_hash string of generate_hash() or werkzeug's generate_password_hash()
+        :param: password string
+        :return: True when the password matches
+    """
+    if not password_hash:
+        return False
+    if password_hash.startswith('scrypt:'):
+        method, salt, key = password_hash.split('$', 2)
+        _, parameters = parse_method(method)
+        return hmac.compare_digest(scrypt(password, salt, parameters, len(key) // 2).hex(), key)
+    return check_password_hash(password_hash, password)
+
+
+def scrypt(password, salt, parameters, length):
+    n, r, p = parameters
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=n, r=r, p=p,
+                          maxmem=256 * n * r * p, dklen=length)
+
+
+def needs_rehash(password_hash, method):
+    """
+        :return: True when a hash wasn't made with the current PASSWORD_HASH settings
+    """
+    return not password_hash or password_hash.split('$', 1)[0] != method
+
+
+"""""
+WORKER POOL
+"""""
+
+
+class CredentialPool(object):
+    """
+        the threads that hash the passwords of one app, with a bounded queue in front of them
+    """
+
+    def __init__(self, workers, queue, wait, nice=0):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='credentials', initializer=lower_priority,
+                                           initargs=(nice,))
+        self.slots = threading.BoundedSemaphore(workers + queue)  # running and waiting hashes
+        self.wait = wait
+
+    def run(self, function, *args):
+        """
+            this method will run a hash in the pool and wait for its result
+            :return: result of function(*args)
+        """
+        if not self.slots.acquire(timeout=self.wait):
+            raise CredentialsBusy('Too many people are logging in right now, please try again in a moment.',
+                                  retry_after=1)
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result()
+
+
+def lower_priority(nice):
+    # linux schedules every thread on its own, a hashing thread with a higher nice value leaves the cpu to
+    # the request threads first. other systems only have a priority per process, the threads keep theirs
+    if nice and sys.platform.startswith('linux') and hasattr(threading, 'get_native_id'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), os.getpriority(os.PRIO_PROCESS, 0) + nice)
+        except OSError:
+            pass
+
+
+"""""
+THROTTLING
+"""""
+
+
+class Throttle(object):
+    """
+        failed attempts per key (account or address) in a sliding window
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.failures = {}  # key -> deque of monotonic times of the failures in the window
+        self.lock = threading.Lock()
+
+    def retry_after(self, key):
+        """
+            :return: seconds until the key may try again, 0 when it may try now
+        """
+        with self.lock:
+            failures = self.failures.get(key)
+            if not failures:
+                return 0
+            self.expire(failures, time.monotonic())
+            if len(failures) < self.limit:
+                return 0
+            return max(1, int(failures[0] + self.window - time.monotonic()) + 1)
+
+    def failed(self, key):
+        now = time.monotonic()
+        with self.lock:
+            failures = self.failures.setdefault(key, deque())
+            failures.append(now)
+            self.expire(failures, now)
+            if len(self.failures) > THROTTLE_MAX_KEYS:
+                self.prune(now)
+
+    def reset(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+
+    def expire(self, failures, now):
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        while len(failures) > self.limit:
+            failures.popleft()
+
+    def prune(self, now):
+        for key in [key for key, failures in self.failures.items() if failures[-1] <= now - self.window]:
+            del self.failures[key]
+        while len(self.failures) > THROTTLE_MAX_KEYS:  # still full of active keys, drop the oldest
+            del self.failures[next(iter(self.failures))]
+
+
+"""""
+CREDENTIALS
+"""""
+
+
+class Credentials(object):
+    """
+        the hash settings, the worker pool and the login throttles of one app
+    """
+
+    def __init__(self, config):
+        parse_method(config['PASSWORD_HASH'])
+        self.method = config['PASSWORD_HASH']
+        workers = config['CREDENTIAL_WORKERS'] or max(1, (os.cpu_count() or 1) // 2)
+        self.pool = CredentialPool(workers, config['CREDENTIAL_QUEUE'], config['CREDENTIAL_QUEUE_WAIT'],
+                                   config['CREDENTIAL_NICE'])
+        self.accounts = Throttle(config['LOGIN_ACCOUNT_ATTEMPTS'], config['LOGIN_WINDOW'])
+        self.addresses = Throttle(config['LOGIN_ADDRESS_ATTEMPTS'], config['LOGIN_WINDOW'])
+
+
+def init_credentials(app):
+    """
+        this method will create the password hashing pool and the login throttles of the app
+        :param: app flask application
+    """
+    app.extensions['credentials'] = Credentials(app.config)
+    app.register_error_handler(CredentialError, credential_error)
+
+
+def credentials():
+    return current_app.extensions['credentials']
+
+
+def credential_error(error):
+    return str(error), error.status, {'Retry-After': str(error.retry_after)}
+
+
+def hash_password(password):
+    """
+        this method will hash a password with the PASSWORD_HASH settings in the worker pool
+        :param: password string
+        :return: hash string
+    """
+    settings = credentials()
+    return settings.pool.run(generate_hash, password, settings.method)
+
+
+def check_password(password_hash, password):
+    """
+        this method will check a password against its hash in the worker pool
+        :return: True when the password matches
+    """
+    return credentials().pool.run(verify_hash, password_hash, password)
+
+
+def authenticate(email, password, address):
+    """
+        this method will check the login of a user, count the failures and save a new hash of the password
+        when the hash settings changed since it was made
+        :param: email login id
+        :param: password string
+        :param: address ip address of the client
+        :return: User, or None when the email or the password is wrong
+    """
+    from budget_aj_app.models import User
+    settings = credentials()
+    account = (email or '').strip().lower()
+    retry_after = max(settings.accounts.retry_after(account), settings.addresses.retry_after(address))
+    if retry_after:
+        raise LoginThrottled(f"Too many failed logins, please try again in {retry_after} seconds.",
+                             retry_after=retry_after)
+    user = User.query.filter_by(email=email).first()
+    if user is None or not check_password(user.password_hash, password):
+        settings.accounts.failed(account)
+        settings.addresses.failed(address)
+        return None
+    settings.accounts.reset(account)
+    if needs_rehash(user.password_hash, settings.method):
+        user.password_hash = hash_password(password)
+        db.session.commit()
+    return user
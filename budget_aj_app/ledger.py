@@ -0,0 +1,387 @@
+################################################
+# ledger.py in budget_aj_app
+################################################
+#
+#   Description:
+#       append only ledger of the money of every budget. every insert, edit and delete of an expense or an
+#       income writes ledger entries in the same transaction (session flush, batch edits), an edit takes the
+#       old amount back with one entry and adds the new amount with another, so the entries are never
+#       changed and the sum of the entries of a row is its current amount. the entries are the audit trail
+#       of the budget: who changed what and when, with the old and the new values of an edit.
+#
+#       `flask ledger snapshot` writes the spend to date of every budget at the end of every closed month
+#       (ledger_snapshot). the spend of a budget as of any day is the last snapshot before that day plus the
+#       entries dated after the snapshot, at most a month of entries. an entry dated on or before a snapshot
+#       (a late or back dated expense) removes the snapshots it changes, the next run writes them again.
+#       the balances are in the budget currency, the entries in other currencies are converted with the
+#       rates of their month (rates.py), so a new budget currency removes the snapshots of the budget too and a
+#       new rate version writes again the snapshots of the budgets with expenses in other currencies.
+#
+#       moving expenses to the archive and back doesn't change the money, it writes no entries, except for an
+#       expense that is restored with a new id: its amount is taken back from the old id and posted on the new
+#       one. the incomes and expenses from before the ledger get an opening entry from `flask ledger open`.
+#
+################################################
+import json
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import click
+from flask import has_request_context
+from flask.cli import AppGroup
+from flask_login import current_user
+from sqlalchemy import event, select, and_, func, extract
+from budget_aj_app import db
+from budget_aj_app.models import Budget, Income, Expenses, ExpenseArchive, LedgerEntry, LedgerSnapshot
+from budget_aj_app.money import DEFAULT_CURRENCY
+from budget_aj_app.rates import Conversion
+from budget_aj_app.rollup import old_value, currency_changed
+from budget_aj_app.sharding import ShardedSession, all_shards, using_shard
+from budget_aj_app.signals import rows_changed
+
+OPENING = 'O'
+INSERT = 'I'
+UPDATE = 'U'
+DELETE = 'D'
+
+entry_table = LedgerEntry.__table__
+snapshot_table = LedgerSnapshot.__table__
+budget_table = Budget.__table__
+
+
+class Ledgered(object):
+    """
+        the columns of a table that go into its ledger entries
+    """
+
+    def __init__(self, model, amount, description, audited, date_column=None, category=None):
+        self.model = model
+        self.amount = amount
+        self.description = description
+        self.audited = audited  # columns whose old and new values are kept for an edit
+        self.date_column = date_column  # the entries of a table without one count on the day of the change
+        self.category = category
+
+    @property
+    def columns(self):
+        return ('id', 'budget_id', 'currency') + self.audited
+
+
+# table name -> columns of the tables in the ledger, only the expenses count in the spend
+LEDGERED = {
+    'expenses': Ledgered(Expenses, 'expense_amount_cents', 'expense_description',
+                         ('expense_description', 'expense_amount_cents', 'category', 'expense_type',
+                          'transaction_date', 'due_date'),
+                         date_column='transaction_date', category='category'),
+    'income': Ledgered(Income, 'income_amount_month_cents', 'income_description',
+                       ('income_description', 'income_amount_month_cents', 'income_tax_bp', 'effective_from',
+                        'effective_to')),
+}
+SPEND_TABLE = 'expenses'
+
+
+def as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def ledger_entry(table_name, row, operation, sign, user_id, changes=None, today=None):
+    """
+        this method will build one ledger entry of a row
+        :param: table_name 'expenses' or 'income'
+        :param: row dict of the Ledgered columns of the row
+        :param: operation OPENING, INSERT, UPDATE or DELETE
+        :param: sign 1 adds the amount of the row, -1 takes it back
+        :param: user_id id of the user that made the change, or None
+        :param: changes optional dict of column -> (old, new) of an edit
+        :param: today optional date of the change
+        :return: dict of the ledger_entry columns
+    """
+    ledgered = LEDGERED[table_name]
+    day = row[ledgered.date_column] if ledgered.date_column else today or date.today()
+    return dict(budget_id=row['budget_id'], table_name=table_name, row_id=row['id'], operation=operation,
+                entry_date=as_date(day), category=row[ledgered.category] if ledgered.category else None,
+                amount_cents=sign * row[ledgered.amount], currency=row.get('currency') or DEFAULT_CURRENCY,
+                description=row.get(ledgered.description),
+                changes=json.dumps({column: [json_value(old), json_value(new)]
+                                    for column, (old, new) in changes.items()}) if changes else None,
+                user_id=user_id, recorded_at=datetime.utcnow())
+
+
+def edit_entries(table_name, old, new, user_id):
+    """
+        this method will build the two entries of an edit, none when no audited column changed
+        :param: old dict of the Ledgered columns before the edit
+        :param: new dict of the Ledgered columns after the edit
+        :return: list of entries
+    """
+    changes = {column: (old.get(column), new.get(column)) for column in LEDGERED[table_name].audited
+               if column in new and old.get(column) != new.get(column)}
+    if not changes:
+        return []
+    return [ledger_entry(table_name, old, UPDATE, -1, user_id),
+            ledger_entry(table_name, new, UPDATE, 1, user_id, changes)]
+
+
+def write_entries(session, entries):
+    """
+        this method will append entries to the ledger and remove the snapshots of the days they change
+        :param: session database session in the transaction of the write
+        :param: entries list of dicts made by ledger_entry()
+    """
+    if not entries:
+        return
+    session.execute(entry_table.insert(), entries)
+    first_day = {}
+    for entry in entries:
+        if entry['table_name'] == SPEND_TABLE:
+            budget_id = entry['budget_id']
+            first_day[budget_id] = min(first_day.get(budget_id, entry['entry_date']), entry['entry_date'])
+    for budget_id, day in first_day.items():
+        session.execute(snapshot_table.delete().where(and_(snapshot_table.c.budget_id == budget_id,
+                                                           snapshot_table.c.as_of >= day)))
+
+
+"""""
+WRITE HOOKS
+"""""
+
+
+def acting_user_id(session):
+    # the user of the request, the jobs and the command line write entries without one
+    if not has_request_context():
+        return None
+    with session.no_autoflush:
+        return current_user.id if current_user.is_authenticated else None
+
+
+def row_values(obj, old=False):
+    read = (lambda name: old_value(obj, name)) if old else (lambda name: getattr(obj, name))
+    return {name: read(name) for name in LEDGERED[obj.__tablename__].columns}
+
+
+@event.listens_for(ShardedSession, 'after_flush')
+def record_flushed_changes(session, flush_context):
+    # the snapshots of a budget that changed its currency are in the old one
+    for budget_id in currency_changed(session):
+        session.execute(snapshot_table.delete().where(snapshot_table.c.budget_id == budget_id))
+    changed = [(INSERT, obj) for obj in session.new if obj.__tablename__ in LEDGERED] + \
+              [(DELETE, obj) for obj in session.deleted if obj.__tablename__ in LEDGERED] + \
+              [(UPDATE, obj) for obj in session.dirty if obj.__tablename__ in LEDGERED and
+               session.is_modified(obj, include_collections=False)]
+    if not changed:
+        return
+    user_id = acting_user_id(session)
+    entries = []
+    for operation, obj in changed:
+        if operation == INSERT:
+            entries.append(ledger_entry(obj.__tablename__, row_values(obj), INSERT, 1, user_id))
+        elif operation == DELETE:
+            entries.append(ledger_entry(obj.__tablename__, row_values(obj, old=True), DELETE, -1, user_id))
+        else:
+            entries.extend(edit_entries(obj.__tablename__, row_values(obj, old=True), row_values(obj), user_id))
+    write_entries(session, entries)
+
+
+@rows_changed.connect
+def record_batch_changes(sender, session, user_id, table_name, rows, values, deleted, **extra):
+    # written in the same transaction as the batch statement, batch.run_batch reads the Ledgered columns
+    if table_name not in LEDGERED:
+        return
+    entries = []
+    for row in rows:
+        if deleted:
+            entries.append(ledger_entry(table_name, row, DELETE, -1, user_id))
+        else:
+            entries.extend(edit_entries(table_name, row, dict(row, **values), user_id))
+    write_entries(session, entries)
+
+
+"""""
+BALANCES
+"""""
+
+
+class Balance(object):
+    """
+        spend to date of a budget at the end of a day, amounts in cents of the budget currency
+    """
+    __slots__ = ('budget_id', 'as_of', 'spent_cents', 'categories', 'snapshot', 'replayed')
+
+    def __init__(self, budget_id, as_of, categories, snapshot, replayed):
+        self.budget_id = budget_id
+        self.as_of = as_of
+        self.categories = {category: cents for category, cents in categories.items() if cents}
+        self.spent_cents = sum(self.categories.values())
+        self.snapshot = snapshot  # day of the snapshot it started from, None without one
+        self.replayed = replayed  # entries read after the snapshot
+
+
+def balance_as_of(budget_id, day):
+    """
+        this method will read the spend to date of a budget from its last snapshot on or before the day and
+        the entries after the snapshot, converted to the budget currency in the month of their date
+        :param: budget_id integer budget id
+        :param: day date, the entries of that day are included
+        :return: Balance
+    """
+    snapshot = LedgerSnapshot.query.filter(LedgerSnapshot.budget_id == budget_id, LedgerSnapshot.as_of <= day). \
+        order_by(LedgerSnapshot.as_of.desc()).first()
+    categories = defaultdict(int, json.loads(snapshot.categories) if snapshot else {})
+    condition = and_(entry_table.c.budget_id == budget_id, entry_table.c.table_name == SPEND_TABLE,
+                     entry_table.c.entry_date <= day)
+    if snapshot is not None:
+        condition = and_(condition, entry_table.c.entry_date > snapshot.as_of)
+    replayed = 0
+    conversion = Conversion(entry_table.c.currency, budget_table.c.currency,
+                            extract('year', entry_table.c.entry_date), extract('month', entry_table.c.entry_date))
+    for category, cents, count in db.session.execute(
+            select([entry_table.c.category, func.sum(conversion.cents(entry_table.c.amount_cents)), func.count()]).
+            select_from(conversion.join(entry_table.join(budget_table,
+                                                         budget_table.c.id == entry_table.c.budget_id))).
+            where(condition).group_by(entry_table.c.category)):
+        categories[category] += int(cents or 0)
+        replayed += count
+    return Balance(budget_id, day, categories, snapshot.as_of if snapshot else None, replayed)
+
+
+def month_end(year, month):
+    return date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+
+
+def take_snapshots(budget_id, until=None):
+    """
+        this method will write the missing snapshots of a budget at the end of every month up to a day
+        :param: budget_id integer budget id
+        :param: until optional last day to snapshot, the end of the last closed month by default
+        :return: number of written snapshots
+    """
+    until = until or date.today().replace(day=1) - timedelta(days=1)
+    latest = db.session.query(func.max(LedgerSnapshot.as_of)).filter(LedgerSnapshot.budget_id == budget_id).scalar()
+    if latest is None:
+        latest = db.session.query(func.min(LedgerEntry.entry_date)). \
+            filter(LedgerEntry.budget_id == budget_id, LedgerEntry.table_name == SPEND_TABLE).scalar()
+        if latest is None:
+            return 0
+        latest -= timedelta(days=1)  # the first snapshot is at the end of the month of the first entry
+    written = 0
+    index = latest.year * 12 + latest.month - 1 + (latest == month_end(latest.year, latest.month))
+    while True:
+        day = month_end(index // 12, index % 12 + 1)
+        if day > until:
+            break
+        balance = balance_as_of(budget_id, day)
+        db.session.add(LedgerSnapshot(budget_id=budget_id, as_of=day, spent_cents=balance.spent_cents,
+                                      categories=json.dumps(balance.categories, sort_keys=True)))
+        db.session.flush()
+        written += 1
+        index += 1
+    db.session.commit()
+    return written
+
+
+def snapshot_budgets(until=None, budget_id=None):
+    """
+        this method will write the missing snapshots of the budgets of the current shard
+        :return: number of written snapshots
+    """
+    query = db.session.query(Budget.id).filter(Budget.deleted_at.is_(None))
+    if budget_id is not None:
+        query = query.filter(Budget.id == budget_id)
+    return sum(take_snapshots(budget, until) for budget, in query.all())
+
+
+"""""
+AUDIT TRAIL
+"""""
+
+
+def audit_query(budget_id, table_name=None, row_id=None, before=None, limit=50):
+    """
+        this method will build the query of the latest ledger entries of a budget, newest first
+        :param: budget_id integer budget id
+        :param: table_name optional 'expenses' or 'income'
+        :param: row_id optional id of one expense or income
+        :param: before optional entry id, only older entries (the next page)
+        :param: limit entries of the page, one more is read to know if there are more
+        :return: select of the ledger entries
+    """
+    query = select([entry_table]).where(entry_table.c.budget_id == budget_id)
+    if table_name:
+        query = query.where(entry_table.c.table_name == table_name)
+    if row_id is not None:
+        query = query.where(entry_table.c.row_id == row_id)
+    if before is not None:
+        query = query.where(entry_table.c.id < before)
+    return query.order_by(entry_table.c.id.desc()).limit(limit + 1)
+
+
+def entry_json(entry):
+    return {'id': entry.id, 'kind': entry.table_name, 'row_id': entry.row_id, 'operation': entry.operation,
+            'date': entry.entry_date.isoformat(), 'category': entry.category, 'amount_cents': entry.amount_cents,
+            'currency': entry.currency, 'description': entry.description,
+            'changes': json.loads(entry.changes) if entry.changes else None, 'user_id': entry.user_id,
+            'recorded_at': entry.recorded_at.isoformat()}
+
+
+"""""
+OPENING ENTRIES
+"""""
+
+
+def open_ledger(budget_id=None):
+    """
+        this method will write an opening entry for every income and expense (archived ones too) of the
+        budgets of the current shard that have no ledger entry yet
+        :param: budget_id optional budget id
+        :return: number of written entries
+    """
+    from budget_aj_app.archive import unpack_expenses
+    opened = select([entry_table.c.budget_id]).distinct()
+    query = db.session.query(Budget.id).filter(Budget.deleted_at.is_(None), ~Budget.id.in_(opened))
+    if budget_id is not None:
+        query = query.filter(Budget.id == budget_id)
+    written = 0
+    for budget, in query.all():
+        entries = []
+        for table_name, ledgered in LEDGERED.items():
+            table = ledgered.model.__table__
+            for row in db.session.execute(select([table.c[name] for name in ledgered.columns]).
+                                          where(table.c.budget_id == budget)):
+                entries.append(ledger_entry(table_name, dict(row), OPENING, 1, None))
+        for archive in ExpenseArchive.query.filter_by(budget_id=budget):
+            entries.extend(ledger_entry(SPEND_TABLE, dict(row, budget_id=budget), OPENING, 1, None)
+                           for row in unpack_expenses(archive.data))
+        write_entries(db.session(), entries)
+        db.session.commit()
+        written += len(entries)
+    return written
+
+
+"""""
+COMMAND LINE
+"""""
+
+ledger_command = AppGroup('ledger', help='Keep the budget ledger and its snapshots.')
+
+
+@ledger_command.command('snapshot')
+@click.option('--until', default=None, help='last day to snapshot (YYYY-MM-DD), the last closed month by default')
+@click.option('--budget-id', type=int, default=None, help='only snapshot one budget')
+def snapshot_command(until, budget_id):
+    """Write the missing month end snapshots of the budgets."""
+    until = datetime.strptime(until, '%Y-%m-%d').date() if until else None
+    for shard in all_shards():
+        with using_shard(shard):
+            click.echo(f"{shard or 'default'}: {snapshot_budgets(until, budget_id)} snapshots")
+
+
+@ledger_command.command('open')
+@click.option('--budget-id', type=int, default=None, help='only open one budget')
+def open_command(budget_id):
+    """Write the opening entries of the budgets from before the ledger."""
+    for shard in all_shards():
+        with using_shard(shard):
+            click.echo(f"{shard or 'default'}: {open_ledger(budget_id)} opening entries")
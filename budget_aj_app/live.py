@@ -0,0 +1,267 @@
+################################################
+# live.py in budget_aj_app
+################################################
+#
+#   Description:
+#       live dashboard updates. every commit that touches a budget publishes a small message on the budget
+#       channel, the open dashboards listen on /dashboard/live/<budget_id> (server-sent events) and patch
+#       their charts with the deltas instead of reloading the page.
+#
+#       the pub/sub is pluggable (LIVE_BROKER):
+#           'memory'                       in-process, one worker (flask run, gunicorn --workers 1 --threads n)
+#           'sqlite:////path/live.sqlite'  local stand-in for a shared broker when there are several workers on
+#                                          one machine, each worker polls the shared file and fans out locally
+#
+################################################
+import json
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
+from budget_aj_app.models import Budget, Income, Expenses
+from budget_aj_app.sharding import ShardedSession, current_shard
+from budget_aj_app.signals import rows_changed, category_over_limit
+
+
+"""""
+BROKERS
+"""""
+
+
+class Subscription(object):
+    """
+        the messages of one channel for one listener, a slow listener that falls too far behind is told
+        to reload instead of blocking the publishers
+    """
+    RELOAD = {'reload': True}
+
+    def __init__(self, channel, size):
+        self.channel = channel
+        self.messages = queue.Queue(maxsize=size)
+        self.overflowed = False
+
+    def put(self, message):
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+            this method will wait for the next message
+            :param: timeout seconds to wait
+            :return: message dict or None when nothing arrived in time
+        """
+        if self.overflowed:
+            self.overflowed = False
+            return self.RELOAD
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class InProcessBroker(object):
+    """
+        pub/sub inside one process, publish() hands the message to every subscription of the channel
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    @contextmanager
+    def subscribe(self, channel):
+        subscription = Subscription(channel, self.queue_size)
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self.lock:
+                self.channels[channel].discard(subscription)
+                if not self.channels[channel]:
+                    del self.channels[channel]
+
+
+class SqliteBroker(InProcessBroker):
+    """
+        pub/sub between the worker processes of one machine through a shared sqlite file. publish() appends
+        to the file, one thread per process polls it and delivers the new messages to the local subscriptions
+    """
+
+    def __init__(self, path, poll_interval=0.5, retention=60, queue_size=100):
+        super().__init__(queue_size)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.poller = None
+        connection = self.connect()
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS live_message (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "channel TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)")
+        finally:
+            connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def publish(self, channel, message):
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("INSERT INTO live_message (channel, payload, created) VALUES (?, ?, ?)",
+                                   (channel, json.dumps(message), now))
+                connection.execute("DELETE FROM live_message WHERE created < ?", (now - self.retention,))
+        finally:
+            connection.close()
+
+    @contextmanager
+    def subscribe(self, channel):
+        with super().subscribe(channel) as subscription:
+            with self.lock:
+                if self.poller is None or not self.poller.is_alive():
+                    self.poller = threading.Thread(target=self.poll, name='live-broker', daemon=True)
+                    self.poller.start()
+            yield subscription
+
+    def poll(self):
+        connection = self.connect()
+        try:
+            last_id = connection.execute("SELECT COALESCE(MAX(id), 0) FROM live_message").fetchone()[0]
+            while True:
+                with self.lock:
+                    if not self.channels:
+                        return  # nobody listens, the next subscribe starts a new poller
+                rows = connection.execute("SELECT id, channel, payload FROM live_message WHERE id > ? ORDER BY id",
+                                          (last_id,)).fetchall()
+                for message_id, channel, payload in rows:
+                    last_id = message_id
+                    super().publish(channel, json.loads(payload))
+                time.sleep(self.poll_interval)
+        finally:
+            connection.close()
+
+
+def init_live(app):
+    """
+        this method will create the broker configured by LIVE_BROKER for the app
+        :param: app flask application
+    """
+    setting = app.config['LIVE_BROKER']
+    if setting == 'memory':
+        broker = InProcessBroker()
+    elif setting.startswith('sqlite:///'):
+        broker = SqliteBroker(setting[len('sqlite:///'):], poll_interval=app.config['LIVE_POLL_INTERVAL'])
+    else:
+        raise ValueError(f"unknown LIVE_BROKER {setting!r}")
+    app.extensions['live_broker'] = broker
+    # every open stream keeps one worker thread busy, only so many may be open at once
+    app.extensions['live_streams'] = threading.BoundedSemaphore(app.config['LIVE_MAX_STREAMS'])
+
+
+def broker():
+    return current_app.extensions['live_broker']
+
+
+def stream_slots():
+    return current_app.extensions['live_streams']
+
+
+def budget_channel(budget_id, shard=None):
+    # the budget ids are only unique inside one shard
+    return f"budget:{budget_id}" if shard is None else f"budget:{shard}:{budget_id}"
+
+
+"""""
+PUBLISH ON COMMIT
+"""""
+
+
+def pending_changes(session, budget_id):
+    # the shard of the write, the session is in it until the commit
+    return session.info.setdefault('live_changes', {}).setdefault(
+        (current_shard(), budget_id), {'expenses': set(), 'deleted_expenses': set(), 'incomes': set(), 'deleted_incomes': set(),
+                    'categories': set(), 'alerts': [], 'totals': False, 'deleted': False})
+
+
+@event.listens_for(ShardedSession, 'after_flush')
+def collect_live_changes(session, flush_context):
+    for state, objects in (('new', session.new), ('dirty', session.dirty), ('deleted', session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Expenses):
+                changes = pending_changes(session, obj.budget_id)
+                changes['deleted_expenses' if state == 'deleted' else 'expenses'].add(obj.id)
+                history = get_history(obj, 'category')
+                changes['categories'].update(history.sum() if state == 'dirty' else [obj.category])
+                changes['totals'] = True
+            elif isinstance(obj, Income):
+                changes = pending_changes(session, obj.budget_id)
+                changes['deleted_incomes' if state == 'deleted' else 'incomes'].add(obj.id)
+                changes['totals'] = True
+            elif isinstance(obj, Budget) and state == 'dirty' and obj.deleted_at is not None:
+                pending_changes(session, obj.id)['deleted'] = True
+
+
+@rows_changed.connect
+def collect_batch_changes(sender, session, user_id, table_name, rows, values, deleted, **extra):
+    # published with the flushed changes when the batch transaction commits
+    name = {'expenses': 'expenses', 'income': 'incomes'}.get(table_name)
+    if name is None:
+        return
+    for row in rows:
+        changes = pending_changes(session, row['budget_id'])
+        changes[f'deleted_{name}' if deleted else name].add(row['id'])
+        if name == 'expenses':
+            changes['categories'].update({row['category'], values.get('category', row['category'])})
+        changes['totals'] = True
+
+
+@category_over_limit.connect
+def collect_limit_alerts(sender, session, budget_id, year, month, category, spent_cents, limit_cents, **extra):
+    pending_changes(session, budget_id)['alerts'].append(
+        {'year': year, 'month': month, 'category': category, 'spent_cents': spent_cents, 'limit_cents': limit_cents})
+
+
+@event.listens_for(ShardedSession, 'after_commit')
+def publish_live_changes(session):
+    changes = session.info.pop('live_changes', None)
+    if not changes or 'live_broker' not in current_app.extensions:
+        return
+    for (shard, budget_id), change in changes.items():
+        message = {key: sorted(value) if isinstance(value, set) else value for key, value in change.items()}
+        message['budget_id'] = budget_id
+        try:
+            broker().publish(budget_channel(budget_id, shard), message)
+        except Exception:
+            # the data is committed, a missed live update only means a stale chart until the next reload
+            current_app.logger.exception(f"live update of budget {budget_id} failed")
+
+
+@event.listens_for(ShardedSession, 'after_rollback')
+def drop_live_changes(session):
+    session.info.pop('live_changes', None)
+
+
+def sse(event_name, data):
+    """
+        this method will format one server-sent event
+        :param: event_name name of the event the page listens to
+        :param: data json serializable payload
+        :return: string of the event
+    """
+    return f"event: {event_name}\ndata: {json.dumps(data)}\n\n"
@@ -1,8 +1,12 @@
 from budget_aj_app import db,login_manager
+from budget_aj_app.sharding import sharded, replicated
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from budget_aj_app import credentials
 from flask_login import UserMixin
+from sqlalchemy import func
 from sqlalchemy.orm import backref
+from sqlalchemy.ext.hybrid import hybrid_property
+from budget_aj_app.money import Money, DEFAULT_CURRENCY, to_cents, from_cents, to_basis_points, from_basis_points
 
 
 @login_manager.user_loader
@@ -26,19 +30,34 @@ class User(db.Model, UserMixin):
     def __init__(self, email, user_name, password):
         self.email = email
         self.user_name = user_name
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = credentials.hash_password(password)
 
+    # the hashes run in the worker pool of credentials.py
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return credentials.check_password(self.password_hash, password)
 
     def hash_password(self, password):
-        return generate_password_hash(password)
+        return credentials.hash_password(password)
 
 
     def __repr__(self):
         return f"UserName: {self.user_name}"
 
 
+class UserShard(db.Model):
+
+    __tablename__ = 'user_shard'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    shard = db.Column(db.String(64), nullable=False, index=True)
+    status = db.Column(db.String(16), nullable=False, default='active')  # 'moving' while the data is copied
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"User {self.user_id} is on shard {self.shard}."
+
+
+@sharded(owner='user_id')
 class Budget(db.Model, UserMixin):
 
     __tablename__ = 'budget'
@@ -49,21 +68,33 @@ class Budget(db.Model, UserMixin):
     creation_date = db.Column(db.DateTime, nullable=False,
                               default=datetime.utcnow(), onupdate=datetime.utcnow())
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)  # set when the budget waits for the purge
+    currency = db.Column(db.String(3), nullable=False, default=DEFAULT_CURRENCY)  # the totals are shown in it
     incomes = db.relationship('Income', backref='budget', lazy=True, passive_deletes=True)
     expenses = db.relationship('Expenses', backref='budget', lazy=True, passive_deletes=True)
 
-    def __init__(self, user_id, budget_name, budget_description=""):
+    def __init__(self, user_id, budget_name, budget_description="", currency=DEFAULT_CURRENCY):
         self.budget_name = budget_name
         self.budget_description = budget_description
         self.user_id = user_id
+        self.currency = currency
 
     def get_id(self):
         return self.id
 
+    @classmethod
+    def active(cls):
+        """
+            this method will return the budget query without the deleted budgets
+            :return: query object
+        """
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     def __repr__(self):
         return f"New Budget has been added: {self.budget_name}."
 
 
+@sharded(owner='user_id', references={'selected_budget_id': 'budget'})
 class UserSelect(db.Model, UserMixin):
 
     __tablename__ = 'user_select'
@@ -80,35 +111,79 @@ class UserSelect(db.Model, UserMixin):
         return f"Budget you selected is: {Budget.query.filter_by(id=self.selected_budget_id).first()}."
 
 
+@sharded(owner='budget_id', references={'budget_id': 'budget'})
 class Income(db.Model, UserMixin):
 
     __tablename__ = 'income'
 
     id = db.Column(db.Integer, primary_key=True)
-    income_amount_month = db.Column(db.Float, nullable=False)
+    income_amount_month_cents = db.Column(db.BigInteger, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default=DEFAULT_CURRENCY)
     income_description = db.Column(db.String(64), nullable=False)
-    income_tax = db.Column(db.Float, default=0)
+    income_tax_bp = db.Column(db.Integer, nullable=False, default=0)  # tax % in basis points (1/100 of a %)
+    # months the income counts in, an empty date is an open end
+    effective_from = db.Column(db.Date, nullable=True)
+    effective_to = db.Column(db.Date, nullable=True)
     creation_date = db.Column(db.DateTime, nullable=False,
                               default=datetime.utcnow(), onupdate=datetime.utcnow())
     budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False)
 
-    def __init__(self, budget_id, income_amount_month, income_description, income_tax):
+    def __init__(self, budget_id, income_amount_month, income_description, income_tax, currency=DEFAULT_CURRENCY,
+                 effective_from=None, effective_to=None):
         self.budget_id = budget_id
         self.income_amount_month = income_amount_month
         self.income_description = income_description
         self.income_tax = income_tax
+        self.currency = currency
+        self.effective_from = effective_from
+        self.effective_to = effective_to
+
+    @hybrid_property
+    def income_amount_month(self):
+        return from_cents(self.income_amount_month_cents)
+
+    @income_amount_month.setter
+    def income_amount_month(self, amount):
+        self.income_amount_month_cents = to_cents(amount)
+
+    @income_amount_month.expression
+    def income_amount_month(cls):
+        return cls.income_amount_month_cents / 100.0
+
+    @hybrid_property
+    def income_tax(self):
+        return from_basis_points(self.income_tax_bp)
+
+    @income_tax.setter
+    def income_tax(self, percent):
+        self.income_tax_bp = to_basis_points(percent)
+
+    @income_tax.expression
+    def income_tax(cls):
+        return cls.income_tax_bp / 100.0
+
+    @property
+    def income_money(self):
+        return Money(self.income_amount_month_cents, self.currency)
+
+    @property
+    def income_after_tax_cents(self):
+        # integer math, rounded half up to the cent
+        return (self.income_amount_month_cents * (10000 - self.income_tax_bp) + 5000) // 10000
 
     def __repr__(self):
         return f"New income added to the budget.."
 
 
+@sharded(owner='budget_id', references={'budget_id': 'budget'})
 class Expenses(db.Model, UserMixin):
 
     __tablename__ = 'expenses'
 
     id = db.Column(db.Integer, primary_key=True)
     expense_description = db.Column(db.String(128), nullable=False)
-    expense_amount = db.Column(db.Float, nullable=False)
+    expense_amount_cents = db.Column(db.BigInteger, nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default=DEFAULT_CURRENCY)
     category = db.Column(db.String(64), nullable=False)
     expense_type = db.Column(db.String(32), nullable=False)
     due_date = db.Column(db.DateTime, nullable=True)
@@ -116,7 +191,8 @@ class Expenses(db.Model, UserMixin):
     creation_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow(), onupdate=datetime.utcnow())
     budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False)
 
-    def __init__(self, budget_id, expense_description, expense_amount, category, expense_type, transaction_date, due_date=None):
+    def __init__(self, budget_id, expense_description, expense_amount, category, expense_type, transaction_date, due_date=None,
+                 currency=DEFAULT_CURRENCY):
         self.budget_id = budget_id
         self.expense_description = expense_description
         self.expense_amount = expense_amount
@@ -124,6 +200,245 @@ class Expenses(db.Model, UserMixin):
         self.expense_type = expense_type
         self.transaction_date = transaction_date
         self.due_date = due_date
+        self.currency = currency
+
+    @hybrid_property
+    def expense_amount(self):
+        return from_cents(self.expense_amount_cents)
+
+    @expense_amount.setter
+    def expense_amount(self, amount):
+        self.expense_amount_cents = to_cents(amount)
+
+    @expense_amount.expression
+    def expense_amount(cls):
+        return cls.expense_amount_cents / 100.0
+
+    @property
+    def expense_money(self):
+        return Money(self.expense_amount_cents, self.currency)
 
     def __repr__(self):
         return f"New Expense has been added to the budget.."
+
+
+@sharded(owner='budget_id', references={'budget_id': 'budget'})
+class CategoryLimit(db.Model):
+
+    __tablename__ = 'category_limit'
+    __table_args__ = (db.UniqueConstraint('budget_id', 'category'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False)
+    category = db.Column(db.String(64), nullable=False)
+    limit_cents = db.Column(db.BigInteger, nullable=False)  # monthly limit
+
+    def __init__(self, budget_id, category, limit):
+        self.budget_id = budget_id
+        self.category = category
+        self.limit = limit
+
+    @hybrid_property
+    def limit(self):
+        return from_cents(self.limit_cents)
+
+    @limit.setter
+    def limit(self, amount):
+        self.limit_cents = to_cents(amount)
+
+    def __repr__(self):
+        return f"Limit of {self.category} is {self.limit}."
+
+
+@sharded(owner='budget_id', references={'budget_id': 'budget'})
+class CategorySpend(db.Model):
+    """
+        spend to date of one category in one month of a budget in one currency, kept up to date by the write
+        hooks in rollup.py. the reads convert it to the budget currency (rates.py)
+    """
+
+    __tablename__ = 'category_spend'
+    __table_args__ = (db.UniqueConstraint('budget_id', 'year', 'month', 'category', 'currency'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    category = db.Column(db.String(64), nullable=False)
+    currency = db.Column(db.String(3), nullable=False, default=DEFAULT_CURRENCY)
+    spent_cents = db.Column(db.BigInteger, nullable=False, default=0)
+    expense_count = db.Column(db.Integer, nullable=False, default=0)
+    over_limit_since = db.Column(db.DateTime, nullable=True)  # set by the write that went over the limit
+
+    @property
+    def spent(self):
+        return from_cents(self.spent_cents)
+
+    def __repr__(self):
+        return f"{self.category} {self.year}-{self.month}: {self.spent}."
+
+
+def remap_archive(connection, row, id_maps):
+    # the blob format is in archive.py, which imports the models
+    from budget_aj_app.archive import remap_archived_ids
+    return remap_archived_ids(connection, row, id_maps)
+
+
+@sharded(owner='budget_id', references={'budget_id': 'budget'}, remap=remap_archive)
+class ExpenseArchive(db.Model):
+    """
+        the expenses of one closed month of a budget, compressed into one blob by archive.py. the spend of the
+        month stays in category_spend
+    """
+
+    __tablename__ = 'expense_archive'
+    __table_args__ = (db.UniqueConstraint('budget_id', 'year', 'month'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    expense_count = db.Column(db.Integer, nullable=False)
+    total_cents = db.Column(db.BigInteger, nullable=False)
+    archive_format = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Archive of {self.year}-{self.month}: {self.expense_count} expenses."
+
+
+# the row ids follow the rows to their new ids when the user is moved to another shard, the archived expenses too
+# (their new ids are written into the archive blobs)
+@sharded(owner='budget_id', references={'budget_id': 'budget'},
+         row_references={'row_id': ('table_name', ('expenses', 'income'))})
+class LedgerEntry(db.Model):
+    """
+        one change of the money of a budget, written by the write hooks in ledger.py and never changed after.
+        an edit is two entries, one taking the old amount back and one with the new amount
+    """
+
+    __tablename__ = 'ledger_entry'
+    __table_args__ = (db.Index('ix_ledger_entry_budget_date', 'budget_id', 'entry_date'),
+                      db.Index('ix_ledger_entry_budget_row', 'budget_id', 'table_name', 'row_id'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False)
+    table_name = db.Column(db.String(32), nullable=False)  # 'expenses' or 'income'
+    row_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(1), nullable=False)  # 'O' opening, 'I' insert, 'U' update, 'D' delete
+    entry_date = db.Column(db.Date, nullable=False)  # day the amount counts on
+    category = db.Column(db.String(64), nullable=True)
+    amount_cents = db.Column(db.BigInteger, nullable=False)  # signed, spend for expenses, monthly amount for incomes
+    currency = db.Column(db.String(3), nullable=False, default=DEFAULT_CURRENCY)
+    description = db.Column(db.String(128), nullable=True)
+    changes = db.Column(db.Text, nullable=True)  # json {column: [old, new]} of an update
+    user_id = db.Column(db.Integer, nullable=True)  # who made the change, when known
+    recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Ledger entry {self.id}: {self.operation} {self.table_name} {self.row_id} {self.amount_cents}."
+
+
+@sharded(owner='budget_id', references={'budget_id': 'budget'})
+class LedgerSnapshot(db.Model):
+    """
+        spend to date of a budget at the end of one day, in total and by category, written by
+        `flask ledger snapshot`. a balance is read from the last snapshot before it and the entries after it
+    """
+
+    __tablename__ = 'ledger_snapshot'
+    __table_args__ = (db.UniqueConstraint('budget_id', 'as_of'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    budget_id = db.Column(db.Integer, db.ForeignKey('budget.id', ondelete='CASCADE'), nullable=False)
+    as_of = db.Column(db.Date, nullable=False)  # the entries of this day are in it
+    spent_cents = db.Column(db.BigInteger, nullable=False)
+    categories = db.Column(db.Text, nullable=False)  # json {category: spent cents}
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Snapshot of budget {self.budget_id} on {self.as_of}: {from_cents(self.spent_cents)}."
+
+
+@replicated
+class RateVersion(db.Model):
+    """
+        one loaded exchange rate file, the queries convert with the rates of the active version (rates.py)
+    """
+
+    __tablename__ = 'rate_version'
+
+    id = db.Column(db.Integer, primary_key=True)
+    checksum = db.Column(db.String(64), nullable=False)  # sha256 of the file
+    source = db.Column(db.String(255), nullable=False)  # file name
+    base_currency = db.Column(db.String(3), nullable=False)
+    valid_from = db.Column(db.Date, nullable=False)  # first day of the first month with rates
+    valid_to = db.Column(db.Date, nullable=False)  # first day of the last month with rates
+    rate_count = db.Column(db.Integer, nullable=False)
+    active = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    loaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Rate version {self.id} from {self.source}: {self.rate_count} rates."
+
+
+@replicated
+class ExchangeRate(db.Model):
+    """
+        rate of one currency in one month of a rate version, the mean of the rates of the month in the file
+    """
+
+    __tablename__ = 'exchange_rate'
+
+    version_id = db.Column(db.Integer, db.ForeignKey('rate_version.id', ondelete='CASCADE'), primary_key=True)
+    currency = db.Column(db.String(3), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    rate_micros = db.Column(db.BigInteger, nullable=False)  # units of the currency for one base currency unit, x 10^6
+
+    def __repr__(self):
+        return f"{self.currency} {self.year}-{self.month}: {self.rate_micros / 10 ** 6}."
+
+
+# the /api/lookup typeahead searches the descriptions of one budget by case insensitive prefix
+db.Index('ix_income_budget_description', Income.budget_id, func.lower(Income.income_description))
+db.Index('ix_expenses_budget_description', Expenses.budget_id, func.lower(Expenses.expense_description))
+
+
+@sharded(owner='user_id')
+class ChangeLog(db.Model):
+
+    __tablename__ = 'change_log'
+    # the log is kept next to the rows it describes, the versions count up per user (ChangeCounter)
+    __table_args__ = (db.Index('ix_change_log_user_version', 'user_id', 'version', unique=True),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    budget_id = db.Column(db.Integer, nullable=True)
+    table_name = db.Column(db.String(32), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(1), nullable=False)  # 'I' insert, 'U' update, 'D' delete
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Change {self.version}: {self.operation} {self.table_name} {self.row_id}."
+
+
+@sharded(owner='user_id')
+class ChangeCounter(db.Model):
+    """
+        last change log version handed out to a user. the transaction that writes change log entries of the user
+        keeps the row locked until it commits, so the versions of a user commit in the order they are handed out
+        and a client that synced past a version never misses a smaller one
+    """
+
+    __tablename__ = 'change_counter'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, unique=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"Change counter of user {self.user_id}: {self.version}."
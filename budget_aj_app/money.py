@@ -0,0 +1,78 @@
+################################################
+# money.py in budget_aj_app
+################################################
+#
+#   Description:
+#       amounts are stored as integer cents (and percentages as integer basis points) so sums in the
+#       database are exact, these helpers convert between the stored integers and Decimal amounts
+#
+################################################
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+DEFAULT_CURRENCY = 'USD'
+CENT = Decimal('0.01')
+
+
+def to_cents(amount):
+    """
+        this method will convert an amount of money to integer cents, rounding half up
+        :param: amount float, Decimal, int or string amount, None is treated as 0
+        :return: integer cents
+    """
+    if amount is None:
+        return 0
+    if not isinstance(amount, Decimal):
+        amount = Decimal(str(amount))  # str() keeps a float like 12.34 from becoming 12.339999...
+    return int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    """
+        this method will convert integer cents to a Decimal amount with two places
+        :param: cents integer cents, None is treated as 0
+        :return: Decimal amount
+    """
+    return (Decimal(cents or 0) / 100).quantize(CENT)
+
+
+def to_basis_points(percent):
+    """
+        this method will convert a percentage to integer basis points (hundredths of a percent)
+        :param: percent float, Decimal, int or string percentage, None is treated as 0
+        :return: integer basis points
+    """
+    return to_cents(percent)
+
+
+def from_basis_points(basis_points):
+    """
+        this method will convert integer basis points to a Decimal percentage
+        :param: basis_points integer hundredths of a percent
+        :return: Decimal percentage
+    """
+    return from_cents(basis_points)
+
+
+class Money(namedtuple('Money', ['cents', 'currency'])):
+    """
+        an exact amount of money in one currency
+    """
+    __slots__ = ()
+
+    @property
+    def amount(self):
+        return from_cents(self.cents)
+
+    def __add__(self, other):
+        if not isinstance(other, Money):
+            return NotImplemented
+        if other.currency != self.currency:
+            raise ValueError(f"can't add {other.currency} to {self.currency}")
+        return Money(self.cents + other.cents, self.currency)
+
+    def __float__(self):
+        return float(self.amount)
+
+    def __str__(self):
+        return f"{self.amount} {self.currency}"
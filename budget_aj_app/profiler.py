@@ -0,0 +1,315 @@
+################################################
+# profiler.py in budget_aj_app
+################################################
+#
+#   Description:
+#       request profiling for admins. a selected request (an admin sending the PROFILER_HEADER, a user listed
+#       in PROFILE_USERS or an endpoint listed in PROFILE_ROUTES) is sampled by a background thread every
+#       PROFILER_INTERVAL seconds. the stacks of the request thread cover everything it runs, the queries
+#       of sqlalchemy, the plotly figures and the jinja templates alike, and the sql statements it sends are
+#       timed. every profile is saved in PROFILER_DIR as
+#           stacks.txt   collapsed stacks, one "frame;frame;frame count" line per stack (flamegraph.pl format)
+#           flame.svg    flame graph of the stacks
+#           profile.json the request, the share of the samples per component and the query list
+#       and the admins list and download them under /admin/profiles.
+#
+#       nothing of this module is imported or hooked into the app unless PROFILER_ENABLED is set, so the
+#       requests of an app without the profiler pay nothing for it.
+#
+################################################
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from html import escape
+from flask import Blueprint, current_app, g, request, abort, jsonify, send_from_directory
+from flask_login import current_user, login_required
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# package of a frame -> component the samples are counted for
+COMPONENTS = (('sqlalchemy', 'sqlalchemy'), ('plotly', 'plotly'), ('jinja2', 'jinja'),
+              ('budget_aj_app', 'app'))
+COLORS = {'sqlalchemy': '#e8793c', 'plotly': '#4c8fd6', 'jinja': '#55b26a', 'app': '#d9b43c', None: '#b9b9b9'}
+MAX_QUERY_LENGTH = 2000  # characters of a statement kept in the query list
+
+# thread id -> Profile of the request running in that thread
+active = {}
+
+
+class Profile(object):
+    """
+        the samples and the queries of one request
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()  # tuple of frames, root first -> number of samples
+        self.queries = []
+        self.started = time.perf_counter()
+        self.started_at = datetime.utcnow()
+        self.duration = None
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name='profiler', daemon=True)
+
+    def start(self):
+        active[self.thread_id] = self
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        active.pop(self.thread_id, None)
+        self.duration = time.perf_counter() - self.started
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+
+    def components(self):
+        """
+            this method will count the share of the samples that ran in each component, a sample counts for
+            every component that is on its stack
+            :return: dict of component -> share of the samples (0..1)
+        """
+        total = sum(self.stacks.values())
+        counts = Counter()
+        for stack, count in self.stacks.items():
+            found = {component_of(frame) for frame in stack}
+            for component in found - {None}:
+                counts[component] += count
+        return {component: round(counts[component] / total, 3) if total else 0.0
+                for _, component in COMPONENTS}
+
+
+def component_of(frame):
+    package = frame.split('.', 1)[0].split(':', 1)[0]
+    for name, component in COMPONENTS:
+        if package == name:
+            return component
+    return None
+
+
+"""""
+OUTPUT
+"""""
+
+
+def collapsed_stacks(stacks):
+    """
+        this method will write the stacks in the collapsed format of flamegraph.pl and speedscope
+        :param: stacks Counter of tuple of frames -> samples
+        :return: string, one line per stack
+    """
+    return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+def flame_graph(stacks, title, width=1200, row_height=16):
+    """
+        this method will draw the stacks as a flame graph, the root at the bottom and the width of a frame
+        proportional to its samples
+        :param: stacks Counter of tuple of frames -> samples
+        :param: title title shown above the graph
+        :return: svg string
+    """
+    # tree of frame -> [samples, children]
+    root = [0, {}]
+    for stack, count in stacks.items():
+        root[0] += count
+        node = root
+        for frame in stack:
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+    depth = max((len(stack) for stack in stacks), default=0)
+    height = (depth + 3) * row_height
+    scale = (width - 20) / root[0] if root[0] else 0
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="Verdana" '
+             f'font-size="11">',
+             f'<text x="10" y="{row_height}" font-size="14">{escape(title)}</text>']
+
+    def draw(node, x, level):
+        for frame, (count, children) in sorted(node[1].items()):
+            frame_width = count * scale
+            if frame_width >= 0.5:
+                y = height - (level + 1) * row_height
+                label = frame if len(frame) * 7 < frame_width else frame[:max(0, int(frame_width / 7) - 2)] + '..'
+                parts.append(f'<g><title>{escape(frame)} ({count} samples, {count * 100 / root[0]:.1f}%)</title>'
+                             f'<rect x="{x:.1f}" y="{y}" width="{frame_width:.1f}" height="{row_height - 1}" '
+                             f'fill="{COLORS[component_of(frame)]}" rx="2"/>')
+                if frame_width > 21:
+                    parts.append(f'<text x="{x + 3:.1f}" y="{y + row_height - 4}">{escape(label)}</text>')
+                parts.append('</g>')
+                draw([count, children], x, level + 1)
+            x += frame_width
+
+    draw(root, 10, 0)
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def save_profile(profile, details):
+    """
+        this method will write the files of a profile and remove the oldest profiles over PROFILER_KEEP
+        :param: profile stopped Profile
+        :param: details dict of the request saved in profile.json
+        :return: id of the profile (name of its directory)
+    """
+    folder = profile_folder()
+    profile_id = f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}-{details['endpoint'] or 'none'}"
+    path = os.path.join(folder, profile_id)
+    os.makedirs(path)
+    details.update(duration_ms=round(profile.duration * 1000, 1), samples=sum(profile.stacks.values()),
+                   interval_ms=profile.interval * 1000, components=profile.components(),
+                   query_count=len(profile.queries),
+                   query_ms=round(sum(query['ms'] for query in profile.queries), 1), queries=profile.queries)
+    with open(os.path.join(path, 'stacks.txt'), 'w') as stacks:
+        stacks.write(collapsed_stacks(profile.stacks))
+    with open(os.path.join(path, 'flame.svg'), 'w') as svg:
+        svg.write(flame_graph(profile.stacks, f"{details['method']} {details['path']} "
+                                              f"{details['duration_ms']} ms, {details['query_count']} queries"))
+    with open(os.path.join(path, 'profile.json'), 'w') as meta:
+        json.dump(details, meta, indent=1)
+    for old in sorted(os.listdir(folder))[:-current_app.config['PROFILER_KEEP']]:
+        shutil.rmtree(os.path.join(folder, old), ignore_errors=True)
+    return profile_id
+
+
+def profile_folder():
+    return current_app.config['PROFILER_DIR'] or os.path.join(current_app.instance_path, 'profiles')
+
+
+"""""
+REQUEST HOOKS
+"""""
+
+
+def is_admin():
+    return current_user.is_authenticated and current_user.email in current_app.config['PROFILER_ADMINS']
+
+
+def wants_profile():
+    """
+        this method will decide if the current request is profiled
+        :return: True for a request of an admin with the profiler header, of a user in PROFILE_USERS or to an
+                 endpoint in PROFILE_ROUTES
+    """
+    config = current_app.config
+    if request.endpoint in config['PROFILE_ROUTES']:
+        return True
+    if request.headers.get(config['PROFILER_HEADER']):
+        return is_admin()
+    return current_user.is_authenticated and (current_user.email in config['PROFILE_USERS'] or
+                                              current_user.id in config['PROFILE_USERS'])
+
+
+def start_request_profile():
+    if request.blueprint == 'profiler' or not wants_profile():
+        return
+    g.profile = Profile(threading.get_ident(), current_app.config['PROFILER_INTERVAL'])
+    g.profile.start()
+
+
+def finish_request_profile(response=None):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.stop()
+    details = {'method': request.method, 'path': request.full_path.rstrip('?'), 'endpoint': request.endpoint,
+               'user_id': current_user.id if current_user.is_authenticated else None,
+               'status': response.status_code if response is not None else 500,
+               'started_at': profile.started_at.isoformat()}
+    profile_id = save_profile(profile, details)
+    if response is not None:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def stop_failed_request_profile(error):
+    # after_request doesn't run when the view raised, the profile is saved with status 500
+    if 'profile' in g:
+        finish_request_profile()
+
+
+def record_query_start(conn, cursor, statement, parameters, context, executemany):
+    if threading.get_ident() in active:
+        conn.info.setdefault('profiler_started', []).append(time.perf_counter())
+
+
+def record_query_end(conn, cursor, statement, parameters, context, executemany):
+    profile = active.get(threading.get_ident())
+    started = conn.info.get('profiler_started')
+    if profile is None or not started:
+        return
+    profile.queries.append({'sql': statement[:MAX_QUERY_LENGTH], 'many': executemany,
+                            'ms': round((time.perf_counter() - started.pop()) * 1000, 3),
+                            'at_ms': round((time.perf_counter() - profile.started) * 1000, 1)})
+
+
+def init_profiler(app):
+    """
+        this method will hook the profiler into the requests of the app and add the admin views,
+        create_app() only calls it when PROFILER_ENABLED is set
+        :param: app flask app
+    """
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    app.teardown_request(stop_failed_request_profile)
+    if not event.contains(Engine, 'before_cursor_execute', record_query_start):
+        event.listen(Engine, 'before_cursor_execute', record_query_start)
+        event.listen(Engine, 'after_cursor_execute', record_query_end)
+    app.register_blueprint(profiler)
+
+
+"""""
+ADMIN VIEWS
+"""""
+
+profiler = Blueprint('profiler', __name__, url_prefix='/admin/profiles')
+
+
+@profiler.before_request
+@login_required
+def admins_only():
+    if not is_admin():
+        abort(404)
+
+
+@profiler.route('/')
+def profiles():
+    """
+        this view will list the saved profiles, newest first
+    """
+    folder = profile_folder()
+    listed = []
+    for profile_id in sorted(os.listdir(folder) if os.path.isdir(folder) else (), reverse=True):
+        try:
+            with open(os.path.join(folder, profile_id, 'profile.json')) as meta:
+                details = json.load(meta)
+        except (OSError, ValueError):
+            continue  # still being written or removed
+        details.pop('queries')
+        listed.append(dict(details, id=profile_id))
+    return jsonify(profiles=listed)
+
+
+@profiler.route('/<profile_id>/<any("stacks.txt", "flame.svg", "profile.json"):name>')
+def profile_file(profile_id, name):
+    """
+        this view will send one file of a profile
+    """
+    folder = profile_folder()
+    if not os.path.isdir(folder) or profile_id not in os.listdir(folder):
+        abort(404)
+    return send_from_directory(os.path.join(folder, profile_id), name)
@@ -0,0 +1,159 @@
+################################################
+# purge.py in budget_aj_app
+################################################
+#
+#   Description:
+#       deleting a budget only marks it as deleted (Budget.deleted_at) so the request returns right away,
+#       the rows that belong to the budget are removed here in small batches on a background thread.
+#       the soft deleted budgets are the queue, so `flask purge-budgets` can finish any purge that was
+#       interrupted by a restart.
+#
+################################################
+import threading
+import queue
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from budget_aj_app import db
+from budget_aj_app.sharding import all_shards, current_shard, shard_engine, using_shard
+
+# every table that holds budget data registers a purge step, steps run in registration order
+# and each one is called as step(connection, budget_id, batch_size) -> number of deleted rows
+_purge_steps = []
+
+
+def purge_step(step):
+    """
+        this decorator will register a function that deletes one batch of budget data
+        :param: step function taking (connection, budget_id, batch_size) and returning the deleted rows count
+        :return: the same function
+    """
+    _purge_steps.append(step)
+    return step
+
+
+def batch_delete(table, column='budget_id'):
+    """
+        this method will build a purge step that deletes one batch of rows from table by primary key
+        :param: table name of the table to delete from
+        :param: column name of the column holding the budget id
+        :return: purge step function
+    """
+    statement = text(f"DELETE FROM {table} WHERE id IN "
+                     f"(SELECT id FROM {table} WHERE {column} = :budget_id LIMIT :batch_size)")
+
+    def step(connection, budget_id, batch_size):
+        return connection.execute(statement, budget_id=budget_id, batch_size=batch_size).rowcount
+    step.__name__ = f"purge_{table}"
+    return step
+
+
+purge_step(batch_delete('expenses'))
+purge_step(batch_delete('income'))
+purge_step(batch_delete('category_spend'))
+purge_step(batch_delete('category_limit'))
+purge_step(batch_delete('expense_archive'))
+purge_step(batch_delete('ledger_entry'))
+purge_step(batch_delete('ledger_snapshot'))
+
+
+def purge_budget(budget_id, batch_size=None):
+    """
+        this method will delete all the data of a soft deleted budget, one short transaction per batch so
+        the database is never locked for long, and finally the budget row itself
+        :param: budget_id integer id of the soft deleted budget
+        :param: batch_size optional number of rows deleted per transaction
+        :return: total number of deleted rows
+    """
+    batch_size = batch_size or current_app.config['PURGE_BATCH_SIZE']
+    engine = shard_engine()
+    total = 0
+    for step in _purge_steps:
+        while True:
+            with engine.begin() as connection:
+                deleted = step(connection, budget_id, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                break
+    # the foreign keys cascade whatever is left, e.g. rows added while the purge was running
+    with engine.begin() as connection:
+        total += connection.execute(text("DELETE FROM budget WHERE id = :budget_id AND deleted_at IS NOT NULL"),
+                                    budget_id=budget_id).rowcount
+    return total
+
+
+def pending_purges():
+    """
+        this method will return the ids of the soft deleted budgets of the current shard that are still
+        waiting for the purge
+        :return: list of budget ids
+    """
+    from budget_aj_app.models import Budget
+    return [row[0] for row in db.session.query(Budget.id).filter(Budget.deleted_at.isnot(None)).all()]
+
+
+class PurgeWorker(object):
+    """
+        one background thread per process that runs the queued budget purges
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def schedule(self, app, shard, budget_id):
+        """
+            this method will queue the purge of a soft deleted budget and start the worker thread if needed
+            :param: app flask application the purge runs in
+            :param: shard name of the shard the budget lives in
+            :param: budget_id integer id of the soft deleted budget
+        """
+        self.jobs.put((app, shard, budget_id))
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='budget-purge', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                app, shard, budget_id = self.jobs.get(timeout=5)
+            except queue.Empty:
+                return
+            try:
+                with app.app_context(), using_shard(shard):
+                    purge_budget(budget_id)
+            except Exception:
+                # the budget stays soft deleted, `flask purge-budgets` will pick it up again
+                app.logger.exception(f"purge of budget {budget_id} failed")
+            finally:
+                self.jobs.task_done()
+
+
+worker = PurgeWorker()
+
+
+def schedule_purge(budget_id):
+    """
+        this method will purge a soft deleted budget on the background thread, or right away when
+        PURGE_IN_BACKGROUND is turned off
+        :param: budget_id integer id of the soft deleted budget
+    """
+    if current_app.config['PURGE_IN_BACKGROUND']:
+        worker.schedule(current_app._get_current_object(), current_shard(), budget_id)
+    else:
+        purge_budget(budget_id)
+
+
+@click.command('purge-budgets')
+@click.option('--batch-size', type=int, default=None, help='rows deleted per transaction')
+@with_appcontext
+def purge_budgets_command(batch_size):
+    """Remove the data of every soft deleted budget."""
+    for shard in all_shards():
+        with using_shard(shard):
+            for budget_id in pending_purges():
+                deleted = purge_budget(budget_id, batch_size)
+                click.echo(f"budget {budget_id}: {deleted} rows deleted")
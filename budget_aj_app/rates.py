@@ -0,0 +1,458 @@
+################################################
+# rates.py in budget_aj_app
+################################################
+#
+#   Description:
+#       exchange rates of the amounts that are not in the currency of their budget. the rates come from a
+#       csv file of date,currency,rate lines (rate = units of the currency for one RATES_BASE) loaded by
+#       `flask rates load`, nothing is fetched from the network. every loaded file is a new version of the
+#       rate table and the queries use the active one, the last loaded or the one picked with
+#       `flask rates activate`, so an older file can be put back and the totals it gave come back with it.
+#
+#       a version keeps one rate per currency and month, the mean of the rates of the month in the file,
+#       carried forward over the months without rates up to RATES_CARRY_MONTHS after the month of the load.
+#       the month is the rate date of every conversion: the category_spend rollup is kept per month and
+#       currency, and the aggregation queries join it (and the incomes, in the months they count in) to the
+#       rates of the amount currency and of the budget currency on (currency, year, month), so the sums are
+#       converted by the database. an amount in the budget currency isn't joined to any rate, a budget in one
+#       currency reads the same totals as before.
+#
+#       the rate tables are in the main database and copied to every shard, where the joins run. single
+#       amounts (the currency checks of the forms, /api/rates) are converted in python with the rates of a
+#       per process cache keyed by (currency, date).
+#
+################################################
+import csv
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+from datetime import date
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, and_, or_, case, cast, func, BigInteger
+from budget_aj_app import db
+from budget_aj_app.models import Budget, CategorySpend, CategoryLimit, LedgerEntry, LedgerSnapshot, RateVersion, \
+    ExchangeRate
+from budget_aj_app.money import DEFAULT_CURRENCY
+from budget_aj_app.sharding import all_shards, directory_engine, router, using_shard
+
+MICROS = 10 ** 6
+CURRENCY_CODE = re.compile(r'^[A-Z]{3}$')
+INSERT_CHUNK = 1000
+
+version_table = RateVersion.__table__
+rate_table = ExchangeRate.__table__
+
+
+class RateError(ValueError):
+    """
+        raised when a rate file can't be loaded or a rate version doesn't exist
+    """
+
+
+"""""
+RATE FILES
+"""""
+
+
+def month_index(day):
+    return day.year * 12 + day.month - 1
+
+
+def index_date(index):
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def to_micros(rate):
+    return int((rate * MICROS).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def read_rates_file(path):
+    """
+        this method will read a rate file, a csv file with a date,currency,rate header
+        :param: path file path
+        :return: tuple of (list of (date, currency, Decimal rate), sha256 of the file)
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    rows = []
+    for line, row in enumerate(csv.DictReader(io.StringIO(data.decode('utf-8-sig'))), start=2):
+        try:
+            day = date.fromisoformat(row['date'].strip())
+            currency = row['currency'].strip().upper()
+            rate = Decimal(row['rate'].strip())
+        except (KeyError, AttributeError, ValueError, InvalidOperation):
+            raise RateError(f"line {line} of {path}: expected a date,currency,rate line like 2026-01-31,EUR,0.92")
+        if not CURRENCY_CODE.match(currency) or not rate > 0 or not to_micros(rate):
+            raise RateError(f"line {line} of {path}: {currency!r} {rate} isn't a currency code with a positive rate")
+        rows.append((day, currency, rate))
+    if not rows:
+        raise RateError(f"{path} has no rates")
+    return rows, hashlib.sha256(data).hexdigest()
+
+
+def month_rates(rows, base, until):
+    """
+        this method will turn the rates of a file into one rate per currency and month, the mean of the rates of
+        the month carried forward over the months without rates. the base currency is 1 in every month
+        :param: rows list of (date, currency, Decimal rate)
+        :param: base base currency of the file
+        :param: until month index (year * 12 + month - 1) of the last month to fill
+        :return: dict of (currency, month index) -> rate micros
+    """
+    months = {}
+    for day, currency, rate in rows:
+        if currency != base:
+            months.setdefault((currency, month_index(day)), []).append(rate)
+    first = min(month_index(day) for day, _, _ in rows)
+    last = max(max(month_index(day) for day, _, _ in rows), until)
+    rates = {(base, index): MICROS for index in range(first, last + 1)}
+    for currency in sorted({currency for currency, _ in months}):
+        current = None
+        for index in range(first, last + 1):
+            values = months.get((currency, index))
+            if values:
+                current = to_micros(sum(values) / len(values))
+            if current is not None:
+                rates[(currency, index)] = current
+    return rates
+
+
+"""""
+VERSIONS
+"""""
+
+
+def load_rates(path, today=None):
+    """
+        this method will load a rate file as a new version (a file that is loaded again reuses its version),
+        make it the active version and copy it to the shards
+        :param: path file path
+        :param: today optional date the rates are carried forward from
+        :return: RateVersion
+    """
+    rows, checksum = read_rates_file(path)
+    base = current_app.config['RATES_BASE']
+    until = month_index(today or date.today()) + current_app.config['RATES_CARRY_MONTHS']
+    rates = month_rates(rows, base, until)
+    first, last = min(index for _, index in rates), max(index for _, index in rates)
+    version = RateVersion.query.filter_by(checksum=checksum, base_currency=base, valid_to=index_date(last)).first()
+    if version is None:
+        version = RateVersion(checksum=checksum, source=os.path.basename(path), base_currency=base,
+                              valid_from=index_date(first), valid_to=index_date(last), rate_count=len(rates))
+        db.session.add(version)
+        db.session.flush()
+        values = [{'version_id': version.id, 'currency': currency, 'year': index // 12, 'month': index % 12 + 1,
+                   'rate_micros': micros} for (currency, index), micros in sorted(rates.items())]
+        for start in range(0, len(values), INSERT_CHUNK):
+            db.session.execute(rate_table.insert(), values[start:start + INSERT_CHUNK])
+        db.session.commit()
+    activate_version(version.id)
+    return version
+
+
+def activate_version(version_id):
+    """
+        this method will make a rate version the one the queries use, in the main database and in every shard.
+        the ledger snapshots of the budgets with expenses in other currencies hold totals converted with the
+        old rates, they are written again, and the spend of the limited categories is compared with the limits
+        again
+        :param: version_id integer rate version id
+    """
+    # rollup.py and ledger.py convert with this module
+    from budget_aj_app.rollup import check_limits
+    from budget_aj_app.ledger import SPEND_TABLE, take_snapshots
+    if db.session.query(RateVersion.id).filter_by(id=version_id).scalar() is None:
+        raise RateError(f"there is no rate version {version_id}")
+    db.session.execute(version_table.update().values(active=version_table.c.id == version_id))
+    db.session.commit()
+    for shard in all_shards():
+        if shard is not None:
+            copy_rates(shard)
+        with using_shard(shard):
+            snapshots, entries, budgets = LedgerSnapshot.__table__, LedgerEntry.__table__, Budget.__table__
+            # the snapshots of a budget whose expenses are all in its own currency don't change
+            converted = select([entries.c.budget_id]).distinct(). \
+                select_from(entries.join(budgets, budgets.c.id == entries.c.budget_id)). \
+                where(and_(entries.c.table_name == SPEND_TABLE, entries.c.currency != budgets.c.currency))
+            rewrite = [budget_id for budget_id, in db.session.execute(
+                select([snapshots.c.budget_id]).distinct().where(snapshots.c.budget_id.in_(converted)))]
+            db.session.execute(snapshots.delete().where(snapshots.c.budget_id.in_(converted)))
+            limited = select([CategoryLimit.__table__.c.budget_id]).distinct()
+            check_limits(db.session(), CategorySpend.__table__.c.budget_id.in_(limited))
+            db.session.commit()
+            for budget_id in rewrite:
+                take_snapshots(budget_id)
+    rate_cache().clear()
+
+
+def copy_rates(shard):
+    """
+        this method will copy the rate versions that a shard doesn't have yet, and the active version, from
+        the main database to the shard
+        :param: shard shard name
+    """
+    with directory_engine().connect() as source, router().engine(shard).begin() as target:
+        copied = {row.id for row in target.execute(select([version_table.c.id]))}
+        for version in source.execute(version_table.select().order_by(version_table.c.id)).fetchall():
+            if version.id not in copied:
+                target.execute(version_table.insert().values(dict(version)))
+                rates = [dict(row) for row in source.execute(rate_table.select().
+                                                             where(rate_table.c.version_id == version.id))]
+                for start in range(0, len(rates), INSERT_CHUNK):
+                    target.execute(rate_table.insert(), rates[start:start + INSERT_CHUNK])
+        active = source.execute(select([version_table.c.id]).where(version_table.c.active.is_(True))).scalar()
+        target.execute(version_table.update().values(active=version_table.c.id == active))
+
+
+"""""
+CONVERSION IN THE QUERIES
+"""""
+
+
+def active_version():
+    """
+        :return: scalar select of the id of the active rate version
+    """
+    return select([version_table.c.id]).where(version_table.c.active.is_(True)).limit(1).as_scalar()
+
+
+class Conversion(object):
+    """
+        the joins of a query to the rates of the amount currency and of the budget currency in the month the
+        amounts count in, and the amounts converted with them. an amount in the budget currency needs no rate,
+        an amount without a rate converts to NULL and is left out of the sums (`flask rates check` lists them)
+    """
+
+    def __init__(self, currency, target, year=None, month=None):
+        """
+            :param: currency currency column of the amounts
+            :param: target currency column of the budget
+            :param: year column of the year the amounts count in, None joins every month of the amount
+                    currency (the months are then self.year and self.month)
+            :param: month column of the month the amounts count in
+        """
+        version = active_version()
+        self.currency = currency
+        self.target = target
+        self.source_rate = rate_table.alias()
+        self.target_rate = rate_table.alias()
+        self.every_month = year is None
+        source = and_(self.source_rate.c.version_id == version, self.source_rate.c.currency == currency)
+        if self.every_month:
+            year, month = self.source_rate.c.year, self.source_rate.c.month
+        else:
+            source = and_(source, self.source_rate.c.year == year, self.source_rate.c.month == month)
+        self.year = year
+        self.month = month
+        self.joins = [(self.source_rate, source),
+                      (self.target_rate, and_(self.target_rate.c.version_id == version,
+                                              self.target_rate.c.currency == target,
+                                              self.target_rate.c.year == year, self.target_rate.c.month == month))]
+
+    def join(self, from_clause):
+        """
+            this method will join the rates to the from clause of a query
+            :param: from_clause table or join with the amounts and the budget currency
+            :return: join
+        """
+        (source, source_condition), (target, target_condition) = self.joins
+        if self.every_month:
+            from_clause = from_clause.join(source, source_condition)
+        else:
+            from_clause = from_clause.outerjoin(source, source_condition)
+        return from_clause.outerjoin(target, target_condition)
+
+    def join_query(self, query):
+        """
+            this method will join the rates to an orm query, like join()
+            :param: query orm query with the amounts and the budget currency
+            :return: query
+        """
+        (source, source_condition), (target, target_condition) = self.joins
+        if self.every_month:
+            query = query.join(source, source_condition)
+        else:
+            query = query.outerjoin(source, source_condition)
+        return query.outerjoin(target, target_condition)
+
+    def cents(self, cents):
+        """
+            this method will convert an amount of the query to the budget currency, rounded to the cent
+            :param: cents column or expression of integer cents in the amount currency
+            :return: expression of integer cents in the budget currency
+        """
+        return case([(self.currency == self.target, cents)],
+                    else_=cast(func.round(cents * 1.0 * self.target_rate.c.rate_micros /
+                                          self.source_rate.c.rate_micros), BigInteger))
+
+
+def missing_rates():
+    """
+        this method will find the months of the spend rollup of the current shard that have no rate to the
+        budget currency in the active version, their spend is left out of the totals
+        :return: list of (budget id, currency, year, month)
+    """
+    spend, budget = CategorySpend.__table__, Budget.__table__
+    conversion = Conversion(spend.c.currency, budget.c.currency, spend.c.year, spend.c.month)
+    query = select([spend.c.budget_id, spend.c.currency, spend.c.year, spend.c.month]). \
+        select_from(conversion.join(spend.join(budget, budget.c.id == spend.c.budget_id))). \
+        where(and_(spend.c.currency != budget.c.currency, budget.c.deleted_at.is_(None),
+                   or_(conversion.source_rate.c.rate_micros.is_(None),
+                       conversion.target_rate.c.rate_micros.is_(None)))). \
+        distinct().order_by(spend.c.budget_id, spend.c.currency, spend.c.year, spend.c.month)
+    return db.session.execute(query).fetchall()
+
+
+"""""
+RATE CACHE
+"""""
+
+
+class RateCache(object):
+    """
+        the rates of the active version that this process looked up, keyed by (currency, first day of the
+        month). the active version is read again every RATES_CACHE_SECONDS, a new one empties the cache
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.version = None
+        self.checked_at = None
+        self.rates = {}
+        self.currencies = (DEFAULT_CURRENCY,)
+        self.lock = threading.Lock()
+
+    def active_version(self):
+        """
+            :return: id of the active rate version, None before the first rate file is loaded
+        """
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.max_age:
+            return self.version
+        version = db.session.query(RateVersion.id).filter(RateVersion.active.is_(True)).scalar()
+        with self.lock:
+            if version != self.version or self.checked_at is None:
+                currencies = [] if version is None else \
+                    [code for code, in db.session.query(ExchangeRate.currency).filter_by(version_id=version).distinct()]
+                self.currencies = tuple(sorted(set(currencies) | {DEFAULT_CURRENCY}))
+                self.rates = {}
+                self.version = version
+            self.checked_at = now
+        return version
+
+    def rate(self, currency, day):
+        """
+            this method will look up the rate of a currency in the month of a day
+            :param: currency currency code
+            :param: day date
+            :return: rate micros (units of the currency for one base currency unit), None without a rate
+        """
+        version = self.active_version()
+        key = (currency, day.replace(day=1))
+        with self.lock:
+            if key in self.rates:
+                return self.rates[key]
+        micros = None
+        if version is not None:
+            micros = db.session.query(ExchangeRate.rate_micros). \
+                filter_by(version_id=version, currency=currency, year=day.year, month=day.month).scalar()
+        with self.lock:
+            if version == self.version:
+                self.rates[key] = micros
+        return micros
+
+    def known_currencies(self):
+        """
+            :return: tuple of the currency codes of the active version, the default currency without one
+        """
+        self.active_version()
+        return self.currencies
+
+    def clear(self):
+        with self.lock:
+            self.checked_at = None
+
+
+def init_rates(app):
+    """
+        this method will create the rate cache of the app
+        :param: app flask application
+    """
+    app.extensions['rates'] = RateCache(app.config['RATES_CACHE_SECONDS'])
+
+
+def rate_cache():
+    return current_app.extensions['rates']
+
+
+def convert(cents, currency, target, day):
+    """
+        this method will convert one amount with the rates of the month of a day, rounded half away from zero
+        like the queries
+        :param: cents integer cents in the currency
+        :param: currency currency code of the amount
+        :param: target currency code to convert to
+        :param: day date of the amount
+        :return: integer cents in the target currency, None when a rate is missing
+    """
+    if currency == target:
+        return cents
+    source_rate, target_rate = rate_cache().rate(currency, day), rate_cache().rate(target, day)
+    if not source_rate or not target_rate:
+        return None
+    return int((Decimal(cents * target_rate) / source_rate).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+"""""
+COMMAND LINE
+"""""
+
+rates_command = AppGroup('rates', help='Manage the exchange rates.')
+
+
+@rates_command.command('load')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def load_rates_command(path):
+    """Load a date,currency,rate csv file as the active rate version."""
+    try:
+        version = load_rates(path)
+    except RateError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"version {version.id}: {version.rate_count} rates from {version.valid_from:%Y-%m} "
+               f"to {version.valid_to:%Y-%m} in {version.base_currency}, active")
+    check_rates_command.callback()
+
+
+@rates_command.command('activate')
+@click.argument('version_id', type=int)
+def activate_rates_command(version_id):
+    """Make an already loaded rate version the active one."""
+    try:
+        activate_version(version_id)
+    except RateError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"version {version_id} is active")
+
+
+@rates_command.command('status')
+def status_rates_command():
+    """List the loaded rate versions."""
+    for version in RateVersion.query.order_by(RateVersion.id):
+        click.echo(f"{'*' if version.active else ' '} {version.id}: {version.source}, {version.rate_count} rates "
+                   f"{version.valid_from:%Y-%m} to {version.valid_to:%Y-%m}, loaded {version.loaded_at:%Y-%m-%d %H:%M}")
+
+
+@rates_command.command('check')
+def check_rates_command():
+    """List the months of spend that the active rates can't convert."""
+    for shard in all_shards():
+        with using_shard(shard):
+            for budget_id, currency, year, month in missing_rates():
+                click.echo(f"{shard or 'default'}: budget {budget_id} has {currency} spend in {year}-{month:02d} "
+                           f"without a rate, it is left out of the totals")
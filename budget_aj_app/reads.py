@@ -0,0 +1,239 @@
+################################################
+# reads.py in budget_aj_app
+################################################
+#
+#   Description:
+#       the read only requests that both serving modes answer: the dashboard summary, the expense list, the
+#       id lookup of the edit page and the csv export. the queries are sqlalchemy core selects and the rows
+#       are turned into the responses by the functions below, the flask views run the selects on the session
+#       and the asgi app (asgi.py) on its async connections, so the two modes send the same answers.
+#
+################################################
+from datetime import date, timedelta
+from sqlalchemy import select, func, and_, or_
+from budget_aj_app.models import Budget, UserSelect, Income, Expenses, CategorySpend, ExpenseArchive
+from budget_aj_app.money import from_cents, DEFAULT_CURRENCY
+from budget_aj_app.rates import Conversion
+from budget_aj_app.series import series_queries, monthly_series
+
+budget_table = Budget.__table__
+select_table = UserSelect.__table__
+income_table = Income.__table__
+expenses_table = Expenses.__table__
+spend_table = CategorySpend.__table__
+archive_table = ExpenseArchive.__table__
+
+
+"""""
+BUDGETS
+"""""
+
+
+def selected_budget_query(user_id):
+    """
+        this method will build the query of the budget the user works on
+        :param: user_id integer user id
+        :return: select of selected_budget_id, no row when the user never selected one
+    """
+    return select([select_table.c.selected_budget_id]).where(select_table.c.user_id == user_id)
+
+
+def owned_budget_query(user_id, budget_id):
+    """
+        this method will build the query that checks that a budget belongs to the user and isn't deleted
+        :return: select of the budget id, no row when the user can't read the budget
+    """
+    return select([budget_table.c.id]).where(and_(budget_table.c.id == budget_id, budget_table.c.user_id == user_id,
+                                                  budget_table.c.deleted_at.is_(None)))
+
+
+"""""
+DASHBOARD SUMMARY
+"""""
+
+
+def summary_queries(budget_id, today=None):
+    """
+        this method will build the queries of the dashboard summary of a budget
+        :param: budget_id integer budget id
+        :param: today optional date of the current month
+        :return: dict of name -> select, the rows go to dashboard_summary()
+    """
+    today = today or date.today()
+    queries = series_queries(budget_id)
+    conversion = Conversion(spend_table.c.currency, budget_table.c.currency, spend_table.c.year, spend_table.c.month)
+    queries['categories'] = select([spend_table.c.category, func.sum(conversion.cents(spend_table.c.spent_cents))]). \
+        select_from(conversion.join(spend_table.join(budget_table, budget_table.c.id == spend_table.c.budget_id))). \
+        where(and_(spend_table.c.budget_id == budget_id, spend_table.c.year == today.year,
+                   spend_table.c.month == today.month, spend_table.c.spent_cents != 0)). \
+        group_by(spend_table.c.category)
+    queries['budget'] = select([budget_table.c.currency]).where(budget_table.c.id == budget_id)
+    return queries
+
+
+def dashboard_summary(budget_id, rows, today=None):
+    """
+        this method will build the dashboard summary from the rows of the summary queries
+        :param: budget_id integer budget id
+        :param: rows dict of name -> list of rows of summary_queries()
+        :param: today optional date of the current month
+        :return: dict with the month spend by category and the monthly income and spend series (series.py),
+                 in cents of the budget currency
+    """
+    from budget_aj_app.users.views import category_choice
+    today = today or date.today()
+    spent = dict((category, cents) for category, cents in rows['categories'])
+    series = monthly_series(rows['spend'], rows['incomes'], rows['foreign_incomes'])
+    return {
+        'budget_id': budget_id,
+        'currency': rows['budget'][0][0] if rows['budget'] else DEFAULT_CURRENCY,
+        'month': f"{today.year}-{today.month:02d}",
+        'categories': [{'category': key, 'label': label, 'spent_cents': spent[key]}
+                       for key, label in category_choice() if spent.get(key)],
+        'months': [totals.label for totals in series],
+        'income_cents': [totals.income_cents for totals in series],
+        'expenses_cents': [totals.spent_cents for totals in series],
+    }
+
+
+"""""
+EXPENSES
+"""""
+
+
+def expense_list_query(budget_id, category=None, expense_type=None, date_from=None, date_to=None, limit=100,
+                       offset=0):
+    """
+        this method will build the query of one page of the expenses of a budget
+        :param: budget_id integer budget id
+        :param: category optional category key
+        :param: expense_type optional expense type
+        :param: date_from optional first transaction date (included)
+        :param: date_to optional last transaction date (included)
+        :param: limit rows of the page, one more is read to know if there are more
+        :param: offset rows to skip
+        :return: select of the expense columns, ordered by transaction date
+    """
+    query = report_query(budget_id, category, expense_type)
+    if date_from is not None:
+        query = query.where(expenses_table.c.transaction_date >= date_from)
+    if date_to is not None:
+        query = query.where(expenses_table.c.transaction_date < date_to + timedelta(days=1))
+    return query.limit(limit + 1).offset(offset)
+
+
+def report_query(budget_id, category=None, expense_type=None):
+    """
+        this method will build the query of the expenses of a budget that the expense report and the csv
+        export show
+        :return: select of the expense columns, ordered by transaction date
+    """
+    query = select([expenses_table]).where(expenses_table.c.budget_id == budget_id)
+    if category:
+        query = query.where(expenses_table.c.category == category)
+    if expense_type:
+        query = query.where(expenses_table.c.expense_type == expense_type)
+    return query.order_by(expenses_table.c.transaction_date, expenses_table.c.id)
+
+
+def archive_query(budget_id):
+    """
+        this method will build the query of the archive blobs of a budget, they go to archive.filter_archived()
+        :return: select of the blob data
+    """
+    return select([archive_table.c.data]).where(archive_table.c.budget_id == budget_id). \
+        order_by(archive_table.c.year, archive_table.c.month)
+
+
+def expense_json(expense):
+    """
+        this method will return an expense as sent by the json endpoints, the amount in integer cents
+        :param: expense Expenses object, expense row or ArchivedExpense
+        :return: dict
+    """
+    return {'id': expense.id, 'category': expense.category, 'description': expense.expense_description,
+            'amount_cents': expense.expense_amount_cents, 'currency': expense.currency,
+            'expense_type': expense.expense_type, 'transaction_date': expense.transaction_date.isoformat(),
+            'due_date': expense.due_date.isoformat() if expense.due_date else None}
+
+
+EXPORT_HEADER = ['id', 'category', 'description', 'amount', 'currency', 'type', 'transaction_date', 'due_date',
+                 'archived']
+
+
+def export_row(expense):
+    """
+        this method will return the csv row of an expense
+        :param: expense Expenses object, expense row or ArchivedExpense
+        :return: list of values in EXPORT_HEADER order
+    """
+    from budget_aj_app.users.views import category_choice
+    return [expense.id, category_choice(expense.category), expense.expense_description,
+            from_cents(expense.expense_amount_cents), expense.currency, expense.expense_type,
+            expense.transaction_date.strftime('%Y-%m-%d'),
+            expense.due_date.strftime('%Y-%m-%d') if expense.due_date else '',
+            'yes' if getattr(expense, 'archived', False) else '']
+
+
+"""""
+LOOKUP
+"""""
+
+
+def prefix_range(column, prefix):
+    """
+        this method will build a case insensitive prefix match that the (budget_id, lower(description)) index
+        can answer with a range scan, LIKE 'abc%' can't use it on every database
+        :param: column description column
+        :param: prefix typed text
+        :return: sqlalchemy condition
+    """
+    prefix = prefix.lower()
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return and_(func.lower(column) >= prefix, func.lower(column) < upper)
+
+
+# kind -> (table, description column, columns of the details)
+LOOKUPS = {
+    'expenses': (expenses_table, expenses_table.c.expense_description,
+                 (expenses_table.c.category, expenses_table.c.expense_amount_cents,
+                  expenses_table.c.transaction_date)),
+    'incomes': (income_table, income_table.c.income_description, (income_table.c.income_amount_month_cents,)),
+}
+
+
+def lookup_query(kind, budget_id, text, limit, offset):
+    """
+        this method will build the query of the id pickers of the edit page, a number matches the id, text
+        matches the start of the description (case insensitive)
+        :param: kind 'expenses' or 'incomes'
+        :param: budget_id integer budget id
+        :param: text typed id or start of the description
+        :param: limit rows of the page, one more is read to know if there are more
+        :param: offset rows to skip
+        :return: select of id, description and the details columns
+    """
+    table, description, details = LOOKUPS[kind]
+    query = select([table.c.id, description] + list(details)).where(table.c.budget_id == budget_id)
+    if text.isdigit():
+        query = query.where(or_(table.c.id == int(text), prefix_range(description, text)))
+    elif text:
+        query = query.where(prefix_range(description, text))
+    return query.order_by(func.lower(description), table.c.id).offset(offset).limit(limit + 1)
+
+
+def lookup_result(kind, row):
+    """
+        this method will return one match of the id pickers
+        :param: kind 'expenses' or 'incomes'
+        :param: row row of lookup_query()
+        :return: dict of id, description and details
+    """
+    if kind == 'expenses':
+        from budget_aj_app.users.views import category_choice
+        row_id, description, category, amount_cents, transaction_date = row
+        details = f"{category_choice(category)}, {from_cents(amount_cents)}, {transaction_date.strftime('%m/%d/%Y')}"
+    else:
+        row_id, description, amount_cents = row
+        details = f"{from_cents(amount_cents)} a month"
+    return {'id': row_id, 'description': description, 'details': details}
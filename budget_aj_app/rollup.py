@@ -0,0 +1,347 @@
+################################################
+# rollup.py in budget_aj_app
+################################################
+#
+#   Description:
+#       spend to date per (budget, month, category, currency) in the category_spend table. the totals are
+#       not recomputed with SUMs, every write of an expense adds its difference in the same transaction
+#       (session flush, batch edits). the same write compares the new spend of the category, converted to the
+#       budget currency (rates.py), with the category limit and marks the rows that went over it, so budget
+#       vs actual reads one row per category and currency.
+#
+################################################
+from collections import defaultdict
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, select, and_, or_, func, extract, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import get_history
+from budget_aj_app import db
+from budget_aj_app.models import Budget, Expenses, CategoryLimit, CategorySpend, ExpenseArchive
+from budget_aj_app.archive import unpack_expenses
+from budget_aj_app.rates import Conversion
+from budget_aj_app.sharding import ShardedSession, all_shards, using_shard
+from budget_aj_app.signals import rows_changed, category_over_limit
+
+spend_table = CategorySpend.__table__
+limit_table = CategoryLimit.__table__
+budget_table = Budget.__table__
+SPEND_KEY = ('budget_id', 'year', 'month', 'category', 'currency')  # the unique constraint of category_spend
+
+
+def old_value(obj, attribute):
+    """
+        this method will return the value an attribute had before the changes that are being flushed
+        :param: obj mapped object
+        :param: attribute name of the attribute
+        :return: the value as it was loaded from the database
+    """
+    history = get_history(obj, attribute)
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(obj, attribute)
+
+
+def spend_key(budget_id, transaction_date, category, currency):
+    return budget_id, transaction_date.year, transaction_date.month, category, currency
+
+
+def key_condition(key):
+    return and_(category_condition(key[:4]), spend_table.c.currency == key[4])
+
+
+def category_condition(key):
+    # the rows of one category in one month, in every currency
+    budget_id, year, month, category = key
+    return and_(spend_table.c.budget_id == budget_id, spend_table.c.year == year,
+                spend_table.c.month == month, spend_table.c.category == category)
+
+
+def apply_deltas(session, deltas):
+    """
+        this method will add the spend differences to the rollup and check the limits of the changed rows
+        :param: session database session in the transaction of the write
+        :param: deltas dict of (budget_id, year, month, category, currency) -> [cents, number of expenses]
+    """
+    changed = [(key, delta) for key, delta in deltas.items() if delta != [0, 0]]
+    if not changed:
+        return
+    bind = session.get_bind(clause=spend_table.insert())  # the shard, the sqlite upsert is a text() without tables
+    upsert = upsert_statement(bind.dialect)
+    for key, (cents, count) in changed:
+        if upsert is not None:
+            session.execute(upsert, dict(zip(SPEND_KEY, key), spent_cents=cents, expense_count=count), bind=bind)
+        else:
+            add_spend(session, key, cents, count)
+    check_limits(session, or_(*[category_condition(key[:4]) for key in {key[:4] for key, _ in changed}]))
+
+
+def upsert_statement(dialect):
+    """
+        this method will build the insert of a rollup row that adds to the row instead when it is already there,
+        the first expenses of a category month written at the same time by two transactions would otherwise
+        both miss the row with their UPDATE and both insert it
+        :param: dialect sqlalchemy dialect of the shard
+        :return: statement with the SPEND_KEY, spent_cents and expense_count parameters, None when the database
+                 has no INSERT ... ON CONFLICT
+    """
+    if dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(spend_table)
+        return statement.on_conflict_do_update(index_elements=list(SPEND_KEY), set_=dict(
+            spent_cents=spend_table.c.spent_cents + statement.excluded.spent_cents,
+            expense_count=spend_table.c.expense_count + statement.excluded.expense_count))
+    if dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info >= (3, 24):
+        # sqlalchemy 1.3 has no sqlite on_conflict_do_update()
+        columns = ', '.join(SPEND_KEY)
+        return text(f"INSERT INTO category_spend ({columns}, spent_cents, expense_count) "
+                    f"VALUES ({', '.join(':' + name for name in SPEND_KEY)}, :spent_cents, :expense_count) "
+                    f"ON CONFLICT ({columns}) DO UPDATE SET spent_cents = spent_cents + excluded.spent_cents, "
+                    f"expense_count = expense_count + excluded.expense_count")
+    return None
+
+
+def add_spend(session, key, cents, count):
+    """
+        this method will add to a rollup row with an UPDATE, or insert it in a savepoint and add to the row of
+        the other transaction when that one inserted it first
+        :param: session database session in the transaction of the write
+        :param: key (budget_id, year, month, category, currency)
+        :param: cents spend difference
+        :param: count expense count difference
+    """
+    add = spend_table.update().where(key_condition(key)).values(
+        spent_cents=spend_table.c.spent_cents + cents, expense_count=spend_table.c.expense_count + count)
+    if session.execute(add).rowcount:
+        return
+    try:
+        with session.begin_nested():
+            session.execute(spend_table.insert().values(dict(zip(SPEND_KEY, key)), spent_cents=cents,
+                                                        expense_count=count))
+    except IntegrityError:
+        session.execute(add)
+
+
+def check_limits(session, condition):
+    """
+        this method will compare the spend of the categories of the matching rollup rows, all currencies
+        converted to the budget currency, with their limit, mark the rows of the categories that are over it
+        (and unmark the ones back under) and send category_over_limit for the categories that just went over
+        :param: session database session
+        :param: condition where clause on category_spend that matches all the currencies of a category month
+    """
+    key = [spend_table.c.budget_id, spend_table.c.year, spend_table.c.month, spend_table.c.category]
+    conversion = Conversion(spend_table.c.currency, budget_table.c.currency, spend_table.c.year, spend_table.c.month)
+    rows = session.execute(
+        select(key + [func.sum(conversion.cents(spend_table.c.spent_cents)).label('spent_cents'),
+                      func.min(spend_table.c.over_limit_since).label('over_limit_since'),
+                      func.count(spend_table.c.over_limit_since).label('marked'), func.count().label('currencies'),
+                      limit_table.c.limit_cents]).
+        select_from(conversion.join(
+            spend_table.join(budget_table, budget_table.c.id == spend_table.c.budget_id).
+            outerjoin(limit_table, and_(limit_table.c.budget_id == spend_table.c.budget_id,
+                                        limit_table.c.category == spend_table.c.category)))).
+        where(condition).group_by(*key + [limit_table.c.limit_cents])).fetchall()
+    now = datetime.utcnow()
+    for row in rows:
+        rows_of_category = category_condition((row.budget_id, row.year, row.month, row.category))
+        spent_cents = row.spent_cents or 0
+        over = row.limit_cents is not None and spent_cents > row.limit_cents
+        if over and row.marked < row.currencies:
+            session.execute(spend_table.update().
+                            where(and_(rows_of_category, spend_table.c.over_limit_since.is_(None))).
+                            values(over_limit_since=row.over_limit_since or now))
+            if row.over_limit_since is None:
+                category_over_limit.send(current_app._get_current_object(), session=session,
+                                         budget_id=row.budget_id, year=row.year, month=row.month,
+                                         category=row.category, spent_cents=spent_cents,
+                                         limit_cents=row.limit_cents)
+        elif not over and row.marked:
+            session.execute(spend_table.update().where(rows_of_category).values(over_limit_since=None))
+
+
+def currency_changed(session):
+    """
+        this method will find the budgets of a flush whose currency was changed
+        :param: session database session being flushed
+        :return: list of budget ids
+    """
+    return [obj.id for obj in session.dirty if isinstance(obj, Budget) and get_history(obj, 'currency').deleted]
+
+
+def add_delta(deltas, key, cents, count):
+    delta = deltas[key]
+    delta[0] += cents
+    delta[1] += count
+
+
+def old_spend_key(obj):
+    return spend_key(old_value(obj, 'budget_id'), old_value(obj, 'transaction_date'), old_value(obj, 'category'),
+                     old_value(obj, 'currency'))
+
+
+@event.listens_for(ShardedSession, 'after_flush')
+def roll_up_flushed_expenses(session, flush_context):
+    deltas = defaultdict(lambda: [0, 0])
+    for obj in session.new:
+        if isinstance(obj, Expenses):
+            add_delta(deltas, spend_key(obj.budget_id, obj.transaction_date, obj.category, obj.currency),
+                      obj.expense_amount_cents, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Expenses):
+            add_delta(deltas, old_spend_key(obj), -old_value(obj, 'expense_amount_cents'), -1)
+    for obj in session.dirty:
+        if isinstance(obj, Expenses) and session.is_modified(obj, include_collections=False):
+            add_delta(deltas, old_spend_key(obj), -old_value(obj, 'expense_amount_cents'), -1)
+            add_delta(deltas, spend_key(obj.budget_id, obj.transaction_date, obj.category, obj.currency),
+                      obj.expense_amount_cents, 1)
+    apply_deltas(session, deltas)
+    # the limits are in the budget currency, the spend of a budget in a new currency is compared again
+    for budget_id in currency_changed(session):
+        check_limits(session, spend_table.c.budget_id == budget_id)
+
+
+@rows_changed.connect
+def roll_up_batch(sender, session, table_name, rows, values, deleted, **extra):
+    if table_name != Expenses.__tablename__:
+        return
+    deltas = defaultdict(lambda: [0, 0])
+    for row in rows:
+        add_delta(deltas, spend_key(row['budget_id'], row['transaction_date'], row['category'], row['currency']),
+                  -row['expense_amount_cents'], -1)
+        if not deleted:
+            add_delta(deltas, spend_key(row['budget_id'], row['transaction_date'],
+                                        values.get('category', row['category']),
+                                        values.get('currency', row['currency'])),
+                      values.get('expense_amount_cents', row['expense_amount_cents']), 1)
+    apply_deltas(session, deltas)
+
+
+"""""
+LIMITS
+"""""
+
+
+def set_category_limit(budget_id, category, limit):
+    """
+        this method will set the monthly limit of a category, or remove it, and re-check every month of
+        the category against it
+        :param: budget_id integer budget id
+        :param: category category key
+        :param: limit Decimal monthly limit, None or 0 removes the limit
+    """
+    limit_row = CategoryLimit.query.filter_by(budget_id=budget_id, category=category).first()
+    if not limit:
+        if limit_row is not None:
+            db.session.delete(limit_row)
+    elif limit_row is None:
+        db.session.add(CategoryLimit(budget_id, category, limit))
+    else:
+        limit_row.limit = limit
+    db.session.flush()
+    check_limits(db.session(), and_(spend_table.c.budget_id == budget_id, spend_table.c.category == category))
+    db.session.commit()
+
+
+class BudgetVsActual(object):
+    """
+        limit and spend of one category in one month
+    """
+    __slots__ = ('category', 'limit_cents', 'spent_cents', 'over_limit_since')
+
+    def __init__(self, category, limit_cents=None, spent_cents=0, over_limit_since=None):
+        self.category = category
+        self.limit_cents = limit_cents
+        self.spent_cents = spent_cents
+        self.over_limit_since = over_limit_since
+
+    @property
+    def left_cents(self):
+        return None if self.limit_cents is None else self.limit_cents - self.spent_cents
+
+    @property
+    def used_percent(self):
+        if not self.limit_cents:
+            return None
+        return round(self.spent_cents * 100 / self.limit_cents, 1)
+
+
+def budget_vs_actual(budget_id, year, month):
+    """
+        this method will return the limit and the spend of every category of a budget in one month, read
+        from the limits and the rollup (one row per category and currency, no expense is read)
+        :param: budget_id integer budget id
+        :param: year integer year
+        :param: month integer month
+        :return: dict of category key -> BudgetVsActual, the spend in the budget currency
+    """
+    rows = {}
+    for limit in CategoryLimit.query.filter_by(budget_id=budget_id):
+        rows[limit.category] = BudgetVsActual(limit.category, limit.limit_cents)
+    conversion = Conversion(spend_table.c.currency, budget_table.c.currency, spend_table.c.year, spend_table.c.month)
+    for category, spent_cents, over_limit_since in db.session.execute(
+            select([spend_table.c.category, func.sum(conversion.cents(spend_table.c.spent_cents)),
+                    func.min(spend_table.c.over_limit_since)]).
+            select_from(conversion.join(spend_table.join(budget_table, budget_table.c.id == spend_table.c.budget_id))).
+            where(and_(spend_table.c.budget_id == budget_id, spend_table.c.year == year,
+                       spend_table.c.month == month)).
+            group_by(spend_table.c.category)):
+        row = rows.setdefault(category, BudgetVsActual(category))
+        row.spent_cents = spent_cents or 0
+        row.over_limit_since = over_limit_since
+    return rows
+
+
+"""""
+REBUILD
+"""""
+
+
+def rebuild_rollup(budget_id=None):
+    """
+        this method will recompute the rollup from the expenses and the archived months, for repairs
+        :param: budget_id optional budget id, all the budgets of the current shard when None
+        :return: number of rollup rows written
+    """
+    session = db.session()
+    expenses = Expenses.__table__
+    condition = spend_table.c.budget_id == budget_id if budget_id is not None else None
+    session.execute(spend_table.delete().where(condition) if condition is not None else spend_table.delete())
+    year = extract('year', expenses.c.transaction_date)
+    month = extract('month', expenses.c.transaction_date)
+    totals = select([expenses.c.budget_id, year, month, expenses.c.category, expenses.c.currency,
+                     func.sum(expenses.c.expense_amount_cents), func.count()])
+    if budget_id is not None:
+        totals = totals.where(expenses.c.budget_id == budget_id)
+    totals = totals.group_by(expenses.c.budget_id, year, month, expenses.c.category, expenses.c.currency)
+    session.execute(spend_table.insert().from_select(
+        ['budget_id', 'year', 'month', 'category', 'currency', 'spent_cents', 'expense_count'], totals))
+    # the archived months are not in the expenses table anymore, their spend is added from the blobs
+    archives = ExpenseArchive.query if budget_id is None else ExpenseArchive.query.filter_by(budget_id=budget_id)
+    for archive in archives:
+        deltas = defaultdict(lambda: [0, 0])
+        for row in unpack_expenses(archive.data):
+            add_delta(deltas, spend_key(archive.budget_id, row['transaction_date'], row['category'],
+                                        row['currency']), row['expense_amount_cents'], 1)
+        apply_deltas(session, deltas)
+    condition = condition if condition is not None else spend_table.c.id.isnot(None)
+    check_limits(session, condition)
+    written = session.execute(select([func.count()]).select_from(spend_table).where(condition)).scalar()
+    session.commit()
+    return written
+
+
+rollup_command = AppGroup('rollup', help='Maintain the category spend rollup.')
+
+
+@rollup_command.command('rebuild')
+@click.option('--budget-id', type=int, default=None, help='only rebuild one budget')
+def rebuild_rollup_command(budget_id):
+    """Recompute the category spend rollup from the expenses."""
+    for shard in all_shards():
+        with using_shard(shard):
+            click.echo(f"{shard or 'default'}: {rebuild_rollup(budget_id)} rollup rows")
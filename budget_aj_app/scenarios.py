@@ -0,0 +1,210 @@
+################################################
+# scenarios.py in budget_aj_app
+################################################
+#
+#   Description:
+#       what-if scenarios for a budget. the current incomes, taxes and spend of the budget are the baseline,
+#       a grid of changes (raise %, tax change, new monthly bill, change of the discretionary spend) is turned
+#       into one row per variant and every variant is evaluated at once with numpy array operations.
+#
+#       the discretionary spend (one time expenses) is simulated with monte carlo draws per category from
+#       its monthly mean and standard deviation. the same draws are shared by all the variants, a variant only
+#       scales them, so the percentiles of the savings come from one sort of the simulations instead of one
+#       simulation per variant. the amounts of the baseline are in the budget currency (rates.py).
+#
+#       numpy is slow to import, this module is imported by the /scenarios view on first use.
+#
+################################################
+from datetime import date
+import numpy as np
+from flask import current_app
+from sqlalchemy import func, extract
+from budget_aj_app import db
+from budget_aj_app.models import Budget, Income, Expenses
+from budget_aj_app.rates import Conversion
+from budget_aj_app.series import income_in_month
+
+PERCENTILES = (10, 50, 90)
+
+
+class ScenarioError(ValueError):
+    """
+        raised when a scenario request is not valid, the message is shown to the user
+    """
+
+
+def parse_values(text, name):
+    """
+        this method will read a list of values like "0, 2.5, 5"
+        :param: text string of numbers separated by commas or spaces
+        :param: name name of the field for the error message
+        :return: sorted list of distinct floats
+    """
+    values = set()
+    for part in (text or '0').replace(',', ' ').split():
+        try:
+            value = float(part)
+        except ValueError:
+            raise ScenarioError(f"{part} is not a number ({name})")
+        if not np.isfinite(value):
+            raise ScenarioError(f"{part} is not a number ({name})")
+        values.add(value)
+    return sorted(values)
+
+
+class Baseline(object):
+    """
+        the monthly figures of a budget the scenarios start from, amounts in cents
+    """
+
+    def __init__(self, income_cents, tax_rates, categories, bill_cents, spend_mean_cents, spend_std_cents,
+                 history_months):
+        self.income_cents = np.asarray(income_cents, dtype=float)  # one per income
+        self.tax_rates = np.asarray(tax_rates, dtype=float)  # 0..1, one per income
+        self.categories = list(categories)
+        self.bill_cents = np.asarray(bill_cents, dtype=float)  # one per category
+        self.spend_mean_cents = np.asarray(spend_mean_cents, dtype=float)
+        self.spend_std_cents = np.asarray(spend_std_cents, dtype=float)
+        self.history_months = history_months
+
+
+def load_baseline(budget_id, history_months=12, today=None):
+    """
+        this method will read the baseline of a budget: the monthly incomes and taxes, the monthly bills and the
+        mean and spread of the one time spend per category over the last complete months
+        :param: budget_id integer budget id
+        :param: history_months number of complete months the spend is averaged over
+        :param: today optional date the history ends before
+        :return: Baseline
+    """
+    today = today or date.today()
+    # the incomes of the current month, an income that already ended isn't part of the baseline
+    conversion = Conversion(Income.currency, Budget.currency, today.year, today.month)
+    incomes = conversion.join_query(
+        db.session.query(conversion.cents(Income.income_amount_month_cents), Income.income_tax_bp).
+        join(Budget, Budget.id == Income.budget_id)). \
+        filter(Income.budget_id == budget_id, income_in_month(today.year, today.month)).all()
+    incomes = [(cents, bp) for cents, bp in incomes if cents is not None]  # no rate to the budget currency
+    last = today.year * 12 + today.month - 1  # months since year 0 of the current month, not part of the history
+    first = last - history_months
+    year = extract('year', Expenses.transaction_date)
+    month = extract('month', Expenses.transaction_date)
+    conversion = Conversion(Expenses.currency, Budget.currency, year, month)
+    rows = conversion.join_query(
+        db.session.query(year, month, Expenses.category, Expenses.expense_type,
+                         func.sum(conversion.cents(Expenses.expense_amount_cents))).
+        join(Budget, Budget.id == Expenses.budget_id)). \
+        filter(Expenses.budget_id == budget_id,
+               Expenses.transaction_date >= date(first // 12, first % 12 + 1, 1),
+               Expenses.transaction_date < date(last // 12, last % 12 + 1, 1)). \
+        group_by(year, month, Expenses.category, Expenses.expense_type).all()
+    categories = sorted({row[2] for row in rows})
+    index = {category: column for column, category in enumerate(categories)}
+    # one row per history month, the months without spend count as 0
+    bills = np.zeros((history_months, len(categories)))
+    spend = np.zeros((history_months, len(categories)))
+    for y, m, category, expense_type, cents in rows:
+        target = bills if expense_type == 'month_bill' else spend
+        target[int(y) * 12 + int(m) - 1 - first, index[category]] += cents or 0
+    return Baseline([cents for cents, _ in incomes], [bp / 10000 for _, bp in incomes], categories,
+                    bills.mean(axis=0), spend.mean(axis=0), spend.std(axis=0), history_months)
+
+
+class ScenarioResult(object):
+    """
+        the projection of every variant, amounts in cents. savings has the shape (percentiles, variants, months)
+    """
+
+    def __init__(self, grid, net_income, bills, expected_spend, savings, mean_savings, shortfall, months,
+                 simulations):
+        self.raise_pct, self.tax_change, self.new_bill, self.discretionary_change = grid
+        self.net_income = net_income
+        self.bills = bills
+        self.expected_spend = expected_spend
+        self.monthly_balance = net_income - bills - expected_spend
+        self.savings = savings
+        self.mean_savings = mean_savings
+        self.shortfall = shortfall  # probability that the savings are negative at the end
+        self.months = months
+        self.simulations = simulations
+
+    def __len__(self):
+        return len(self.net_income)
+
+    def ranked(self):
+        """
+            this method will order the variants by their median savings at the end, best first
+            :return: array of variant indexes
+        """
+        return np.argsort(-self.savings[PERCENTILES.index(50), :, -1], kind='stable')
+
+    def baseline_index(self):
+        """
+            this method will find the variant without any change
+            :return: variant index or None when the grid has no such variant
+        """
+        match = np.flatnonzero((self.raise_pct == 0) & (self.tax_change == 0) & (self.new_bill == 0) &
+                               (self.discretionary_change == 0))
+        return int(match[0]) if len(match) else None
+
+
+def scenario_grid(raise_pct, tax_change, new_bill, discretionary_change):
+    """
+        this method will build every combination of the changes
+        :param: raise_pct list of income raises in %
+        :param: tax_change list of tax changes in percentage points
+        :param: new_bill list of new monthly bills (amount)
+        :param: discretionary_change list of changes of the one time spend in %
+        :return: tuple of 4 arrays, one value per variant
+    """
+    count = len(raise_pct) * len(tax_change) * len(new_bill) * len(discretionary_change)
+    if count > current_app.config['SCENARIO_MAX_VARIANTS']:
+        raise ScenarioError(f"{count} variants, at most {current_app.config['SCENARIO_MAX_VARIANTS']} "
+                            f"can be compared at once")
+    axes = np.meshgrid(np.asarray(raise_pct, dtype=float), np.asarray(tax_change, dtype=float),
+                       np.asarray(new_bill, dtype=float), np.asarray(discretionary_change, dtype=float),
+                       indexing='ij')
+    return tuple(axis.ravel() for axis in axes)
+
+
+def run_scenarios(baseline, grid, months=12, simulations=2000, seed=None):
+    """
+        this method will project the monthly balance and the savings of every variant
+        :param: baseline Baseline of the budget
+        :param: grid tuple of arrays returned by scenario_grid()
+        :param: months number of months to project
+        :param: simulations number of monte carlo runs of the discretionary spend
+        :param: seed optional seed of the random draws
+        :return: ScenarioResult
+    """
+    if not 1 <= simulations <= current_app.config['SCENARIO_MAX_SIMULATIONS']:
+        raise ScenarioError(f"the simulations must be between 1 and {current_app.config['SCENARIO_MAX_SIMULATIONS']}")
+    raise_pct, tax_change, new_bill, discretionary_change = grid
+    # (variants, incomes)
+    rates = np.clip(baseline.tax_rates[None, :] + tax_change[:, None] / 100, 0, 1)
+    gross = baseline.income_cents[None, :] * (1 + raise_pct[:, None] / 100)
+    net_income = (gross * (1 - rates)).sum(axis=1)
+    bills = baseline.bill_cents.sum() + new_bill * 100
+    scale = np.maximum(1 + discretionary_change / 100, 0)
+
+    # (simulations, months) of the discretionary spend, a month can't have negative spend
+    rng = np.random.default_rng(seed)
+    draws = rng.normal(baseline.spend_mean_cents, baseline.spend_std_cents,
+                       size=(simulations, months, len(baseline.categories)))
+    np.maximum(draws, 0, out=draws)
+    spend = draws.sum(axis=2)
+    spent_to_date = spend.cumsum(axis=1)
+
+    fixed = (net_income - bills)[:, None] * np.arange(1, months + 1)[None, :]  # (variants, months)
+    # a variant scales the shared draws by a factor >= 0, so its low savings come from the high spend
+    spend_percentiles = np.percentile(spent_to_date, [100 - p for p in PERCENTILES], axis=0)  # (percentiles, months)
+    savings = fixed[None, :, :] - scale[None, :, None] * spend_percentiles[:, None, :]
+    mean_savings = fixed - scale[:, None] * spent_to_date.mean(axis=0)[None, :]
+
+    # the savings at the end are negative when the simulated spend is over fixed / scale
+    final = np.sort(spent_to_date[:, -1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        threshold = np.where(scale > 0, fixed[:, -1] / scale, np.where(fixed[:, -1] < 0, -np.inf, np.inf))
+    shortfall = (simulations - np.searchsorted(final, threshold, side='right')) / simulations
+    return ScenarioResult(grid, net_income, bills, scale * spend.mean(), savings, mean_savings, shortfall, months,
+                          simulations)
@@ -0,0 +1,182 @@
+################################################
+# series.py in budget_aj_app
+################################################
+#
+#   Description:
+#       the monthly income and spend series of a budget. an income counts in the months between its
+#       effective_from and effective_to dates (both optional, an open end counts forever), the spend of a
+#       month comes from the category_spend rollup, so the archived months are still in it.
+#
+#       the series reads small queries, the spend rollup grouped by month and the incomes of the budget,
+#       and spreads every income over its months with a difference array: one +amount at its first month
+#       and one -amount after its last month, then one running sum. the cost is O(incomes + months) whatever
+#       the number of expenses or the length of the history.
+#
+#       the amounts are in the budget currency, the queries convert the rest with the rates of every month
+#       (rates.py). an income in another currency has another amount in every month, its months come from a
+#       third query that joins it to the rates and groups it by month.
+#
+################################################
+from datetime import date
+from sqlalchemy import select, func, and_, or_, extract
+from budget_aj_app.models import Budget, Income, CategorySpend
+from budget_aj_app.rates import Conversion
+
+budget_table = Budget.__table__
+income_table = Income.__table__
+spend_table = CategorySpend.__table__
+
+
+class MonthTotals(object):
+    """
+        one month of the series, amounts in cents
+    """
+    __slots__ = ('year', 'month', 'income_cents', 'net_income_cents', 'spent_cents')
+
+    def __init__(self, year, month, income_cents, net_income_cents, spent_cents):
+        self.year = year
+        self.month = month
+        self.income_cents = income_cents
+        self.net_income_cents = net_income_cents
+        self.spent_cents = spent_cents
+
+    @property
+    def label(self):
+        return f"{self.year}-{self.month}"
+
+
+"""""
+QUERIES
+"""""
+
+
+def month_start(year, month):
+    return date(year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+
+
+def income_in_month(year, month, table=income_table):
+    """
+        this method will build the condition of the incomes that count in a month
+        :param: year integer year
+        :param: month integer month
+        :param: table income table, or an alias of it
+        :return: sqlalchemy condition
+    """
+    return and_(or_(table.c.effective_from.is_(None), table.c.effective_from < month_start(year, month + 1)),
+                or_(table.c.effective_to.is_(None), table.c.effective_to >= month_start(year, month)))
+
+
+def month_number(column):
+    # months since year 0 of a date column
+    return extract('year', column) * 12 + extract('month', column) - 1
+
+
+def series_queries(budget_id):
+    """
+        this method will build the queries of the monthly series of a budget
+        :param: budget_id integer budget id
+        :return: dict of name -> select, the rows go to monthly_series()
+    """
+    spend_budget = spend_table.join(budget_table, budget_table.c.id == spend_table.c.budget_id)
+    spend = Conversion(spend_table.c.currency, budget_table.c.currency, spend_table.c.year, spend_table.c.month)
+    # the incomes in another currency count in every month of their rates between their dates, the months
+    # outside of the spend months are not in the series
+    income_budget = income_table.join(budget_table, budget_table.c.id == income_table.c.budget_id)
+    income = Conversion(income_table.c.currency, budget_table.c.currency)
+    month = income.year * 12 + income.month - 1
+    spend_month = spend_table.c.year * 12 + spend_table.c.month - 1
+    first_spend = select([func.min(spend_month)]).where(spend_table.c.budget_id == budget_id).as_scalar()
+    last_spend = select([func.max(spend_month)]).where(spend_table.c.budget_id == budget_id).as_scalar()
+    gross = income.cents(income_table.c.income_amount_month_cents)
+    return {
+        'spend': select([spend_table.c.year, spend_table.c.month,
+                         func.sum(spend.cents(spend_table.c.spent_cents))]).
+        select_from(spend.join(spend_budget)).
+        where(spend_table.c.budget_id == budget_id).
+        group_by(spend_table.c.year, spend_table.c.month).
+        having(func.sum(spend_table.c.expense_count) > 0).
+        order_by(spend_table.c.year, spend_table.c.month),
+        'incomes': select([income_table.c.income_amount_month_cents, income_table.c.income_tax_bp,
+                           income_table.c.effective_from, income_table.c.effective_to]).
+        select_from(income_budget).
+        where(and_(income_table.c.budget_id == budget_id, income_table.c.currency == budget_table.c.currency)),
+        'foreign_incomes': select([income.year, income.month, func.sum(gross),
+                                   func.sum(gross * (10000 - income_table.c.income_tax_bp))]).
+        select_from(income.join(income_budget)).
+        where(and_(income_table.c.budget_id == budget_id, income_table.c.currency != budget_table.c.currency,
+                   or_(income_table.c.effective_from.is_(None), month >= month_number(income_table.c.effective_from)),
+                   or_(income_table.c.effective_to.is_(None), month <= month_number(income_table.c.effective_to)),
+                   month >= first_spend, month <= last_spend)).
+        group_by(income.year, income.month),
+    }
+
+
+"""""
+SERIES
+"""""
+
+
+def month_index(day):
+    return day.year * 12 + day.month - 1
+
+
+def monthly_series(spend_rows, income_rows, foreign_income_rows=()):
+    """
+        this method will build the series of every month from the first to the last month with spend, the
+        months in between without spend are in it with 0
+        :param: spend_rows list of (year, month, spent cents) ordered by month
+        :param: income_rows list of (amount cents, tax basis points, effective_from, effective_to)
+        :param: foreign_income_rows optional list of (year, month, amount cents, amount cents * (10000 - tax
+                basis points)) of the converted incomes in other currencies
+        :return: list of MonthTotals, empty when the budget has no spend
+    """
+    if not spend_rows:
+        return []
+    first = int(spend_rows[0][0]) * 12 + int(spend_rows[0][1]) - 1
+    count = int(spend_rows[-1][0]) * 12 + int(spend_rows[-1][1]) - first
+    spent = [0] * count
+    for year, month, cents in spend_rows:
+        spent[int(year) * 12 + int(month) - 1 - first] = int(cents or 0)
+
+    # gross and after tax (cents * (10000 - basis points), divided once per month) changes per month
+    gross = [0] * (count + 1)
+    net = [0] * (count + 1)
+    for cents, tax_bp, effective_from, effective_to in income_rows:
+        start = max(month_index(effective_from) - first, 0) if effective_from else 0
+        end = min(month_index(effective_to) - first + 1, count) if effective_to else count
+        if start >= end:
+            continue
+        gross[start] += cents
+        gross[end] -= cents
+        net[start] += cents * (10000 - tax_bp)
+        net[end] -= cents * (10000 - tax_bp)
+    for year, month, cents, net_cents in foreign_income_rows:
+        offset = int(year) * 12 + int(month) - 1 - first
+        if 0 <= offset < count and cents is not None:
+            gross[offset] += int(cents)
+            gross[offset + 1] -= int(cents)
+            net[offset] += int(net_cents)
+            net[offset + 1] -= int(net_cents)
+
+    series = []
+    income_cents = net_income = 0
+    for offset in range(count):
+        income_cents += gross[offset]
+        net_income += net[offset]
+        index = first + offset
+        series.append(MonthTotals(index // 12, index % 12 + 1, income_cents, (net_income + 5000) // 10000,
+                                  spent[offset]))
+    return series
+
+
+def budget_series(connection, budget_id):
+    """
+        this method will read the monthly series of a budget
+        :param: connection session or connection of the budget shard
+        :param: budget_id integer budget id
+        :return: list of MonthTotals
+    """
+    queries = series_queries(budget_id)
+    return monthly_series(connection.execute(queries['spend']).fetchall(),
+                          connection.execute(queries['incomes']).fetchall(),
+                          connection.execute(queries['foreign_incomes']).fetchall())
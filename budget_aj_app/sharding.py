@@ -0,0 +1,655 @@
+################################################
+# sharding.py in budget_aj_app
+################################################
+#
+#   Description:
+#       every budget belongs to one user, so the budget data (budgets, incomes, expenses, ...) of each
+#       user lives in one of the databases listed in the SHARDS config. the main database
+#       (SQLALCHEMY_DATABASE_URI) is the directory, it keeps the users and the user -> shard map.
+#
+#       the session picks the shard from the logged in user, so the views don't need to know about it.
+#       jobs that run outside of a request pick the shard with `using_shard(name)`.
+#
+#       with an empty SHARDS config everything stays in the main database, like before.
+#
+#       shard uris are normal sqlalchemy uris, a postgres schema can be selected by adding it after
+#       a '#', e.g. 'postgresql://db-host/budget#shard_1'.
+#
+################################################
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import click
+from flask import current_app, g, has_request_context
+from flask.cli import AppGroup
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, func, orm, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.util import find_tables
+from budget_aj_app.signals import user_data_moved
+
+
+class ShardError(RuntimeError):
+    """
+        raised when the shard of a query can't be found or the user data is being moved
+    """
+
+
+class ShardedTable(object):
+    """
+        how the rows of one sharded table are found and moved
+        owner: 'user_id' for rows owned by the user, 'budget_id' for rows owned by one of the user budgets
+        references: column name -> sharded table name, ids that must be remapped when the rows are moved
+        row_references: column name -> (name of the column that holds the table name, the tables it may name),
+                        ids of rows of several tables that must be remapped when the rows are moved
+        remap: function(connection, row, id_maps) for ids kept inside a column (e.g. a blob), it rewrites the row
+               for the target shard, adds the new ids to id_maps and returns a dict of table name -> ids of the rows
+               it inserted in the target only to reserve the ids, they are deleted once every table is copied
+    """
+
+    def __init__(self, table, owner, references=None, row_references=None, remap=None):
+        self.table = table
+        self.owner = owner
+        self.references = references or {}
+        self.row_references = row_references or {}
+        self.remap = remap
+
+    def referenced_tables(self):
+        return set(self.references.values()) | {name for _, names in self.row_references.values() for name in names}
+
+
+# table name -> ShardedTable, in the order the rows must be copied (parents before children)
+sharded_tables = OrderedDict()
+
+
+def sharded(owner, references=None, row_references=None, remap=None):
+    """
+        this decorator will mark a model as per user data that lives in the user's shard
+        :param: owner name of the column that ties a row to its user, 'user_id' or 'budget_id'
+        :param: references optional dict of column name -> sharded table name for ids to remap on moves
+        :param: row_references optional dict of column name -> (column with the table name, table names) for
+                ids of rows of several tables to remap on moves
+        :param: remap optional function that remaps the ids kept inside a column on moves (ShardedTable)
+        :return: class decorator
+    """
+    def decorate(model):
+        sharded_tables[model.__table__.name] = ShardedTable(model.__table__, owner, references, row_references,
+                                                            remap)
+        return model
+    return decorate
+
+
+# table name -> table of the reference data that the main database and every shard keep a copy of, so the
+# queries of the sharded tables can join it
+replicated_tables = OrderedDict()
+
+
+def replicated(model):
+    """
+        this decorator will mark a model as reference data that is copied to every shard, the session reads
+        and writes it in the main database unless it is joined to a sharded table
+        :return: the model
+    """
+    replicated_tables[model.__table__.name] = model.__table__
+    return model
+
+
+_local = threading.local()
+
+
+@contextmanager
+def using_shard(name):
+    """
+        this method will pin all the sharded queries of this thread to one shard, for jobs that run
+        outside of a user request
+        :param: name shard name, None keeps the default routing
+    """
+    previous = getattr(_local, 'shard', None)
+    _local.shard = name
+    try:
+        yield
+    finally:
+        _local.shard = previous
+
+
+class ShardRouter(object):
+    """
+        keeps the shard engines of one app and the user -> shard lookups
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.uris = OrderedDict(sorted(app.config.get('SHARDS', {}).items()))
+        self.engines = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.uris)
+
+    def engine(self, name):
+        """
+            this method will return the engine of one shard, engines are created on first use
+            :param: name shard name from the SHARDS config
+            :return: sqlalchemy engine
+        """
+        engine = self.engines.get(name)
+        if engine is None:
+            if name not in self.uris:
+                raise ShardError(f"unknown shard {name!r}")
+            with self.lock:
+                engine = self.engines.get(name)
+                if engine is None:
+                    engine = shard_uri_engine(self.uris[name])
+                    self.engines[name] = engine
+        return engine
+
+
+def shard_uri_engine(uri):
+    """
+        this method will create the engine of a shard uri, a '#schema' suffix selects the schema
+        :param: uri database uri from the SHARDS config
+        :return: sqlalchemy engine
+    """
+    uri, _, schema = uri.partition('#')
+    engine = create_engine(uri)
+    if schema:
+        engine = engine.execution_options(schema_translate_map={None: schema})
+    return engine
+
+
+def router():
+    """
+        this method will return the shard router of the current app
+        :return: ShardRouter
+    """
+    return current_app.extensions['shards']
+
+
+def init_sharding(app):
+    """
+        this method will set up the shard router of an app
+        :param: app flask application
+    """
+    app.extensions['shards'] = ShardRouter(app)
+
+
+def directory_engine():
+    """
+        this method will return the engine of the main database that keeps the users and the shard map
+        :return: sqlalchemy engine
+    """
+    from budget_aj_app import db
+    return db.engine
+
+
+def shard_uris():
+    """
+        this method will return the database uri of every shard, for jobs that open their own connections
+        in other processes
+        :return: dict of shard name (None when sharding is off) -> uri
+    """
+    shards = router()
+    if shards.enabled:
+        return dict(shards.uris)
+    return {None: current_app.config['SQLALCHEMY_DATABASE_URI']}
+
+
+def all_shards():
+    """
+        this method will return the names of all the shards, [None] when sharding is off so jobs can
+        always loop over the shards
+        :return: list of shard names
+    """
+    shards = router()
+    return list(shards.uris) if shards.enabled else [None]
+
+
+def user_shard_row(user_id):
+    """
+        this method will return the user -> shard map row of a user (cached for the request), a new user
+        is assigned to the shard with the fewest users, a user with data in the main database is refused until
+        `flask shards migrate` copied it
+        :param: user_id integer user id
+        :return: user_shard row with shard and status
+    """
+    cache = g.setdefault('user_shards', {}) if has_request_context() else {}
+    if user_id not in cache:
+        from budget_aj_app.models import UserShard
+        table = UserShard.__table__
+        with directory_engine().connect() as connection:
+            row = connection.execute(table.select().where(table.c.user_id == user_id)).first()
+        if row is None and has_main_data(user_id):
+            # the data from before SHARDS was set would not be read anymore
+            raise ShardError(f"user {user_id} still has budget data in the main database, run `flask shards migrate`")
+        cache[user_id] = row if row is not None else assign_shard(user_id)
+    return cache[user_id]
+
+
+def shard_for_user(user_id):
+    """
+        this method will return the shard of a user
+        :param: user_id integer user id
+        :return: shard name, None when sharding is off
+    """
+    if not router().enabled:
+        return None
+    return user_shard_row(user_id).shard
+
+
+def assign_shard(user_id, shard=None):
+    """
+        this method will add a user to the user -> shard map and copy the user row to the shard
+        :param: user_id integer user id
+        :param: shard optional shard name, by default the shard with the fewest users
+        :return: the new user_shard row
+    """
+    from budget_aj_app.models import UserShard
+    table = UserShard.__table__
+    try:
+        with directory_engine().begin() as connection:
+            if shard is None:
+                counts = dict(connection.execute(select([table.c.shard, func.count()]).
+                                                 group_by(table.c.shard)).fetchall())
+                shard = min(router().uris, key=lambda name: (counts.get(name, 0), name))
+            connection.execute(table.insert().values(user_id=user_id, shard=shard, status='active',
+                                                     updated_at=datetime.utcnow()))
+    except IntegrityError:
+        pass  # another worker assigned the user first, use its choice
+    with directory_engine().connect() as connection:
+        row = connection.execute(table.select().where(table.c.user_id == user_id)).first()
+    copy_user_row(user_id, row.shard)
+    return row
+
+
+def copy_user_row(user_id, shard):
+    """
+        this method will copy the user row to a shard, the sharded tables keep their foreign keys to the user
+        table so each shard has the rows of its own users (without the password)
+        :param: user_id integer user id
+        :param: shard shard name
+    """
+    from budget_aj_app.models import User
+    table = User.__table__
+    with directory_engine().connect() as connection:
+        user = connection.execute(table.select().where(table.c.id == user_id)).first()
+    with router().engine(shard).begin() as connection:
+        if connection.execute(table.select().where(table.c.id == user_id)).first() is None:
+            connection.execute(table.insert().values(id=user.id, email=user.email, user_name=user.user_name,
+                                                     creation_date=user.creation_date))
+
+
+def current_shard():
+    """
+        this method will return the shard the sharded queries go to, the pinned shard of this thread
+        or the shard of the logged in user
+        :return: shard name, None when sharding is off
+    """
+    if not router().enabled:
+        return None
+    pinned = getattr(_local, 'shard', None)
+    if pinned is not None:
+        return pinned
+    if has_request_context():
+        from flask_login import current_user
+        if current_user.is_authenticated:
+            return shard_for_user(current_user.id)
+    raise ShardError("no shard selected, use using_shard() outside of user requests")
+
+
+def shard_engine():
+    """
+        this method will return the engine the sharded tables of the current shard live in
+        :return: sqlalchemy engine
+    """
+    if router().enabled:
+        return router().engine(current_shard())
+    return directory_engine()
+
+
+class ShardedSession(SignallingSession):
+    """
+        session that sends the sharded tables to the current shard and everything else to the main database
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        shards = self.app.extensions['shards']
+        if shards.enabled:
+            if mapper is not None:
+                tables = [mapper.persist_selectable]
+            elif clause is not None:
+                tables = find_tables(clause, include_crud=True)
+            else:
+                tables = []
+            if any(table.name in sharded_tables for table in tables):
+                return shards.engine(current_shard())
+        return super(ShardedSession, self).get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """
+        flask-sqlalchemy with the shard aware session
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardedSession, db=self, **options)
+
+
+"""""
+MOVING USERS BETWEEN SHARDS
+"""""
+
+
+def set_user_status(user_id, status, shard=None):
+    from budget_aj_app.models import UserShard
+    table = UserShard.__table__
+    values = dict(status=status, updated_at=datetime.utcnow())
+    if shard is not None:
+        values['shard'] = shard
+    with directory_engine().begin() as connection:
+        connection.execute(table.update().where(table.c.user_id == user_id).values(**values))
+
+
+def owned_by(sharded_table, user_id, budget_ids):
+    table = sharded_table.table
+    if sharded_table.owner == 'user_id':
+        return table.c.user_id == user_id
+    return table.c.budget_id.in_(budget_ids)
+
+
+def copy_user_data(user_id, source_engine, target, batch_size=1000):
+    """
+        this method will copy all the budget data of a user from a database to a shard. the rows get new ids in
+        the target shard (ids are only unique inside one shard) and the references between them are remapped.
+        :param: user_id integer user id
+        :param: source_engine engine of the database the rows are in, a shard or the main database
+        :param: target shard name to copy to
+        :param: batch_size rows inserted per statement
+        :return: tuple (dict of table name -> number of copied rows, dict of table name -> old ids,
+                 dict of table name -> new ids, list of the old budget ids)
+    """
+    budget = sharded_tables['budget'].table
+    referenced = {name for entry in sharded_tables.values() for name in entry.referenced_tables()}
+    copied = OrderedDict()
+    copy_user_row(user_id, target)
+    id_maps = {}
+    removed = {}
+    reserved = {}
+    with source_engine.connect() as reader, router().engine(target).begin() as writer:
+        budget_ids = [row.id for row in reader.execute(select([budget.c.id]).where(budget.c.user_id == user_id))]
+        for name, entry in sharded_tables.items():
+            if entry.owner == 'budget_id' and not budget_ids:
+                continue
+            copied[name] = 0
+            batch = []
+            for row in reader.execute(entry.table.select().where(owned_by(entry, user_id, budget_ids))):
+                data = dict(row)
+                old_id = data.pop('id')
+                removed.setdefault(name, []).append(old_id)
+                for column, parent in entry.references.items():
+                    if data.get(column) is not None:
+                        data[column] = id_maps.get(parent, {}).get(data[column], data[column])
+                for column, (table_column, _) in entry.row_references.items():
+                    if data.get(column) is not None:
+                        data[column] = id_maps.get(data[table_column], {}).get(data[column], data[column])
+                if entry.remap is not None:
+                    for table_name, ids in entry.remap(writer, data, id_maps).items():
+                        reserved.setdefault(table_name, []).extend(ids)
+                if name in referenced:
+                    # other tables point to these ids, insert one by one to learn the new ids
+                    new_id = writer.execute(entry.table.insert().values(**data)).inserted_primary_key[0]
+                    id_maps.setdefault(name, {})[old_id] = new_id
+                else:
+                    batch.append(data)
+                    if len(batch) >= batch_size:
+                        writer.execute(entry.table.insert(), batch)
+                        batch = []
+                copied[name] += 1
+            if batch:
+                writer.execute(entry.table.insert(), batch)
+        for name, ids in reserved.items():
+            table = sharded_tables[name].table
+            for start in range(0, len(ids), batch_size):
+                writer.execute(table.delete().where(table.c.id.in_(ids[start:start + batch_size])))
+        added = {name: [row[0] for row in writer.execute(select([entry.table.c.id]).where(
+            owned_by(entry, user_id, list(id_maps.get('budget', {}).values()))))]
+            for name, entry in sharded_tables.items()}
+    return copied, removed, added, budget_ids
+
+
+def delete_user_data(connection, user_id, budget_ids):
+    # children before parents
+    for name, entry in reversed(sharded_tables.items()):
+        if entry.owner == 'user_id' or budget_ids:
+            connection.execute(entry.table.delete().where(owned_by(entry, user_id, budget_ids)))
+
+
+def move_user(user_id, target, batch_size=1000):
+    """
+        this method will move all the budget data of a user to another shard (copy_user_data()). the user can
+        still read while the rows are copied but the writes are refused.
+        :param: user_id integer user id
+        :param: target shard name to move to
+        :param: batch_size rows inserted per statement
+        :return: dict of table name -> number of moved rows
+    """
+    source = shard_for_user(user_id)
+    if source == target:
+        return {}
+    source_engine = router().engine(source)
+    set_user_status(user_id, 'moving')
+    try:
+        moved, removed, added, budget_ids = copy_user_data(user_id, source_engine, target, batch_size)
+        # switch the map, after this the user reads and writes go to the target shard
+        set_user_status(user_id, 'active', target)
+    except Exception:
+        set_user_status(user_id, 'active')
+        raise
+    # the old copy is not used anymore
+    from budget_aj_app.models import User
+    with source_engine.begin() as connection:
+        delete_user_data(connection, user_id, budget_ids)
+        connection.execute(User.__table__.delete().where(User.__table__.c.id == user_id))
+    user_data_moved.send(current_app._get_current_object(), user_id=user_id, removed=removed, added=added)
+    return moved
+
+
+"""""
+MIGRATING THE MAIN DATABASE
+"""""
+
+
+def main_database_users():
+    """
+        this method will return the users that still have budget data in the main database, from before the
+        SHARDS config was set
+        :return: sorted list of user ids
+    """
+    users = set()
+    with directory_engine().connect() as connection:
+        for entry in sharded_tables.values():
+            if entry.owner == 'user_id':
+                users.update(row[0] for row in connection.execute(select([entry.table.c.user_id]).distinct()))
+    return sorted(users)
+
+
+def has_main_data(user_id):
+    with directory_engine().connect() as connection:
+        return any(connection.execute(select([entry.table.c.user_id]).where(entry.table.c.user_id == user_id).
+                                      limit(1)).first() is not None
+                   for entry in sharded_tables.values() if entry.owner == 'user_id')
+
+
+def migrate_user(user_id, batch_size=1000):
+    """
+        this method will copy the budget data that a user still has in the main database to the shard of the
+        user (assigned first when needed), with new ids like a move, and delete it from the main database
+        :param: user_id integer user id
+        :param: batch_size rows inserted per statement
+        :return: dict of table name -> number of copied rows
+    """
+    if not has_main_data(user_id):
+        return {}
+    from budget_aj_app.models import UserShard
+    table = UserShard.__table__
+    with directory_engine().connect() as connection:
+        row = connection.execute(table.select().where(table.c.user_id == user_id)).first()
+    target = (row or assign_shard(user_id)).shard
+    set_user_status(user_id, 'moving')
+    try:
+        copied, removed, added, budget_ids = copy_user_data(user_id, directory_engine(), target, batch_size)
+    finally:
+        set_user_status(user_id, 'active')
+    with directory_engine().begin() as connection:
+        delete_user_data(connection, user_id, budget_ids)
+    user_data_moved.send(current_app._get_current_object(), user_id=user_id, removed=removed, added=added)
+    return copied
+
+
+def user_weights(shard):
+    """
+        this method will return how much data every user has in a shard (number of incomes and expenses)
+        :param: shard shard name
+        :return: dict of user id -> number of rows
+    """
+    budget = sharded_tables['budget'].table
+    weights = {}
+    with router().engine(shard).connect() as connection:
+        for name in ('income', 'expenses'):
+            table = sharded_tables[name].table
+            query = select([budget.c.user_id, func.count(table.c.id)]). \
+                select_from(table.join(budget, budget.c.id == table.c.budget_id)).group_by(budget.c.user_id)
+            for user_id, count in connection.execute(query):
+                weights[user_id] = weights.get(user_id, 0) + count
+    return weights
+
+
+def plan_rebalance(tolerance=0.1):
+    """
+        this method will plan the user moves that bring every shard within tolerance of the average
+        number of rows, moving the user that fits the gap best from the fullest to the emptiest shard
+        :param: tolerance allowed difference from the average as a fraction
+        :return: list of (user_id, source shard, target shard)
+    """
+    from budget_aj_app.models import UserShard
+    mapped = {row.user_id: row.shard for row in UserShard.query.all()}
+    weights = {shard: {} for shard in router().uris}
+    for shard in weights:
+        for user_id, weight in user_weights(shard).items():
+            if mapped.get(user_id) == shard:
+                weights[shard][user_id] = weight
+    loads = {shard: sum(users.values()) for shard, users in weights.items()}
+    average = sum(loads.values()) / float(len(loads) or 1)
+    moves = []
+    while True:
+        fullest = max(loads, key=loads.get)
+        emptiest = min(loads, key=loads.get)
+        gap = loads[fullest] - loads[emptiest]
+        if fullest == emptiest or loads[fullest] <= average * (1 + tolerance):
+            break
+        # the best user to move leaves both shards closest to each other
+        candidates = [(abs(gap - 2 * weight), user_id, weight) for user_id, weight in weights[fullest].items()
+                      if 0 < weight < gap]
+        if not candidates:
+            break
+        _, user_id, weight = min(candidates)
+        moves.append((user_id, fullest, emptiest))
+        weights[emptiest][user_id] = weights[fullest].pop(user_id)
+        loads[fullest] -= weight
+        loads[emptiest] += weight
+    return moves
+
+
+def create_shard_tables(shard):
+    """
+        this method will create the sharded tables (and the user table and the replicated tables) in a new shard
+        :param: shard shard name
+    """
+    from budget_aj_app.models import User
+    tables = [User.__table__] + [entry.table for entry in sharded_tables.values()] + \
+        list(replicated_tables.values())
+    User.metadata.create_all(bind=router().engine(shard), tables=tables)
+
+
+def refuse_if_moving(user_id):
+    """
+        this method will refuse a write to the budget data of a user that is being moved, move_user() would
+        not copy it and deletes the rows of the old shard afterwards. every write of a request must check
+        it, the orm flushes below and the set based writes (batch.py) that never flush.
+        :param: user_id integer user id
+    """
+    if not router().enabled or getattr(_local, 'shard', None) is not None:
+        return
+    if user_shard_row(user_id).status == 'moving':
+        raise ShardError("your budget data is being moved to another database, try again shortly")
+
+
+@event.listens_for(ShardedSession, 'before_flush')
+def refuse_writes_while_moving(session, flush_context, instances):
+    if not session.app.extensions['shards'].enabled:
+        return
+    from flask_login import current_user
+    if has_request_context() and current_user.is_authenticated:
+        changed = list(session.new) + list(session.dirty) + list(session.deleted)
+        if any(obj.__table__.name in sharded_tables for obj in changed):
+            refuse_if_moving(current_user.id)
+
+
+"""""
+COMMAND LINE
+"""""
+
+shards_command = AppGroup('shards', help='Manage the per user database shards.')
+
+
+@shards_command.command('init')
+def init_shards_command():
+    """Create the tables in every shard."""
+    for shard in all_shards():
+        if shard is not None:
+            create_shard_tables(shard)
+            from budget_aj_app.rates import copy_rates
+            copy_rates(shard)
+            click.echo(f"{shard}: tables created")
+
+
+@shards_command.command('status')
+def status_shards_command():
+    """Show the number of users and rows in every shard."""
+    from budget_aj_app.models import UserShard
+    users = dict(UserShard.query.with_entities(UserShard.shard, func.count()).group_by(UserShard.shard).all())
+    for shard in all_shards():
+        if shard is not None:
+            click.echo(f"{shard}: {users.get(shard, 0)} users, {sum(user_weights(shard).values())} rows")
+
+
+@shards_command.command('migrate')
+@click.option('--user-id', type=int, help='only this user')
+def migrate_shards_command(user_id):
+    """Copy the budget data left in the main database to the shards of the users."""
+    if not router().enabled:
+        raise click.ClickException('SHARDS is not set, the budget data stays in the main database')
+    for user in [user_id] if user_id is not None else main_database_users():
+        copied = migrate_user(user)
+        click.echo(f"user {user}: {sum(copied.values())} rows copied to {shard_for_user(user)}")
+
+
+@shards_command.command('move')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+def move_shard_command(user_id, shard):
+    """Move the data of one user to another shard."""
+    for name, count in move_user(user_id, shard).items():
+        click.echo(f"{name}: {count} rows moved")
+
+
+@shards_command.command('rebalance')
+@click.option('--tolerance', type=float, default=0.1, help='allowed difference from the average shard size')
+@click.option('--dry-run', is_flag=True, help='only print the planned moves')
+def rebalance_shards_command(tolerance, dry_run):
+    """Move users until every shard holds about the same number of rows."""
+    for user_id, source, target in plan_rebalance(tolerance):
+        click.echo(f"user {user_id}: {source} -> {target}")
+        if not dry_run:
+            move_user(user_id, target)
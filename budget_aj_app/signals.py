@@ -0,0 +1,25 @@
+################################################
+# signals.py in budget_aj_app
+################################################
+#
+#   Description:
+#       signals for the budget data changes that don't go through the session flush (set based updates,
+#       moving users between shards), so the change log and the other write hooks can follow them
+#
+################################################
+from flask.signals import Namespace
+
+_signals = Namespace()
+
+# sent by sharding.move_user after the user data is copied to the new shard
+# kwargs: user_id, removed and added, dicts of table name -> list of row ids
+user_data_moved = _signals.signal('user-data-moved')
+
+# sent by batch.run_batch inside the transaction of a set based UPDATE or DELETE, before the commit
+# kwargs: session, user_id, table_name, rows (list of dicts of the changed rows as they were before, with at
+# least id and budget_id), values (dict of the new column values) and deleted (True for a delete)
+rows_changed = _signals.signal('rows-changed')
+
+# sent by rollup.check_limits inside the write transaction when the spend of a category goes over its limit
+# kwargs: session, budget_id, year, month, category, spent_cents and limit_cents
+category_over_limit = _signals.signal('category-over-limit')
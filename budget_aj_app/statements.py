@@ -0,0 +1,397 @@
+################################################
+# statements.py in budget_aj_app
+################################################
+#
+#   Description:
+#       monthly statements of every budget as static html files with svg charts (the category pie and the
+#       monthly bars of the dashboard), written by `flask statements run`.
+#
+#       the budgets of every shard are split into chunks and the chunks are rendered by a pool of worker
+#       processes. a worker opens one connection per shard and keeps it for all of its chunks, and a chunk
+#       reads the numbers of all of its budgets with a few grouped queries (incomes, the category_spend rollup,
+#       limits, the expenses of the month) instead of the per request helpers of the pages. the amounts in
+#       other currencies are converted to the budget currency in the queries (rates.py).
+#
+#       every finished statement is appended to the checkpoint file of the month, a run that is started again
+#       skips the budgets that are already in it.
+#
+################################################
+import json
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup
+from sqlalchemy import select, and_, func
+from budget_aj_app.models import User, Budget, Income, Expenses, CategorySpend, CategoryLimit, ExpenseArchive
+from budget_aj_app.money import from_cents
+from budget_aj_app.rates import Conversion
+from budget_aj_app.series import income_in_month
+from budget_aj_app.sharding import all_shards, shard_uris, shard_engine, using_shard, shard_uri_engine
+
+CHECKPOINT = 'checkpoint.jsonl'
+HISTORY_MONTHS = 12
+# the plotly default colors, so the statements look like the dashboard
+COLORS = ('#636efa', '#EF553B', '#00cc96', '#ab63fa', '#FFA15A', '#19d3f3', '#FF6692', '#B6E880', '#FF97FF', '#FECB52')
+
+
+"""""
+SVG CHARTS
+"""""
+
+
+def pie_svg(slices, size=260):
+    """
+        this method will draw the category pie of a statement
+        :param: slices list of (label, amount) with amounts > 0
+        :param: size width and height in pixels
+        :return: svg markup
+    """
+    total = float(sum(amount for _, amount in slices))
+    radius = size / 2 - 10
+    center = size / 2
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{size * 2}" height="{size}" '
+             f'viewBox="0 0 {size * 2} {size}">']
+    angle = -math.pi / 2
+    for index, (label, amount) in enumerate(slices):
+        color = COLORS[index % len(COLORS)]
+        share = float(amount) / total
+        if share >= 0.9999:
+            parts.append(f'<circle cx="{center}" cy="{center}" r="{radius}" fill="{color}"/>')
+        else:
+            end = angle + share * 2 * math.pi
+            x1, y1 = center + radius * math.cos(angle), center + radius * math.sin(angle)
+            x2, y2 = center + radius * math.cos(end), center + radius * math.sin(end)
+            large = 1 if share > 0.5 else 0
+            parts.append(f'<path d="M{center},{center} L{x1:.2f},{y1:.2f} A{radius},{radius} 0 {large} 1 '
+                         f'{x2:.2f},{y2:.2f} Z" fill="{color}"/>')
+            angle = end
+        legend_y = 20 + index * 20
+        parts.append(f'<rect x="{size + 10}" y="{legend_y - 10}" width="12" height="12" fill="{color}"/>')
+        parts.append(f'<text x="{size + 28}" y="{legend_y}" font-size="12">{Markup.escape(label)} '
+                     f'{amount} ({share * 100:.1f}%)</text>')
+    parts.append('</svg>')
+    return Markup(''.join(parts))
+
+
+def bars_svg(months, income, spend, width=640, height=260):
+    """
+        this method will draw the monthly bars of a statement, the income after tax next to the spend
+        :param: months list of month labels
+        :param: income list of amounts, one per month
+        :param: spend list of amounts, one per month
+        :return: svg markup
+    """
+    top = float(max(list(income) + list(spend) + [1]))
+    left, bottom, plot_height = 60, 30, height - 50
+    step = (width - left - 10) / max(len(months), 1)
+    bar = step * 0.35
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+             f'viewBox="0 0 {width} {height}">',
+             f'<line x1="{left}" y1="{height - bottom}" x2="{width - 10}" y2="{height - bottom}" stroke="#999"/>',
+             f'<text x="{left - 5}" y="20" font-size="11" text-anchor="end">{top:.0f}</text>']
+    for index, label in enumerate(months):
+        x = left + index * step + step * 0.15
+        for offset, amount, color in ((0, income[index], '#5fbae9'), (bar, spend[index], 'red')):
+            bar_height = float(amount) / top * plot_height
+            parts.append(f'<rect x="{x + offset:.2f}" y="{height - bottom - bar_height:.2f}" width="{bar:.2f}" '
+                         f'height="{bar_height:.2f}" fill="{color}"><title>{amount}</title></rect>')
+        parts.append(f'<text x="{x + bar:.2f}" y="{height - 10}" font-size="10" text-anchor="middle">{label}</text>')
+    parts.append('</svg>')
+    return Markup(''.join(parts))
+
+
+"""""
+BULK QUERIES
+"""""
+
+
+def month_bounds(year, month):
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return datetime(year, month, 1), datetime(next_month.year, next_month.month, 1)
+
+
+def history_months(year, month, count=HISTORY_MONTHS):
+    """
+        this method will return the months of the bar chart, the statement month last
+        :return: list of (year, month)
+    """
+    last = year * 12 + month - 1
+    return [(index // 12, index % 12 + 1) for index in range(last - count + 1, last + 1)]
+
+
+def statement_data(connection, budgets, year, month):
+    """
+        this method will read the numbers of the statements of a chunk of budgets with one grouped query per
+        kind of data
+        :param: connection database connection of the shard
+        :param: budgets list of dicts with budget_id, budget_name, currency, user_id and user_name
+        :param: year integer year of the statements
+        :param: month integer month of the statements
+        :return: dict of budget id -> dict of the statement numbers
+    """
+    from budget_aj_app.archive import unpack_expenses
+    ids = [budget['budget_id'] for budget in budgets]
+    income, spend, limits, archive = (Income.__table__, CategorySpend.__table__, CategoryLimit.__table__,
+                                      ExpenseArchive.__table__)
+    expenses, budget = Expenses.__table__, Budget.__table__
+    data = {budget['budget_id']: dict(budget, income_cents=0, net_income_cents=0, categories={}, limits={},
+                                      history={}, income_history={}, expenses=[]) for budget in budgets}
+
+    # the incomes that count in every month of the bar chart (effective dates), with the rates of the month
+    months = history_months(year, month)
+    for y, m in months:
+        conversion = Conversion(income.c.currency, budget.c.currency, y, m)
+        income_cents = conversion.cents(income.c.income_amount_month_cents)
+        for budget_id, gross, net in connection.execute(
+                select([income.c.budget_id, func.sum(income_cents),
+                        func.sum(income_cents * (10000 - income.c.income_tax_bp))]).
+                select_from(conversion.join(income.join(budget, budget.c.id == income.c.budget_id))).
+                where(and_(income.c.budget_id.in_(ids), income_in_month(y, m))).group_by(income.c.budget_id)):
+            net_cents = ((net or 0) + 5000) // 10000
+            data[budget_id]['income_history'][(y, m)] = net_cents
+            if (y, m) == (year, month):
+                data[budget_id]['income_cents'] = gross or 0
+                data[budget_id]['net_income_cents'] = net_cents
+
+    first_year, first_month = months[0]
+    period = spend.c.year * 100 + spend.c.month
+    conversion = Conversion(spend.c.currency, budget.c.currency, spend.c.year, spend.c.month)
+    # one row per currency of a category month, added up here
+    for budget_id, y, m, category, cents, count in connection.execute(
+            select([spend.c.budget_id, spend.c.year, spend.c.month, spend.c.category,
+                    conversion.cents(spend.c.spent_cents), spend.c.expense_count]).
+            select_from(conversion.join(spend.join(budget, budget.c.id == spend.c.budget_id))).
+            where(and_(spend.c.budget_id.in_(ids), period >= first_year * 100 + first_month,
+                       period <= year * 100 + month))):
+        statement = data[budget_id]
+        cents = cents or 0
+        statement['history'][(y, m)] = statement['history'].get((y, m), 0) + cents
+        if (y, m) == (year, month) and count:
+            spent, counted = statement['categories'].get(category, (0, 0))
+            statement['categories'][category] = (spent + cents, counted + count)
+
+    for budget_id, category, cents in connection.execute(
+            select([limits.c.budget_id, limits.c.category, limits.c.limit_cents]).where(limits.c.budget_id.in_(ids))):
+        data[budget_id]['limits'][category] = cents
+
+    start, end = month_bounds(year, month)
+    columns = ('id', 'expense_description', 'expense_amount_cents', 'currency', 'category', 'expense_type',
+               'transaction_date')
+    for row in connection.execute(
+            select([expenses.c.budget_id] + [expenses.c[name] for name in columns]).
+            where(and_(expenses.c.budget_id.in_(ids), expenses.c.transaction_date >= start,
+                       expenses.c.transaction_date < end))):
+        data[row.budget_id]['expenses'].append({name: row[name] for name in columns})
+    # a month that is already archived is read from its blob
+    for budget_id, blob in connection.execute(
+            select([archive.c.budget_id, archive.c.data]).
+            where(and_(archive.c.budget_id.in_(ids), archive.c.year == year, archive.c.month == month))):
+        data[budget_id]['expenses'].extend(unpack_expenses(blob))
+    for statement in data.values():
+        statement['expenses'].sort(key=lambda expense: (expense['transaction_date'], expense['id']))
+    return data
+
+
+"""""
+WORKERS
+"""""
+
+# state of one worker process, set up by init_worker()
+_worker = {}
+
+
+def init_worker(uris, labels, year, month, out_dir):
+    """
+        this method will set up a worker process: the shard uris (the connections are opened on first use and
+        kept), the template environment and the statement month
+    """
+    _worker.clear()
+    _worker.update(uris=uris, connections={}, labels=labels, year=year, month=month, out_dir=out_dir,
+                   env=Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')),
+                                   autoescape=select_autoescape(['html'])))
+
+
+def worker_connection(shard):
+    connection = _worker['connections'].get(shard)
+    if connection is None:
+        connection = _worker['connections'][shard] = shard_uri_engine(_worker['uris'][shard]).connect()
+    return connection
+
+
+def expense_amount(expense, currency):
+    # an expense in another currency than the budget is shown as it was entered, with its currency
+    amount = from_cents(expense['expense_amount_cents'])
+    return amount if expense['currency'] == currency else f"{amount} {expense['currency']}"
+
+
+def render_chunk(shard, budgets):
+    """
+        this method will write the statements of a chunk of budgets of one shard
+        :param: shard shard name
+        :param: budgets list of dicts with budget_id, budget_name, currency, user_id and user_name
+        :return: list of checkpoint entries, one per written statement
+    """
+    year, month, labels = _worker['year'], _worker['month'], _worker['labels']
+    template = _worker['env'].get_template('statement.html')
+    months = history_months(year, month)
+    entries = []
+    for budget_id, statement in statement_data(worker_connection(shard), budgets, year, month).items():
+        spent = sum(cents for cents, _ in statement['categories'].values())
+        net = statement['net_income_cents']
+        categories = [{'label': labels.get(key, key), 'spent': from_cents(cents), 'count': count,
+                       'limit': from_cents(statement['limits'][key]) if key in statement['limits'] else None,
+                       'over': key in statement['limits'] and cents > statement['limits'][key]}
+                      for key, (cents, count) in sorted(statement['categories'].items(), key=lambda item: -item[1][0])]
+        html = template.render(
+            statement=statement, year=year, month=month, categories=categories,
+            income=from_cents(statement['income_cents']), net_income=from_cents(net), spent=from_cents(spent),
+            balance=from_cents(net - spent), savings_rate=(net - spent) / net * 100 if net else None,
+            expenses=[dict(expense, label=labels.get(expense['category'], expense['category']),
+                           amount=expense_amount(expense, statement['currency'])) for expense in statement['expenses']],
+            pie=pie_svg([(row['label'], row['spent']) for row in categories if row['spent'] > 0]) if spent else None,
+            bars=bars_svg([f"{y}-{m:02d}" for y, m in months],
+                          [from_cents(statement['income_history'].get((y, m), 0)) for y, m in months],
+                          [from_cents(statement['history'].get((y, m), 0)) for y, m in months]),
+            generated=datetime.utcnow())
+        path = os.path.join(f"user_{statement['user_id']}", f"budget_{budget_id}.html")
+        target = os.path.join(_worker['out_dir'], path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + '.tmp', 'w', encoding='utf-8') as file:
+            file.write(html)
+        os.replace(target + '.tmp', target)
+        entries.append({'shard': shard, 'budget_id': budget_id, 'budget_name': statement['budget_name'],
+                        'user_id': statement['user_id'], 'user_name': statement['user_name'], 'path': path,
+                        'spent_cents': spent, 'net_income_cents': net})
+    return entries
+
+
+"""""
+JOB
+"""""
+
+
+def read_checkpoint(out_dir):
+    """
+        this method will read the statements that are already written for the month
+        :return: dict of (shard, budget id) -> checkpoint entry
+    """
+    done = {}
+    path = os.path.join(out_dir, CHECKPOINT)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash, the budget is written again
+                done[(entry['shard'], entry['budget_id'])] = entry
+    return done
+
+
+def pending_chunks(done, chunk_size):
+    """
+        this method will split the active budgets that have no statement yet into chunks per shard
+        :return: list of (shard, list of budget dicts)
+    """
+    users = dict(User.query.with_entities(User.id, User.user_name).all())
+    chunks = []
+    for shard in all_shards():
+        with using_shard(shard):
+            budget = Budget.__table__
+            with shard_engine().connect() as connection:
+                rows = connection.execute(select([budget.c.id, budget.c.budget_name, budget.c.currency,
+                                                  budget.c.user_id]).
+                                          where(budget.c.deleted_at.is_(None)).order_by(budget.c.id)).fetchall()
+        todo = [{'budget_id': budget_id, 'budget_name': name, 'currency': currency, 'user_id': user_id,
+                 'user_name': users.get(user_id)}
+                for budget_id, name, currency, user_id in rows if (shard, budget_id) not in done]
+        chunks.extend((shard, todo[start:start + chunk_size]) for start in range(0, len(todo), chunk_size))
+    return chunks
+
+
+def write_index(out_dir, year, month, entries):
+    env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')),
+                      autoescape=select_autoescape(['html']))
+    rows = sorted(entries, key=lambda entry: (entry['user_id'], entry['budget_id']))
+    html = env.get_template('statements_index.html').render(
+        year=year, month=month, rows=[dict(row, spent=from_cents(row['spent_cents']),
+                                           net_income=from_cents(row['net_income_cents'])) for row in rows])
+    with open(os.path.join(out_dir, 'index.html'), 'w', encoding='utf-8') as file:
+        file.write(html)
+
+
+def generate_statements(year, month, out_dir, workers=None, chunk_size=None, restart=False, echo=None):
+    """
+        this method will write the statement of every active budget for one month, skipping the ones of an
+        earlier run of the same month unless restart is set
+        :param: year integer year
+        :param: month integer month
+        :param: out_dir directory of the month, created when needed
+        :param: workers number of worker processes, 1 renders in this process
+        :param: chunk_size budgets per chunk
+        :param: restart True to ignore the checkpoint and write everything again
+        :param: echo optional function called with a progress line per chunk
+        :return: number of statements written by this run
+    """
+    from budget_aj_app.users.views import category_choice
+    workers = workers or current_app.config['STATEMENT_WORKERS'] or os.cpu_count() or 1
+    chunk_size = chunk_size or current_app.config['STATEMENT_CHUNK_SIZE']
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint = os.path.join(out_dir, CHECKPOINT)
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    done = read_checkpoint(out_dir)
+    chunks = pending_chunks(done, chunk_size)
+    initargs = (shard_uris(), dict(category_choice()), year, month, out_dir)
+    written = 0
+    with open(checkpoint, 'a', encoding='utf-8') as log:
+        def finished(entries):
+            for entry in entries:
+                log.write(json.dumps(entry) + '\n')
+                done[(entry['shard'], entry['budget_id'])] = entry
+            log.flush()
+            os.fsync(log.fileno())
+            if echo:
+                echo(f"{len(done)} statements written")
+            return len(entries)
+
+        if workers == 1 or len(chunks) <= 1:
+            init_worker(*initargs)
+            for shard, budgets in chunks:
+                written += finished(render_chunk(shard, budgets))
+        else:
+            # spawn, the workers must not share the connections of this process
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_worker, initargs=initargs) as pool:
+                futures = [pool.submit(render_chunk, shard, budgets) for shard, budgets in chunks]
+                for future in futures:
+                    written += finished(future.result())
+    write_index(out_dir, year, month, done.values())
+    return written
+
+
+statements_command = AppGroup('statements', help='Write the monthly statements of the budgets.')
+
+
+@statements_command.command('run')
+@click.option('--month', default=None, help='YYYY-MM, the last complete month by default')
+@click.option('--out', 'out_dir', default='statements', help='directory the months are written to')
+@click.option('--workers', type=int, default=None, help='worker processes, one per cpu by default')
+@click.option('--chunk-size', type=int, default=None, help='budgets per chunk')
+@click.option('--restart', is_flag=True, help='ignore the checkpoint of an earlier run of the month')
+def run_statements_command(month, out_dir, workers, chunk_size, restart):
+    """Write the statement of every active budget for one month."""
+    if month:
+        year, month = (int(part) for part in month.split('-', 1))
+    else:
+        today = date.today()
+        year, month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+    target = os.path.join(out_dir, f"{year}-{month:02d}")
+    written = generate_statements(year, month, target, workers, chunk_size, restart, echo=click.echo)
+    click.echo(f"{written} statements written to {target}")
@@ -0,0 +1,57 @@
+// categorize.js in budget_aj_app/static/scripts
+//
+// category suggestions of the add expense form: when the description input with data-categorize="<url>" changes,
+// the category select of the same form (data-categorize-target) is set to the suggested category, unless the
+// user already picked a category themselves
+(function () {
+
+    var DELAY = 250;  // ms to wait for the next key before asking
+    var CONFIDENCE = 0.5;  // suggestions below this are not applied
+
+    function attach(input) {
+        var select = input.form && input.form.querySelector('select[data-categorize-target]');
+        var amount = input.form && input.form.querySelector('input[name="expense_amount"]');
+        var picked = false;
+        var timer = null;
+        if (!select) {
+            return;
+        }
+        select.addEventListener('change', function () { picked = true; });
+        input.form.addEventListener('reset', function () { picked = false; });
+
+        function suggest() {
+            var text = input.value.trim();
+            if (picked || !text) {
+                return;
+            }
+            var url = input.dataset.categorize + '?description=' + encodeURIComponent(text) +
+                '&amount=' + encodeURIComponent(amount ? amount.value.trim() : '');
+            fetch(url, {credentials: 'same-origin'})
+                .then(function (response) { return response.ok ? response.json() : null; })
+                .then(function (data) {
+                    var suggestion = data && data.suggestions[0];
+                    if (!picked && suggestion && suggestion.category && suggestion.confidence >= CONFIDENCE &&
+                            input.value.trim() === text) {
+                        select.value = suggestion.category;
+                    }
+                });
+        }
+
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(suggest, DELAY);
+        });
+        if (amount) {
+            amount.addEventListener('change', suggest);
+        }
+    }
+
+    function init() {
+        if (!window.fetch) {
+            return;
+        }
+        document.querySelectorAll('input[data-categorize]').forEach(attach);
+    }
+
+    window.BudgetCategorize = {init: init};
+})();
@@ -0,0 +1,168 @@
+// live.js in budget_aj_app/static/scripts
+//
+// keeps the charts of the page in step with the budget without reloading it:
+//  - BudgetLive.connect(url) listens to the server-sent events of the budget and patches the plotly charts
+//  - BudgetLive.backgroundForms() posts the forms marked with data-live in the background
+(function () {
+
+    // the plotly div inside each chart container of the dashboard, create and edit pages
+    var CHARTS = {
+        pie: ['.pie-div'],
+        bar: ['.bar-div'],
+        expenses: ['.add-expense-tab', '.expense-tab-div-expenses'],
+        incomes: ['.income-tab-div']
+    };
+
+    function graphs(name) {
+        var found = [];
+        CHARTS[name].forEach(function (selector) {
+            var container = document.querySelector(selector);
+            var graph = container && container.querySelector('.js-plotly-plot');
+            if (graph && graph.data) {
+                found.push(graph);
+            }
+        });
+        return found;
+    }
+
+    // replace (same id in the first column) or append table rows
+    function upsertRows(name, rows) {
+        graphs(name).forEach(function (graph) {
+            var columns = graph.data[0].cells.values.map(function (column) { return column.slice(); });
+            rows.forEach(function (row) {
+                var index = columns[0].indexOf(row[0]);
+                row.forEach(function (value, column) {
+                    if (index < 0) {
+                        columns[column].push(value);
+                    } else {
+                        columns[column][index] = value;
+                    }
+                });
+            });
+            Plotly.restyle(graph, {'cells.values': [columns]});
+        });
+    }
+
+    function deleteRows(name, ids) {
+        graphs(name).forEach(function (graph) {
+            var columns = graph.data[0].cells.values;
+            var keep = columns[0].map(function (id) { return ids.indexOf(id) < 0; });
+            columns = columns.map(function (column) {
+                return column.filter(function (value, index) { return keep[index]; });
+            });
+            Plotly.restyle(graph, {'cells.values': [columns]});
+        });
+    }
+
+    function updatePie(totals, examples) {
+        graphs('pie').forEach(function (graph) {
+            var labels = [], values = [];
+            graph.data[0].labels.forEach(function (label, index) {
+                if (examples.indexOf(label) < 0 && !(label in totals)) {
+                    labels.push(label);
+                    values.push(graph.data[0].values[index]);
+                }
+            });
+            Object.keys(totals).forEach(function (label) {
+                if (totals[label] > 0) {
+                    labels.push(label);
+                    values.push(totals[label]);
+                }
+            });
+            Plotly.restyle(graph, {labels: [labels], values: [values]});
+        });
+    }
+
+    function updateBars(data) {
+        graphs('bar').forEach(function (graph) {
+            Plotly.restyle(graph, {x: [data.months, data.months], y: [data.income, data.spend]});
+        });
+    }
+
+    function listen(source, name, handler) {
+        source.addEventListener(name, function (event) { handler(JSON.parse(event.data)); });
+    }
+
+    function connect(url) {
+        if (!window.EventSource) {
+            return null;
+        }
+        var source = new EventSource(url);
+        listen(source, 'expenses', function (data) { upsertRows('expenses', data.rows); });
+        listen(source, 'expenses-deleted', function (data) { deleteRows('expenses', data.ids); });
+        listen(source, 'incomes', function (data) { upsertRows('incomes', data.rows); });
+        listen(source, 'incomes-deleted', function (data) { deleteRows('incomes', data.ids); });
+        listen(source, 'categories', function (data) { updatePie(data.totals, data.examples); });
+        listen(source, 'months', updateBars);
+        listen(source, 'alerts', function (data) { showMessage(data.messages.join(' ')); });
+        listen(source, 'reload', function () {
+            source.close();
+            window.location.reload();
+        });
+        // a stream that ends is reopened by the browser, but not one refused by a busy worker (503)
+        source.onerror = function () {
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(function () { connect(url); }, 30000);
+            }
+        };
+        return source;
+    }
+
+    function showMessage(message) {
+        var alert = document.createElement('div');
+        alert.className = 'alert alert-warning alert-dismissible fade show alert-div1';
+        alert.setAttribute('role', 'alert');
+        alert.innerHTML = '<button type="button" class="close" data-dismiss="alert" aria-label="Close">' +
+                          '<span aria-hidden="true">&times;</span></button>';
+        alert.appendChild(document.createTextNode(message));
+        document.querySelectorAll('.alert-div1').forEach(function (old) { old.remove(); });
+        document.body.insertBefore(alert, document.querySelector('.container3'));
+    }
+
+    // post the form in the background, a form with errors is posted normally so the page shows them
+    function backgroundForms() {
+        if (!window.fetch || !window.FormData) {
+            return;
+        }
+        document.querySelectorAll('form[data-live]').forEach(function (form) {
+            var submitter = null;
+            form.addEventListener('click', function (event) {
+                if (event.target.type === 'submit') {
+                    submitter = event.target;
+                }
+            });
+            form.addEventListener('submit', function (event) {
+                if (form.dataset.live === 'off') {
+                    return;
+                }
+                event.preventDefault();
+                var body = new FormData(form);
+                if (submitter && submitter.name) {
+                    body.append(submitter.name, submitter.value);
+                }
+                fetch(form.action || window.location.href, {
+                    method: 'POST', body: body, credentials: 'same-origin',
+                    headers: {'X-Requested-With': 'XMLHttpRequest'}
+                }).then(function (response) {
+                    var json = (response.headers.get('Content-Type') || '').indexOf('application/json') === 0;
+                    if (!response.ok || !json) {
+                        throw new Error('not saved');
+                    }
+                    return response.json();
+                }).then(function (data) {
+                    showMessage(data.message);
+                    form.reset();
+                }).catch(function () {
+                    form.dataset.live = 'off';
+                    if (submitter) {
+                        submitter.click();
+                    } else {
+                        form.submit();
+                    }
+                });
+            });
+        });
+    }
+
+    window.BudgetLive = {connect: connect, backgroundForms: backgroundForms};
+})();
@@ -0,0 +1,54 @@
+// lookup.js in budget_aj_app/static/scripts
+//
+// typeahead for the id inputs of the edit page: an input with data-lookup="<url>" gets a datalist that is
+// filled from the lookup endpoint while the user types an id or the start of a description
+(function () {
+
+    var DELAY = 200;  // ms to wait for the next key before searching
+
+    function attach(input, index) {
+        var list = document.createElement('datalist');
+        var timer = null;
+        var last = null;
+        list.id = 'lookup-' + index;
+        input.setAttribute('list', list.id);
+        input.parentNode.appendChild(list);
+
+        function search() {
+            var text = input.value.trim();
+            if (text === last) {
+                return;
+            }
+            last = text;
+            fetch(input.dataset.lookup + '?limit=20&q=' + encodeURIComponent(text), {credentials: 'same-origin'})
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    if (input.value.trim() !== text) {
+                        return;  // an older answer, the user kept typing
+                    }
+                    list.innerHTML = '';
+                    data.results.forEach(function (row) {
+                        var option = document.createElement('option');
+                        option.value = row.id;
+                        option.label = row.description + ' (' + row.details + ')';
+                        list.appendChild(option);
+                    });
+                });
+        }
+
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(search, DELAY);
+        });
+        input.addEventListener('focus', search);
+    }
+
+    function init() {
+        if (!window.fetch) {
+            return;
+        }
+        document.querySelectorAll('input[data-lookup]').forEach(attach);
+    }
+
+    window.BudgetLookup = {init: init};
+})();
@@ -0,0 +1,168 @@
+################################################
+# templating.py in budget_aj_app
+################################################
+#
+#   Description:
+#       caching of the jinja layer of the pages.
+#
+#       `{% cache 'name', key, ... %} ... {% endcache %}` keeps the html of a block of a template in a per
+#       process lru store (FRAGMENT_CACHE_SIZE blocks, at most FRAGMENT_CACHE_SECONDS old) under the template,
+#       the name and the key values, so the next render of the page outputs it without running the block. the
+#       pages key the blocks that show budget data with budget_version(): the user, the selected budget, the
+#       last change of the user's budgets in the change log, the active exchange rates and the day, so any
+#       write gives the blocks a new key instead of having to find and drop the old ones. forms are never put
+#       in a block, their csrf token belongs to the session.
+#
+#       the views hand the charts and tables to the templates as Deferred values that are only built when
+#       they are output, a cached block skips the plotly figure and its queries along with the html.
+#
+#       the compiled templates are kept on disk by a jinja bytecode cache (TEMPLATE_BYTECODE_DIR), a new
+#       worker process loads them instead of compiling every template again.
+#
+################################################
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from flask import current_app, g
+from flask_login import current_user
+from jinja2 import nodes, FileSystemBytecodeCache
+from jinja2.ext import Extension
+from budget_aj_app import db
+
+
+class FragmentStore(object):
+    """
+        the rendered blocks of this process, least recently used first
+    """
+
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.blocks = OrderedDict()  # key -> (time stored, html)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.blocks.get(key)
+            if entry is None or now - entry[0] > self.max_age:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, html):
+        with self.lock:
+            self.blocks[key] = (time.monotonic(), html)
+            self.blocks.move_to_end(key)
+            while len(self.blocks) > self.max_entries:
+                self.blocks.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """
+        the {% cache %} tag, the key values are expressions separated by commas
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        # two blocks with the same key values in different templates don't share their html
+        block = nodes.Const(f"{parser.name}:{lineno}")
+        return nodes.CallBlock(self.call_method('_cached_block', [block, nodes.List(parts)]), [], [], body). \
+            set_lineno(lineno)
+
+    def _cached_block(self, block, parts, caller):
+        store = fragment_store()
+        if store is None:
+            return caller()
+        key = (block,) + tuple(parts)
+        html = store.get(key)
+        if html is None:
+            html = caller()
+            store.set(key, html)
+        return html
+
+
+class Deferred(object):
+    """
+        html built by a function the first time a template outputs it, a cached block that holds it never
+        builds it
+    """
+
+    def __init__(self, build, *args):
+        self.build = build
+        self.args = args
+        self.html = None
+
+    def __html__(self):
+        if self.html is None:
+            self.html = str(self.build(*self.args))
+        return self.html
+
+    def __str__(self):
+        return self.__html__()
+
+
+def fragment_store():
+    # None when the fragment cache is turned off (FRAGMENT_CACHE_SIZE = 0)
+    return current_app.extensions.get('fragments')
+
+
+def budget_version():
+    """
+        this method will return the version of the selected budget of the current user for the keys of the
+        cached blocks, read once per request
+        :return: tuple of (user id, selected budget id, last change log version of the user, active rate
+                 version, today)
+    """
+    if 'budget_version' not in g:
+        from budget_aj_app.models import ChangeCounter
+        from budget_aj_app.rates import rate_cache
+        from budget_aj_app.users.views import selected_budget
+        changed = db.session.query(ChangeCounter.version).filter(ChangeCounter.user_id == current_user.id).scalar()
+        g.budget_version = (current_user.id, selected_budget(), changed, rate_cache().active_version(), date.today())
+    return g.budget_version
+
+
+def bytecode_folder(app):
+    return app.config['TEMPLATE_BYTECODE_DIR'] or os.path.join(app.instance_path, 'jinja')
+
+
+def bytecode_cache(folder):
+    """
+        this method will create the on disk cache of the compiled templates
+        :param: folder directory of the cache, created when needed, None or '' for no cache
+        :return: FileSystemBytecodeCache or None
+    """
+    if not folder:
+        return None
+    os.makedirs(folder, exist_ok=True)
+    return FileSystemBytecodeCache(folder)
+
+
+def init_templates(app):
+    """
+        this method will add the {% cache %} tag and the bytecode cache to the jinja environment of the app
+        :param: app flask application
+    """
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    if app.config['FRAGMENT_CACHE_SIZE']:
+        app.extensions['fragments'] = FragmentStore(app.config['FRAGMENT_CACHE_SIZE'],
+                                                    app.config['FRAGMENT_CACHE_SECONDS'])
+    if app.config['TEMPLATE_BYTECODE_DIR'] != '':
+        app.jinja_env.bytecode_cache = bytecode_cache(bytecode_folder(app))
+    app.jinja_env.globals['budget_version'] = budget_version
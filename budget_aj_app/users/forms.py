@@ -1,9 +1,12 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, FloatField, SelectField, BooleanField
-from wtforms.validators import DataRequired, Email, EqualTo, Optional, StopValidation, InputRequired
+from wtforms import StringField, PasswordField, SubmitField, DecimalField, SelectField, BooleanField, IntegerField
+from wtforms.validators import DataRequired, Email, EqualTo, Optional, StopValidation, InputRequired, NumberRange
 from wtforms import ValidationError
-from budget_aj_app.models import User, Income, Budget
+from budget_aj_app.models import User, Income, Budget, Expenses
+from budget_aj_app.rates import rate_cache
+from budget_aj_app.money import DEFAULT_CURRENCY
 from wtforms.fields.html5 import DateField
+from datetime import date
 
 
 
@@ -21,6 +24,49 @@ class RequiredIf(object):
         else:
             field.validators.insert(1, Optional(strip_whitespace=True))
 
+class NotBefore(object):
+    # a validator which checks that a date isn't before the date of another field,
+    # an empty date on either side passes
+    def __init__(self, other_field_name, message=None):
+        self.other_field_name = other_field_name
+        self.message = message or 'The end date can not be before the start date!'
+
+    def __call__(self, form, field):
+        other_field = form._fields.get(self.other_field_name)
+        if field.data and other_field.data and field.data < other_field.data:
+            raise StopValidation(self.message)
+
+class BudgetRow(object):
+    # a validator which checks in the database that the id belongs to a row
+    # of the budget the form edits (form.budget_id, set by the view)
+    def __init__(self, model, message=None):
+        self.model = model
+        self.message = message or 'Please pick an Id of the selected budget!'
+
+    def __call__(self, form, field):
+        if field.data is None:
+            return
+        if self.model.query.with_entities(self.model.id). \
+                filter_by(id=field.data, budget_id=getattr(form, 'budget_id', None)).first() is None:
+            raise StopValidation(self.message)
+
+class KnownRate(object):
+    # a validator which checks that the active exchange rates convert the currency to the currency of
+    # the budget (form.budget_currency, set by the view) in the month of the date field, or this month
+    def __init__(self, date_field_name=None, message=None):
+        self.date_field_name = date_field_name
+        self.message = message or 'There is no exchange rate for this currency in that month!'
+
+    def __call__(self, form, field):
+        budget_currency = getattr(form, 'budget_currency', None)
+        if not field.data or budget_currency is None or field.data == budget_currency:
+            return
+        date_field = form._fields.get(self.date_field_name) if self.date_field_name else None
+        day = date_field.data if date_field is not None and date_field.data else date.today()
+        if rate_cache().rate(field.data, day) is None or rate_cache().rate(budget_currency, day) is None:
+            raise StopValidation(self.message)
+
+
 class LoginForm(FlaskForm):
     user_login_id = StringField(validators=[DataRequired()])
     login_password = PasswordField('Password', validators=[DataRequired()])
@@ -70,6 +116,7 @@ class EditProfileForm(FlaskForm):
 class AddBudgetForm(FlaskForm):
     budget_name = StringField('Budget Name', validators=[DataRequired()])
     budget_description = StringField('Budget Description')
+    currency = SelectField('Currency', default=DEFAULT_CURRENCY, validators=[Optional(strip_whitespace=True)])
     submit = SubmitField('Create')
 
 
@@ -83,8 +130,13 @@ class IncomeForm(FlaskForm):
     pay_period = SelectField('Pay Period', choices=[('semi_monthly', ""), ('weekly', 'weekly'),
     ('bi_weekly', 'bi-weekly(every other week)'), ('semi_monthly', 'semi-monthly(twice a month)'),
     ('monthly', 'monthly')], validators=[DataRequired()])
-    income_amount_month = FloatField('Amount', validators=[DataRequired()])
-    income_tax = FloatField('Tax')
+    income_amount_month = DecimalField('Amount', validators=[DataRequired()])
+    income_tax = DecimalField('Tax')
+    effective_from = DateField('Starts', format='%Y-%m-%d', validators=[Optional(strip_whitespace=True)])
+    effective_to = DateField('Ends', format='%Y-%m-%d', validators=[Optional(strip_whitespace=True),
+                                                                    NotBefore('effective_from')])
+    currency = SelectField('Currency', default='', validators=[Optional(strip_whitespace=True),
+                                                               KnownRate('effective_from')])
     submit = SubmitField('Add Income')
 
 
@@ -93,16 +145,19 @@ class AddExpensesForm(FlaskForm):
     category = SelectField('Expense Category', validators=[DataRequired()])
     expense_type = SelectField('Expense Type', choices=[("", ""), ('one', 'One Time'), ('month_bill', 'Monthly Bill')],
                                validators=[DataRequired()])
-    expense_amount = FloatField('Amount', validators=[DataRequired()])
+    expense_amount = DecimalField('Amount', validators=[DataRequired()])
     due_date = SelectField('Due Day', coerce=int, validators=[RequiredIf('expense_type')])
     transaction_date = DateField('Date', format="%Y-%m-%d", validators=[Optional(strip_whitespace=True)])
     expense_months_period = SelectField('Months Period', coerce=int, validators=[RequiredIf('expense_type')])
+    currency = SelectField('Currency', default='', validators=[Optional(strip_whitespace=True),
+                                                               KnownRate('transaction_date')])
     submit = SubmitField('Add Expense')
 
 
 class EditBudgetForm(FlaskForm):
     budget_name = StringField('Budget Name', validators=[DataRequired()])
     budget_description = StringField('Budget Description')
+    currency = SelectField('Currency', default='', validators=[Optional(strip_whitespace=True)])
     edit_budget_submit = SubmitField('Edit')
 
 
@@ -111,40 +166,87 @@ class EditIncomeForm(FlaskForm):
     pay_period = SelectField('Pay Period', choices=[('semi_monthly', ""), ('weekly', 'weekly'),
     ('bi_weekly', 'bi-weekly(every other week)'), ('semi_monthly', 'semi-monthly(twice a month)'),
     ('monthly', 'monthly')], validators=[DataRequired()])
-    income_amount_month = FloatField('Amount', validators=[DataRequired()])
-    income_tax = FloatField('Tax', validators=[DataRequired()])
-    select_income = SelectField("Income Id", coerce=int, validators=[DataRequired()])
+    income_amount_month = DecimalField('Amount', validators=[DataRequired()])
+    income_tax = DecimalField('Tax', validators=[DataRequired()])
+    effective_from = DateField('Starts', format='%Y-%m-%d', validators=[Optional(strip_whitespace=True)])
+    effective_to = DateField('Ends', format='%Y-%m-%d', validators=[Optional(strip_whitespace=True),
+                                                                    NotBefore('effective_from')])
+    currency = SelectField('Currency', default='', validators=[Optional(strip_whitespace=True),
+                                                               KnownRate('effective_from')])
+    select_income = IntegerField("Income Id", validators=[DataRequired(), BudgetRow(Income)])
     edit_income_submit = SubmitField('Edit Income')
 
 
 class EditExpensesForm(FlaskForm):
-    select_expense = SelectField("Expense Id", coerce=int, validators=[InputRequired()])
+    select_expense = IntegerField("Expense Id", validators=[InputRequired(), BudgetRow(Expenses)])
     expense_description = StringField('Expense Description')
     category = SelectField('Expense Category', validators=[Optional(strip_whitespace=True)])
     expense_type = SelectField('Expense Type', choices=[('', ''), ('one', 'One Time'), ('month_bill', 'Monthly Bill')], validators=[Optional(strip_whitespace=True)])
-    expense_amount = FloatField('Amount', validators=[Optional(strip_whitespace=True)])
+    expense_amount = DecimalField('Amount', validators=[Optional(strip_whitespace=True)])
     due_date = SelectField('Due Day', coerce=int, validators=[RequiredIf('expense_type')])
     transaction_date = DateField('Date', format='%Y-%m-%d', validators=[Optional(strip_whitespace=True)])
+    currency = SelectField('Currency', default='', validators=[Optional(strip_whitespace=True),
+                                                               KnownRate('transaction_date')])
     edit_expenses_submit = SubmitField('Edit Expense')
 
 
+class BatchExpensesForm(FlaskForm):
+    expense_ids = StringField('Expense Ids', validators=[Optional(strip_whitespace=True)])
+    filter_category = SelectField('Category', validators=[Optional(strip_whitespace=True)])
+    filter_type = SelectField('Type', choices=[('', ''), ('one', 'One Time'), ('month_bill', 'Monthly Bill')],
+                              validators=[Optional(strip_whitespace=True)])
+    date_from = DateField('From', format='%Y-%m-%d', validators=[Optional(strip_whitespace=True)])
+    date_to = DateField('To', format='%Y-%m-%d', validators=[Optional(strip_whitespace=True)])
+    new_category = SelectField('New Category', validators=[Optional(strip_whitespace=True)])
+    new_type = SelectField('New Type', choices=[('', ''), ('one', 'One Time'), ('month_bill', 'Monthly Bill')],
+                           validators=[Optional(strip_whitespace=True)])
+    new_amount = DecimalField('New Amount', validators=[Optional(strip_whitespace=True)])
+    batch_expenses_submit = SubmitField('Edit All')
+    batch_expenses_delete = SubmitField('Delete All')
+
+
+class BatchIncomesForm(FlaskForm):
+    income_ids = StringField('Income Ids', validators=[DataRequired()])
+    new_income_amount = DecimalField('New Amount', validators=[Optional(strip_whitespace=True)])
+    new_income_tax = DecimalField('New Tax', validators=[Optional(strip_whitespace=True)])
+    batch_incomes_submit = SubmitField('Edit All')
+    batch_incomes_delete = SubmitField('Delete All')
+
+
+class CategoryLimitForm(FlaskForm):
+    category = SelectField('Category', validators=[DataRequired()])
+    limit = DecimalField('Monthly Limit', validators=[InputRequired(), NumberRange(min=0)])
+    limit_submit = SubmitField('Set Limit')
+
+
+class ScenarioForm(FlaskForm):
+    raise_pct = StringField('Raise %', default='0, 3, 5')
+    tax_change = StringField('Tax Change', default='0')
+    new_bill = StringField('New Monthly Bill', default='0')
+    discretionary_change = StringField('Spend Change %', default='0, -10')
+    months = IntegerField('Months', default=12, validators=[InputRequired(), NumberRange(min=1, max=120)])
+    simulations = IntegerField('Simulations', default=2000, validators=[InputRequired(), NumberRange(min=100, max=20000)])
+    scenario_submit = SubmitField('Run')
+
+
 class BudgetDeleteForm(FlaskForm):
     submit2 = SubmitField("Delete")
 
 
 class IncomeDeleteForm(FlaskForm):
-    select_income = SelectField("Income Id", coerce=int, validators=[DataRequired()])
+    select_income = IntegerField("Income Id", validators=[DataRequired(), BudgetRow(Income)])
     income_delete_submit = SubmitField("Delete Income")
 
 
 class ExpenseDeleteForm(FlaskForm):
-    select_expense = SelectField("Expense Id", coerce=int, validators=[DataRequired()])
+    select_expense = IntegerField("Expense Id", validators=[DataRequired(), BudgetRow(Expenses)])
     expense_delete_submit = SubmitField("Delete Expense")
 
 
 class ExpenseViewForm(FlaskForm):
     category = SelectField('Expense Category')
     expense_type = SelectField('Type', choices=[('', ''), ('one', 'One Time'), ('month_bill', 'Monthly Bill')])
+    include_archived = BooleanField('Archived')
     submit = SubmitField("Select")
 
 
@@ -10,20 +10,33 @@
 #       this file will handel all server side requests
 #
 ##############################################################################
-from flask import render_template, url_for, flash, redirect, request, Blueprint, Markup
+from flask import render_template, url_for, flash, redirect, request, Blueprint, Markup, jsonify, Response, \
+    stream_with_context, current_app, abort
 from flask_login import login_user, current_user, logout_user, login_required
 from budget_aj_app import db
-from budget_aj_app.models import User, Income, Budget, UserSelect, Expenses
+from budget_aj_app.purge import schedule_purge
+from budget_aj_app.live import broker, budget_channel, sse, stream_slots
+from budget_aj_app.sharding import current_shard
+from budget_aj_app.credentials import CredentialError, authenticate
+from budget_aj_app.batch import BatchError, batch_expenses, batch_incomes, parse_ids
+from budget_aj_app.rollup import set_category_limit, budget_vs_actual
+from budget_aj_app.archive import archived_expenses
+from budget_aj_app.reads import summary_queries, dashboard_summary, EXPORT_HEADER, export_row
+from budget_aj_app.series import budget_series, income_in_month
+from budget_aj_app.money import from_cents, DEFAULT_CURRENCY
+from budget_aj_app.rates import Conversion, rate_cache
+from budget_aj_app.templating import Deferred
+from budget_aj_app.models import User, Income, Budget, UserSelect, Expenses, CategorySpend
 from budget_aj_app.users.forms import UserCreateForm, LoginForm, IncomeForm, \
     AddExpensesForm, AddBudgetForm, BudgetSelectForm, BudgetDeleteForm, \
-    EditBudgetForm, EditExpensesForm, EditIncomeForm, ExpenseDeleteForm, \
-    IncomeDeleteForm, EditProfileForm, ExpenseViewForm
-from plotly.offline import plot, iplot
-import plotly.graph_objects as go
+    EditBudgetForm, EditExpensesForm, EditIncomeForm, ExpenseDeleteForm, BatchExpensesForm, BatchIncomesForm, \
+    IncomeDeleteForm, EditProfileForm, ExpenseViewForm, CategoryLimitForm, ScenarioForm
 from datetime import datetime, date
-from sqlalchemy.sql import func, extract
+from sqlalchemy.sql import func
 from enum import Enum
-from dateutil.relativedelta import *
+from decimal import Decimal
+import time
+# plotly and dateutil are slow to import, so they are loaded inside the functions that use them
 
 
 users = Blueprint('users', __name__)
@@ -56,8 +69,12 @@ def login():
     """
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.user_login_id.data).first()
-        if user is not None and user.check_password(form.login_password.data):
+        try:
+            user = authenticate(form.user_login_id.data, form.login_password.data, request.remote_addr)
+        except CredentialError as error:
+            flash(str(error))
+            return render_template('login.html', form=form), error.status, {'Retry-After': str(error.retry_after)}
+        if user is not None:
             login_user(user)
             flash('Logged in successfully.')
             next_page = request.args.get('next')
@@ -89,11 +106,8 @@ def user_dashboard():
         this method will render the '/dashboard' view request for user dashboard page
         :return: render user_dashboard.html
     """
-    pie = create_pie()
-    bar = create_bar()
-    expenses_tab = expenses_table()
     delete_budget = BudgetDeleteForm()
-    budgets_available = Budget.query.filter_by(user_id=current_user.id).all()
+    budgets_available = Budget.active().filter_by(user_id=current_user.id).all()
     select_budget = BudgetSelectForm(select_budget=selected_budget())  # assign the currently selected budget id to
     # be the default value for budget select form
     select_budget.select_budget.choices = [(0, "")]+[(budget.id, budget.budget_name) for budget in budgets_available]
@@ -115,8 +129,60 @@ def user_dashboard():
             return redirect(url_for('users.user_dashboard'))
         else:
             flash("Select the budget that you want to delete?")
-    return render_template('user_dashboard.html', pie_div=Markup(pie), bar_div=Markup(bar),
-                           expenses_tab=Markup(expenses_tab), budget_select_form=select_budget, budget_delete_form=delete_budget)
+    # the charts are only built when the page outputs them, not when its cached charts block is used
+    return render_template('user_dashboard.html', pie_div=Deferred(create_pie), bar_div=Deferred(create_bar),
+                           expenses_tab=Deferred(expenses_table), budget_select_form=select_budget, budget_delete_form=delete_budget,
+                           live_url=live_url())
+
+
+@users.route('/dashboard/summary')
+@login_required
+def dashboard_summary_view():
+    """
+        this method will process the '/dashboard/summary' view request, the figures and the plots of the
+        dashboard of the selected budget as json, amounts in cents
+        :return: json response
+    """
+    budget_id = selected_budget()
+    rows = {name: db.session.execute(query).fetchall() for name, query in summary_queries(budget_id).items()}
+    summary = dashboard_summary(budget_id, rows)
+    summary['pie'], summary['bar'] = summary_charts(summary)
+    return jsonify(summary)
+
+
+@users.route('/overview')
+@login_required
+def budgets_overview():
+    """
+        this method will render the '/overview' view request for comparing all the user budgets in one page,
+        the selected budget is not changed
+        :return: render budgets_overview.html
+    """
+    overview = budgets_overview_data()
+    overview_tab = budgets_overview_table(overview)
+    bar = budgets_overview_bar(overview)
+    return render_template('budgets_overview.html', overview_tab=Markup(overview_tab), bar_div=Markup(bar))
+
+
+@users.route('/dashboard/live/<int:budget_id>')
+@login_required
+def budget_live(budget_id):
+    """
+        this method will stream the changes of a budget to the open dashboard as server-sent events
+        :param: budget_id integer id of a budget of the current user
+        :return: text/event-stream response
+    """
+    if Budget.active().filter_by(id=budget_id, user_id=current_user.id).first() is None:
+        abort(404)
+    db.session.rollback()  # don't keep the read transaction open while the stream waits
+    # the stream holds a worker thread until it ends, a full worker sends the page elsewhere or to later
+    if not stream_slots().acquire(blocking=False):
+        return Response("too many live streams, try again later\n", 503,
+                        {'Retry-After': str(current_app.config['LIVE_KEEPALIVE'])})
+    response = Response(stream_with_context(budget_events(budget_id)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stream_slots().release)
+    return response
 
 
 @users.route('/profile', methods=['GET', 'POST'])
@@ -155,10 +221,10 @@ class IncomeMonth(Enum):
         """
            this method will take income period and amount as parameters and return the monthly income
            :param: income_type as string for income period
-           :param: income_amount float type value for income
-           :return: float number for monthly income
+           :param: income_amount Decimal or float value for income
+           :return: Decimal number for monthly income
         """
-        monthly = (income_amount * getattr(cls, income_type).value)/ 12
+        monthly = (Decimal(str(income_amount)) * getattr(cls, income_type).value) / 12
         return round(monthly, 2)
 
 
@@ -171,10 +237,12 @@ def create_budget():
     """
     budget_form = AddBudgetForm()
     income_form = IncomeForm()
-    income_tab = incomes_table()
-    budget_tab = budgets_table()
-    expenses_tab = expenses_table()
     form = AddExpensesForm()
+    currency = budget_currency()
+    budget_form.currency.choices = currency_choice()
+    for amount_form in (income_form, form):
+        amount_form.budget_currency = currency
+        amount_form.currency.choices = currency_choice(currency)
     form.category.choices = category_choice()
     form.due_date.choices = [(0, "")]+[(i, str(i)) for i in range(1, 29)]
     form.expense_months_period.choices = [(0, "")] + [(i, str(i)) for i in range(2, 25)]
@@ -183,7 +251,8 @@ def create_budget():
     if budget_form.validate_on_submit():
         budget = Budget(user_id=current_user.id,
                         budget_name=budget_form.budget_name.data,
-                        budget_description=budget_form.budget_description.data)
+                        budget_description=budget_form.budget_description.data,
+                        currency=budget_form.currency.data or DEFAULT_CURRENCY)
         db.session.add(budget)
         db.session.commit()
         if UserSelect.query.filter_by(user_id=current_user.id).first() is None:
@@ -202,11 +271,13 @@ def create_budget():
             income = Income(budget_id=selected_budget(),
                             income_amount_month=amount_month,
                             income_description=income_form.income_description.data,
-                            income_tax=income_form.income_tax.data)
+                            income_tax=income_form.income_tax.data,
+                            currency=income_form.currency.data or currency,
+                            effective_from=income_form.effective_from.data,
+                            effective_to=income_form.effective_to.data)
             db.session.add(income)
             db.session.commit()
-            flash('Income added to the budget!')
-            return redirect(url_for('users.create_budget'))
+            return mutation_done('Income added to the budget!', 'users.create_budget')
         elif selected_budget() == 0:
             flash('Please select your budget and filling all the required fields.!!')
 
@@ -215,6 +286,7 @@ def create_budget():
         if selected_budget() != 0:
             print(selected_budget())
             if form.expense_months_period.data> 0:
+                from dateutil.relativedelta import relativedelta
                 currentMonth = datetime.now().month
                 currentYear = datetime.now().year
                 due_date = date(currentYear, currentMonth, form.due_date.data)
@@ -225,7 +297,8 @@ def create_budget():
                                         category=form.category.data,
                                         expense_type=form.expense_type.data,
                                         transaction_date= due_date + relativedelta(months=+1),
-                                        due_date = due_date)
+                                        due_date = due_date,
+                                        currency=form.currency.data or currency)
                     due_date = due_date + relativedelta(months=+1)
                     db.session.add(expenses)
             else:
@@ -234,17 +307,19 @@ def create_budget():
                                     expense_amount=form.expense_amount.data,
                                     category=form.category.data,
                                     expense_type=form.expense_type.data,
-                                    transaction_date=form.transaction_date.data
+                                    transaction_date=form.transaction_date.data,
+                                    currency=form.currency.data or currency
                                     )
                 db.session.add(expenses)
             db.session.commit()
-            flash('Expense added to the budget!')
-            return redirect(url_for('users.create_budget'))
+            return mutation_done('Expense added to the budget!', 'users.create_budget')
         elif selected_budget() == 0:
             flash('Please select your budget and filling all the required fields.!!')
 
-    return render_template('create_budget.html', budget_form=budget_form, income_form=income_form, form=form, expenses_tab=Markup(expenses_tab),
-                           income_tab=Markup(income_tab), budget_tab=Markup(budget_tab))
+    # the tables are only built when the page outputs them, not for the add posts or a cached tables block
+    return render_template('create_budget.html', budget_form=budget_form, income_form=income_form, form=form,
+                           expenses_tab=Deferred(expenses_table), income_tab=Deferred(incomes_table),
+                           budget_tab=Deferred(budgets_table), live_url=live_url())
 
 
 @users.route('/edit', methods=['GET', 'POST'])
@@ -259,78 +334,139 @@ def edit_budget():
     edit_expense_form = EditExpensesForm()
     delete_income_form = IncomeDeleteForm()
     delete_expense_form = ExpenseDeleteForm()
-    incomes_available = Income.query.filter_by(budget_id=selected_budget()).all()
-    edit_income_form.select_income.choices = [(0, "")] + [(income.id, income.id) for income in incomes_available]
-    delete_income_form.select_income.choices = [(0, "")] + [(income.id, income.id) for income in incomes_available]
-    expenses_available = Expenses.query.filter_by(budget_id=selected_budget()).all()
-    edit_expense_form.select_expense.choices = [(0, "")] + [(expense.id, expense.id) for expense in expenses_available]
-    delete_expense_form.select_expense.choices = [(0, "")] + [(expense.id, expense.id) for expense in expenses_available]
+    batch_expense_form = BatchExpensesForm()
+    batch_income_form = BatchIncomesForm()
+    # the ids are typed with the help of /api/lookup and checked against the database when the form is posted,
+    # so the page doesn't load every income and expense of the budget
+    for id_form in (edit_income_form, delete_income_form, edit_expense_form, delete_expense_form):
+        id_form.budget_id = selected_budget()
+    # the amounts keep their currency when none is picked, the budget currency is the default of its form
+    currency = budget_currency()
+    edit_budget_form.currency.choices = currency_choice(currency)
+    if not edit_budget_form.edit_budget_submit.data:
+        edit_budget_form.currency.data = currency
+    for amount_form in (edit_income_form, edit_expense_form):
+        amount_form.budget_currency = currency
+        amount_form.currency.choices = [("", "")] + currency_choice(currency)
     edit_expense_form.category.choices = category_choice() # assign available category tuple to category field choices
+    batch_expense_form.filter_category.choices = category_choice()
+    batch_expense_form.new_category.choices = category_choice()
     edit_expense_form.due_date.choices = [(0, "")]+[(i, str(i)) for i in range(1, 29)]# assign day number dynamically for due day
-    income_tab = incomes_table()
-    budget_tab = budgets_table()
-    expenses_tab = expenses_table()
 
     # validate edit budget form and apply it to DB
     if edit_budget_form.edit_budget_submit.data and edit_budget_form.validate():
-        budget = Budget.query.filter_by(id=selected_budget()).first()
+        budget = Budget.active().filter_by(id=selected_budget()).first()
         budget.budget_name = edit_budget_form.budget_name.data
         budget.budget_description = edit_budget_form.budget_description.data
+        budget.currency = edit_budget_form.currency.data or budget.currency
         db.session.commit()
         flash(f'Budget with Id {selected_budget()} has been edited')
         return redirect(url_for('users.edit_budget'))
 
     # validate delete income form and apply it to DB
     if delete_income_form.income_delete_submit.data and delete_income_form.validate():
-        if delete_income_form.select_income != 0:
-            Income.query.filter_by(id=edit_income_form.select_income.data).delete()
+        if delete_income_form.select_income.data != 0:
+            # delete through the session so the change log sees it
+            income = Income.query.filter_by(id=edit_income_form.select_income.data, budget_id=selected_budget()).first()
+            if income is not None:
+                db.session.delete(income)
             db.session.commit()
-            flash(f'Income with Id {edit_income_form.select_income.data} has been deleted')
-            return redirect(url_for('users.edit_budget'))
+            return mutation_done(f'Income with Id {edit_income_form.select_income.data} has been deleted',
+                                 'users.edit_budget')
         else:
             flash('Please select income Id for the income you trying to delete!')
 
     # validate edit income form and apply it to DB
     if edit_income_form.edit_income_submit.data and edit_income_form.validate():
-        if edit_income_form.select_income != 0:
+        if edit_income_form.select_income.data != 0:
             amount_month = IncomeMonth.get_income_month(edit_income_form.pay_period.data, edit_income_form.income_amount_month.data)
-            income = Income.query.filter_by(id=edit_income_form.select_income.data).first()
+            income = Income.query.filter_by(id=edit_income_form.select_income.data, budget_id=selected_budget()).first()
             income.income_amount_month = amount_month
             income.income_description = edit_income_form.income_description.data
             income.income_tax = edit_income_form.income_tax.data
+            income.effective_from = edit_income_form.effective_from.data
+            income.effective_to = edit_income_form.effective_to.data
+            if edit_income_form.currency.data:
+                income.currency = edit_income_form.currency.data
             db.session.commit()
-            flash(f'Income with Id {edit_income_form.select_income.data} has been edited')
-            return redirect(url_for('users.edit_budget'))
+            return mutation_done(f'Income with Id {edit_income_form.select_income.data} has been edited',
+                                 'users.edit_budget')
         else:
             flash('Please select income Id for the income you trying to delete!')
 
     # validate delete expense form and apply it to DB
     if delete_expense_form.expense_delete_submit.data and delete_expense_form.validate():
         if delete_expense_form.select_expense.data != 0:
-            Expenses.query.filter_by(id=delete_expense_form.select_expense.data).delete()
+            expense = Expenses.query.filter_by(id=delete_expense_form.select_expense.data,
+                                               budget_id=selected_budget()).first()
+            if expense is not None:
+                db.session.delete(expense)
             db.session.commit()
-            flash(f'Expense with Id {delete_expense_form.select_expense.data} has been deleted')
-            return redirect(url_for('users.edit_budget'))
+            return mutation_done(f'Expense with Id {delete_expense_form.select_expense.data} has been deleted',
+                                 'users.edit_budget')
         else:
             flash('Please select expense Id for the expense you trying to delete!')
 
     # validate edit expense form and apply it to DB
     if edit_expense_form.edit_expenses_submit.data and edit_expense_form.validate():
         if edit_expense_form.select_expense.data != 0:
-            expense = Expenses.query.filter_by(id=edit_expense_form.select_expense.data).first()
+            expense = Expenses.query.filter_by(id=edit_expense_form.select_expense.data,
+                                               budget_id=selected_budget()).first()
             for field in edit_expense_form:
                 if field.data and field.data != 0 and not str(field.data).isspace() and not str(field.data) == "":
                     setattr(expense, field.name, field.data)
             db.session.commit()
-            flash(f'Expense with Id {edit_expense_form.select_expense.data} has been edited')
-            return redirect(url_for('users.edit_budget'))
+            return mutation_done(f'Expense with Id {edit_expense_form.select_expense.data} has been edited',
+                                 'users.edit_budget')
         else:
             flash('Please select expense Id for the expense you trying to edit!')
 
+    # validate batch expenses form and apply it to DB in one statement
+    if (batch_expense_form.batch_expenses_submit.data or batch_expense_form.batch_expenses_delete.data) \
+            and batch_expense_form.validate():
+        delete = batch_expense_form.batch_expenses_delete.data
+        selection = dict(budget_id=selected_budget(), category=submitted(batch_expense_form.filter_category),
+                         expense_type=submitted(batch_expense_form.filter_type),
+                         date_from=submitted(batch_expense_form.date_from),
+                         date_to=submitted(batch_expense_form.date_to))
+        try:
+            if batch_expense_form.expense_ids.data:
+                selection['ids'] = parse_ids(batch_expense_form.expense_ids.data)
+            changed = batch_expenses(current_user.id, selection,
+                                     dict(category=submitted(batch_expense_form.new_category),
+                                          expense_type=submitted(batch_expense_form.new_type),
+                                          expense_amount=submitted(batch_expense_form.new_amount)), delete=delete)
+            return mutation_done(f'{changed} expenses have been {"deleted" if delete else "edited"}',
+                                 'users.edit_budget')
+        except BatchError as error:
+            flash(str(error))
+
+    # validate batch incomes form and apply it to DB in one statement
+    if (batch_income_form.batch_incomes_submit.data or batch_income_form.batch_incomes_delete.data) \
+            and batch_income_form.validate():
+        delete = batch_income_form.batch_incomes_delete.data
+        try:
+            selection = dict(budget_id=selected_budget(), ids=parse_ids(batch_income_form.income_ids.data))
+            changed = batch_incomes(current_user.id, selection,
+                                    dict(income_amount_month=submitted(batch_income_form.new_income_amount),
+                                         income_tax=submitted(batch_income_form.new_income_tax)), delete=delete)
+            return mutation_done(f'{changed} incomes have been {"deleted" if delete else "edited"}',
+                                 'users.edit_budget')
+        except BatchError as error:
+            flash(str(error))
+
+    # only the latest rows, the page costs the same for a long history
+    latest = current_app.config['EDIT_TABLE_ROWS']
+    income_tab = Deferred(incomes_table, Income.query.filter_by(budget_id=selected_budget()).
+                          order_by(Income.id.desc()).limit(latest))
+    budget_tab = Deferred(budgets_table)
+    expenses_tab = Deferred(expenses_table, Expenses.query.filter_by(budget_id=selected_budget()).
+                            order_by(Expenses.id.desc()).limit(latest))
     return render_template('edit_budget.html', edit_budget_form=edit_budget_form, edit_income_form=edit_income_form,
                            delete_income_form=delete_income_form, edit_expense_form=edit_expense_form,
-                           delete_expense_form=delete_expense_form, expenses_tab=Markup(expenses_tab),
-                           income_tab=Markup(income_tab), budget_tab=Markup(budget_tab))
+                           delete_expense_form=delete_expense_form, batch_expense_form=batch_expense_form,
+                           batch_income_form=batch_income_form, expenses_tab=expenses_tab,
+                           income_tab=income_tab, budget_tab=budget_tab, live_url=live_url())
 
 
 @users.route('/expenses', methods=['GET', 'POST'])
@@ -341,24 +477,104 @@ def expenses_view():
         :return: render expenses_view.html
     """
     expense = None
-    expenses_tab = expenses_table()
     form = ExpenseViewForm()
     form.category.choices = category_choice()
     if form.validate_on_submit():
-        if form.category.data != "" and form.expense_type.data != "":    # when user select category and type
-            expense = Expenses.query.filter_by(budget_id=selected_budget()). \
-                filter_by(category=form.category.data). \
-                filter_by(expense_type=form.expense_type.data).all()
-        elif form.category.data != "":                                      # when user select category only
-            expense = Expenses.query.filter_by(budget_id=selected_budget()). \
-                filter_by(category=form.category.data).all()
-        elif form.expense_type.data != "":                                 # when user select type only
-            expense = Expenses.query.filter_by(budget_id=selected_budget()). \
-                filter_by(expense_type=form.expense_type.data).all()
+        expense = report_expenses(selected_budget(), form.category.data, form.expense_type.data,
+                                  form.include_archived.data)
         expenses_tab = expenses_table(expense)
-        return render_template('expenses_view.html', form=form, expenses_tab=Markup(expenses_tab))
+        return render_template('expenses_view.html', form=form, expenses_tab=Markup(expenses_tab),
+                               export_url=url_for('users.expenses_export', category=form.category.data or None,
+                                                  expense_type=form.expense_type.data or None,
+                                                  archived=1 if form.include_archived.data else None))
+    expenses_tab = expenses_table()
+    return render_template('expenses_view.html', form=form, expenses_tab=Markup(expenses_tab),
+                           export_url=url_for('users.expenses_export'))
 
-    return render_template('expenses_view.html', form=form, expenses_tab=Markup(expenses_tab))
+
+@users.route('/expenses/export')
+@login_required
+def expenses_export():
+    """
+        this method will process the '/expenses/export' view request, the expenses of the selected budget as a
+        csv file, with the same filters as the view expenses page (?category=&expense_type=&archived=1)
+        :return: text/csv response
+    """
+    import csv
+    import io
+    expenses = report_expenses(selected_budget(), request.args.get('category'), request.args.get('expense_type'),
+                               request.args.get('archived') == '1')
+
+    def rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_HEADER)
+        for expense in expenses:
+            writer.writerow(export_row(expense))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    return Response(stream_with_context(rows()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=expenses.csv'})
+
+
+@users.route('/limits', methods=['GET', 'POST'])
+@login_required
+def category_limits():
+    """
+        this method will render the '/limits' view request for the monthly category limits of the selected
+        budget against this month spend
+        :return: render category_limits.html
+    """
+    form = CategoryLimitForm()
+    form.category.choices = category_choice()
+    if form.validate_on_submit():
+        if selected_budget() == 0:
+            flash("Select the budget that you want to set the limits for?")
+        else:
+            set_category_limit(selected_budget(), form.category.data, form.limit.data)
+            if form.limit.data:
+                message = f"The {category_choice(form.category.data)} limit has been set"
+            else:
+                message = f"The {category_choice(form.category.data)} limit has been removed"
+            return mutation_done(message, 'users.category_limits')
+    today = date.today()
+    rows = budget_vs_actual(selected_budget(), today.year, today.month)
+    limits_tab = limits_table(rows)
+    bar = limits_bar(rows)
+    return render_template('category_limits.html', form=form, limits_tab=Markup(limits_tab), bar_div=Markup(bar),
+                           live_url=live_url())
+
+
+@users.route('/scenarios', methods=['GET', 'POST'])
+@login_required
+def scenarios_view():
+    """
+        this method will render the '/scenarios' view request for the what-if projections of the selected
+        budget, the page opens with the default changes of the form
+        :return: render scenarios.html
+    """
+    from budget_aj_app.scenarios import ScenarioError, parse_values, load_baseline, scenario_grid, run_scenarios
+    form = ScenarioForm()
+    result = None
+    summary = ""
+    if request.method == 'GET' or form.validate_on_submit():
+        try:
+            grid = scenario_grid(parse_values(form.raise_pct.data, 'raise %'),
+                                 parse_values(form.tax_change.data, 'tax change'),
+                                 parse_values(form.new_bill.data, 'new monthly bill'),
+                                 parse_values(form.discretionary_change.data, 'spend change %'))
+            started = time.perf_counter()
+            baseline = load_baseline(selected_budget(), current_app.config['SCENARIO_HISTORY_MONTHS'])
+            result = run_scenarios(baseline, grid, form.months.data, form.simulations.data)
+            summary = f"{len(result)} variants x {result.simulations} simulations of {result.months} months " \
+                      f"in {(time.perf_counter() - started) * 1000:.0f} ms"
+        except ScenarioError as error:
+            flash(str(error))
+    scenarios_tab = scenarios_table(result) if result is not None else ""
+    fan = scenarios_fan(result) if result is not None else ""
+    return render_template('scenarios.html', form=form, scenarios_tab=Markup(scenarios_tab), fan_div=Markup(fan),
+                           summary=summary)
 
 
 def create_pie():
@@ -366,33 +582,47 @@ def create_pie():
         this method create the pie plot and return the plot string object
         :return: string of pie plot html object
     """
-    labels = []
-    values = []
-    for key, val in total_expenses_category().items():
-        labels.append(key)
-        values.append(val)
+    totals = total_expenses_category()
+    return pie_chart(list(totals), list(totals.values()))
+
+
+def pie_chart(labels, values):
+    """
+        this method create the pie plot of the month spend by category, the async dashboard summary draws the
+        same plot
+        :param: labels list of category labels
+        :param: values list of amounts
+        :return: string of pie plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
     # pull is given as a fraction of the pie radius
     my_plot_div = plot({"data":[go.Pie(labels=labels, values=values, hole=.3)], # data edit
-                        "layout": go.Layout(margin=dict(t=20, b=20, l=20, r=20))}, output_type='div') # layout edit
+                        "layout": go.Layout(margin=dict(t=20, b=20, l=20, r=20))}, # layout edit
+                       output_type='div', include_plotlyjs=False)  # plotly.js is loaded once by base.html
 
     return my_plot_div
 
 
-
 def create_bar():
     """
         this method create the bar plot and return the plot string object for total monthly income and expenses
         :return: string of bar plot html object
     """
-    expenses_bars = []
-    months = []
-    income_bars = []
-    total_income = Income.query.with_entities(func.sum(Income.income_amount_month)). \
-        filter_by(budget_id=selected_budget()).first()  # query total income for the specified budget
-    for i in total_expenses_month(): # call total monthly expenses method
-        expenses_bars.append(i[0])
-        income_bars.append(total_income[0])
-        months.append(f"{i[1]}-{i[2]}")
+    return bar_chart(*monthly_bars(selected_budget()))
+
+
+def bar_chart(months, income_bars, expenses_bars):
+    """
+        this method create the bar plot of the total income next to the total spend of every month, the async
+        dashboard summary draws the same plot
+        :param: months list of month labels
+        :param: income_bars list of income amounts
+        :param: expenses_bars list of spend amounts
+        :return: string of bar plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
     fig = plot({"data":
         [go.Bar(
             x=months,
@@ -405,16 +635,34 @@ def create_bar():
                 y=expenses_bars,
                 name='Total Spend',
                 marker_color='red'
-            )], "layout": go.Layout(margin=dict(t=30, b=20, l=50, r=50))}, output_type='div')
+            )], "layout": go.Layout(margin=dict(t=30, b=20, l=50, r=50))}, output_type='div', include_plotlyjs=False)
     return fig
 
 
+def summary_charts(summary):
+    """
+        this method will draw the pie and bar plots of a dashboard summary
+        :param: summary dict returned by reads.dashboard_summary()
+        :return: tuple of (pie, bar) plot html objects
+    """
+    if summary['categories']:
+        pie = pie_chart([row['label'] for row in summary['categories']],
+                        [from_cents(row['spent_cents']) for row in summary['categories']])
+    else:
+        pie = pie_chart(list(EXAMPLE_CATEGORY_TOTALS), list(EXAMPLE_CATEGORY_TOTALS.values()))
+    bar = bar_chart(summary['months'], [from_cents(cents) for cents in summary['income_cents']],
+                    [from_cents(cents) for cents in summary['expenses_cents']])
+    return pie, bar
+
+
 def budgets_table():
     """
         this method create the table plot and return the plot string object for budgets available
         :return: string of table plot html object
     """
-    budgets = Budget.query.filter_by(user_id=current_user.id).all()  # query all budget for user
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    budgets = Budget.active().filter_by(user_id=current_user.id).all()  # query all budget for user
     budget_description = []
     budget_name = []
     budget_selected = []
@@ -438,40 +686,228 @@ def budgets_table():
                                          align='center'))],
                 "layout":
                     go.Layout(title="hello world")}
-               , output_type='div')
+               , output_type='div', include_plotlyjs=False)
     return fig
 
 
-def incomes_table():
+def budgets_overview_table(overview):
     """
-        this method create the table plot and return the plot string object for all income available on budget
+        this method create the table plot and return the plot string object for the totals of all user budgets
+        :param: overview list of rows returned by budgets_overview_data()
+        :return: string of table plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    budget_selected = []
+    budget_name = []
+    income = []
+    net_income = []
+    month_spend = []
+    savings_rate = []
+    current = selected_budget()
+    for row in overview:
+        budget_selected.append("*" if row.budget_id == current else "")
+        budget_name.append(row.budget_name)
+        income.append(round(row.income, 2))
+        net_income.append(round(row.net_income, 2))
+        month_spend.append(round(row.month_spend, 2))
+        savings_rate.append("" if row.savings_rate is None else f"{row.savings_rate:.1f}%")
+    fig = plot({"data":[go.Table(columnorder=[1, 2, 3, 4, 5, 6],
+                                 columnwidth=[25, 60, 45, 45, 45, 40],
+                                 header=dict(values=['Selected', 'Budget Name', 'Income', 'Income After Tax',
+                                                     'Spend This Month', 'Savings Rate'],
+                                             fill_color='#39ace7',
+                                             font=dict(color='white', size=12),
+                                             align='center'),
+                                 cells=dict(values=[budget_selected, budget_name, income, net_income, month_spend,
+                                                    savings_rate],
+                                            fill_color='lightcyan',
+                                            align='center'))],
+                "layout":go.Layout(margin=dict(t=50, l=25, r=25, b=50))}, output_type='div', include_plotlyjs=False)
+    return fig
+
+
+def budgets_overview_bar(overview):
+    """
+        this method create the bar plot and return the plot string object for income after tax against
+        the current month spend of every user budget
+        :param: overview list of rows returned by budgets_overview_data()
+        :return: string of bar plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    names = [row.budget_name for row in overview]
+    fig = plot({"data":
+        [go.Bar(
+            x=names,
+            y=[row.net_income for row in overview],
+            name='Income After Tax',
+            marker_color='#5fbae9'
+        ),
+            go.Bar(
+                x=names,
+                y=[row.month_spend for row in overview],
+                name='Spend This Month',
+                marker_color='red'
+            )], "layout": go.Layout(margin=dict(t=30, b=20, l=50, r=50))}, output_type='div', include_plotlyjs=False)
+    return fig
+
+
+def limits_table(rows):
+    """
+        this method create the table plot and return the plot string object for the category limits against
+        this month spend, the categories over their limit are highlighted
+        :param: rows dict returned by budget_vs_actual()
         :return: string of table plot html object
     """
-    incomes = Income.query.filter_by(budget_id=selected_budget()).all()  # query all incomes for specified budget
-    income_id = []
-    income_description = []
-    amount_before = []
-    amount_after = []
-    income_tax = []
-    if incomes:
-        for income in incomes:
-            income_id.append(income.id)
-            income_description.append(income.income_description)
-            amount_before.append(round(income.income_amount_month, 2))
-            amount_after.append(round(income.income_amount_month - income.income_amount_month *
-                                      (income.income_tax / 100), 2))
-            income_tax.append(income.income_tax)
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    category, limit, spent, left, used, colors = [], [], [], [], [], []
+    for key, label in category_choice():
+        row = rows.get(key)
+        if row is None:
+            continue
+        category.append(label)
+        limit.append("" if row.limit_cents is None else from_cents(row.limit_cents))
+        spent.append(from_cents(row.spent_cents))
+        left.append("" if row.left_cents is None else from_cents(row.left_cents))
+        used.append("" if row.used_percent is None else f"{row.used_percent}%")
+        colors.append('#f8d7da' if row.over_limit_since is not None else 'lightcyan')
     fig = plot({"data":[go.Table(columnorder=[1, 2, 3, 4, 5],
-                                 columnwidth=[35, 60, 55, 25, 80],
+                                 columnwidth=[60, 40, 40, 40, 30],
+                                 header=dict(values=['Category', 'Monthly Limit', 'Spent This Month', 'Left',
+                                                     'Used'],
+                                             fill_color='#39ace7',
+                                             font=dict(color='white', size=12),
+                                             align='center'),
+                                 cells=dict(values=[category, limit, spent, left, used],
+                                            fill_color=[colors],
+                                            align='center'))],
+                "layout":go.Layout(margin=dict(t=50, l=30, r=30, b=50))}, output_type='div', include_plotlyjs=False)
+    return fig
+
+
+def limits_bar(rows):
+    """
+        this method create the bar plot and return the plot string object for the limit against this month
+        spend of every category that has a limit
+        :param: rows dict returned by budget_vs_actual()
+        :return: string of bar plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    limited = [(label, rows[key]) for key, label in category_choice() if key in rows and rows[key].limit_cents]
+    names = [label for label, _ in limited]
+    fig = plot({"data":
+        [go.Bar(
+            x=names,
+            y=[from_cents(row.limit_cents) for _, row in limited],
+            name='Monthly Limit',
+            marker_color='#5fbae9'
+        ),
+            go.Bar(
+                x=names,
+                y=[from_cents(row.spent_cents) for _, row in limited],
+                name='Spent This Month',
+                marker_color=['red' if row.over_limit_since is not None else 'orange' for _, row in limited]
+            )], "layout": go.Layout(margin=dict(t=30, b=20, l=50, r=50))}, output_type='div', include_plotlyjs=False)
+    return fig
+
+
+def scenarios_table(result, rows=25):
+    """
+        this method create the table plot and return the plot string object for the best scenario variants,
+        the variant without changes is always listed
+        :param: result ScenarioResult returned by scenarios.run_scenarios()
+        :param: rows number of variants to list
+        :return: string of table plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    listed = [int(index) for index in result.ranked()[:rows]]
+    baseline = result.baseline_index()
+    if baseline is not None and baseline not in listed:
+        listed.append(baseline)
+
+    def money(cents):
+        return round(float(cents) / 100, 2)
+
+    values = [[f"{result.raise_pct[i]:g}%" for i in listed],
+              [f"{result.tax_change[i]:+g}" for i in listed],
+              [f"{result.new_bill[i]:g}" for i in listed],
+              [f"{result.discretionary_change[i]:+g}%" for i in listed],
+              [money(result.monthly_balance[i]) for i in listed],
+              [money(result.savings[0, i, -1]) for i in listed],
+              [money(result.savings[1, i, -1]) for i in listed],
+              [money(result.savings[2, i, -1]) for i in listed],
+              [f"{result.shortfall[i] * 100:.1f}%" for i in listed]]
+    colors = ['#fff3cd' if i == baseline else 'lightcyan' for i in listed]
+    fig = plot({"data":[go.Table(columnorder=list(range(1, 10)),
+                                 columnwidth=[30, 30, 35, 35, 45, 45, 45, 45, 35],
+                                 header=dict(values=['Raise', 'Tax', 'New Bill', 'Spend', 'Balance / Month',
+                                                     'Savings P10', 'Savings P50', 'Savings P90', 'Shortfall'],
+                                             fill_color='#39ace7',
+                                             font=dict(color='white', size=12),
+                                             align='center'),
+                                 cells=dict(values=values,
+                                            fill_color=[colors],
+                                            align='center'))],
+                "layout":go.Layout(margin=dict(t=50, l=25, r=25, b=50))}, output_type='div', include_plotlyjs=False)
+    return fig
+
+
+def scenarios_fan(result):
+    """
+        this method create the line plot and return the plot string object for the projected savings of the best
+        variant and of the variant without changes, the band is the 10th to the 90th percentile
+        :param: result ScenarioResult returned by scenarios.run_scenarios()
+        :return: string of line plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    months = [f"Month {month}" for month in range(1, result.months + 1)]
+    shown = [(int(result.ranked()[0]), 'Best', '#39ace7', 'rgba(57, 172, 231, 0.2)')]
+    baseline = result.baseline_index()
+    if baseline is not None and baseline != shown[0][0]:
+        shown.append((baseline, 'No Change', 'red', 'rgba(255, 0, 0, 0.1)'))
+    data = []
+    for index, name, color, band in shown:
+        low, median, high = (list(result.savings[p, index] / 100) for p in range(3))
+        data.append(go.Scatter(x=months, y=low, line=dict(width=0), showlegend=False, hoverinfo='skip'))
+        data.append(go.Scatter(x=months, y=high, fill='tonexty', fillcolor=band, line=dict(width=0),
+                               name=f"{name} P10-P90"))
+        data.append(go.Scatter(x=months, y=median, line=dict(color=color), name=f"{name} Median"))
+    fig = plot({"data": data, "layout": go.Layout(margin=dict(t=30, b=20, l=50, r=50))}, output_type='div',
+               include_plotlyjs=False)
+    return fig
+
+
+def incomes_table(income_data=None):
+    """
+        this method create the table plot and return the plot string object for all income available on budget
+        :param: income_data optional list of incomes to show instead
+        :return: string of table plot html object
+    """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
+    if income_data is not None:
+        incomes = income_data
+    else:
+        incomes = Income.query.filter_by(budget_id=selected_budget()).all()  # query all incomes for specified budget
+    income_id, amount_before, amount_after, income_tax, income_description, effective = \
+        table_columns([income_table_row(income) for income in incomes], 6)
+    fig = plot({"data":[go.Table(columnorder=[1, 2, 3, 4, 5, 6],
+                                 columnwidth=[35, 60, 55, 25, 80, 70],
                                  header=dict(values=['Income Id', 'Amount Before Tax', 'Amount After Tax', 'Tax %',
-                                                     'Income Description'],
+                                                     'Income Description', 'Effective'],
                                              fill_color='#39ace7',
                                              font=dict(color='white', size=12),
                                              align='center'),
-                                 cells=dict(values=[income_id, amount_before, amount_after, income_tax, income_description],
+                                 cells=dict(values=[income_id, amount_before, amount_after, income_tax, income_description,
+                                                    effective],
                                             fill_color='lightcyan',
                                             align='center'))],
-                "layout":go.Layout(margin=dict(t=50, l=30, r=30, b=50))}, output_type='div')
+                "layout":go.Layout(margin=dict(t=50, l=30, r=30, b=50))}, output_type='div', include_plotlyjs=False)
     return fig
 
 
@@ -481,25 +917,15 @@ def expenses_table(expense_data=None):
         :param: expense_data optional query object if the user requires specific data
         :return: string of table plot html object
     """
+    from plotly.offline import plot
+    import plotly.graph_objects as go
     if expense_data is not None:
         expenses = expense_data  # user option
     else:
         expenses = Expenses.query.filter_by(budget_id=selected_budget()).all() # query all expenses for specified budget
-    id = []
-    expenses_description = []
-    categories = []
-    expenses_amount = []
-    transaction_dates = []
-    due_dates_list = []
-    reports = []
-    if expenses:
-        for expense in expenses:
-            id.append(expense.id)
-            expenses_description.append(expense.expense_description)
-            categories.append(category_choice(expense.category))
-            expenses_amount.append(round(expense.expense_amount, 2))
-            transaction_dates.append(expense.transaction_date.strftime('%m/%d/%Y'))
-            reports.append(due_dates(expense.due_date))
+    # one list per column
+    id, categories, expenses_description, expenses_amount, transaction_dates, reports = \
+        table_columns([expense_table_row(expense) for expense in expenses], 6)
     fig = plot({"data":[go.Table(columnorder=[1, 2, 3, 4, 5, 6],
                                  columnwidth=[25, 40, 60, 35, 65, 90],
                                  header=dict(values=['ID', 'Category', 'Description', 'Amount', 'Transaction/Due-Date', 'Reports'],
@@ -511,10 +937,53 @@ def expenses_table(expense_data=None):
                                                     reports],
                                             fill_color='lightcyan',
                                             align='center'))],
-                "layout":go.Layout(margin=dict(t=50, l=25, r=25, b=50))}, output_type='div')
+                "layout":go.Layout(margin=dict(t=50, l=25, r=25, b=50))}, output_type='div', include_plotlyjs=False)
     return fig
 
 
+def expense_table_row(expense):
+    """
+        this method will return one row of the expenses table, the live updates send the same rows
+        :param: expense Expenses object
+        :return: list of (id, category, description, amount, transaction date, report)
+    """
+    return [expense.id, category_choice(expense.category), expense.expense_description,
+            shown_amount(expense.expense_money), expense.transaction_date.strftime('%m/%d/%Y'),
+            due_dates(expense.due_date)]
+
+
+def income_table_row(income):
+    """
+        this method will return one row of the incomes table, the live updates send the same rows
+        :param: income Income object
+        :return: list of (id, amount before tax, amount after tax, tax %, description, effective dates)
+    """
+    start = income.effective_from.strftime('%Y-%m-%d') if income.effective_from else '...'
+    end = income.effective_to.strftime('%Y-%m-%d') if income.effective_to else '...'
+    return [income.id, shown_amount(income.income_money),
+            shown_amount(income.income_money._replace(cents=income.income_after_tax_cents)), income.income_tax,
+            income.income_description, f"{start} to {end}"]
+
+
+def shown_amount(money):
+    """
+        this method will return an amount of a table row, with its currency when it isn't the default one
+        :param: money Money of the row
+        :return: Decimal amount or string of the amount and the currency
+    """
+    return money.amount if money.currency == DEFAULT_CURRENCY else str(money)
+
+
+def table_columns(rows, count):
+    """
+        this method will turn table rows into the column lists plotly tables take
+        :param: rows list of rows
+        :param: count number of columns
+        :return: list of column lists
+    """
+    return [list(column) for column in zip(*rows)] if rows else [[] for _ in range(count)]
+
+
 def due_dates(due_day):
     """
         this method will receive the due date as a parameter and return the reminder report if it
@@ -561,6 +1030,25 @@ def selected_budget(select=None):
         return 0
 
 
+def budget_currency():
+    """
+        This method will return the currency of the selected budget
+        : return: currency code, the default currency when no budget is selected
+    """
+    currency = Budget.query.with_entities(Budget.currency).filter_by(id=selected_budget()).scalar()
+    return currency or DEFAULT_CURRENCY
+
+
+def currency_choice(first=DEFAULT_CURRENCY):
+    """
+        This method will return the currencies of the active exchange rates as select field choices
+        : param: first currency code listed first, the default of the field
+        : return: list of (code, code) tuples
+    """
+    codes = [first] + [code for code in rate_cache().known_currencies() if code != first]
+    return [(code, code) for code in codes]
+
+
 def category_choice(choice=None):
     """
         This method will receive one optional parameter from the specified choice string and return the user selection
@@ -582,46 +1070,231 @@ def category_choice(choice=None):
         return choices
 
 
+# shown in the pie while the budget has no expenses this month
+EXAMPLE_CATEGORY_TOTALS = {"ex1": 5, 'ex2': 10, 'ex3': 3}
+
+
+def report_expenses(budget_id, category=None, expense_type=None, include_archived=False):
+    """
+        This method will return the expenses of a budget for the view expenses page and the csv export
+        : param: budget_id integer budget id
+        : param: category optional category key
+        : param: expense_type optional expense type
+        : param: include_archived True to add the expenses of the archived months
+        : return: list of Expenses (and ArchivedExpense) ordered by transaction date
+    """
+    query = Expenses.query.filter_by(budget_id=budget_id)
+    if category:
+        query = query.filter_by(category=category)
+    if expense_type:
+        query = query.filter_by(expense_type=expense_type)
+    expenses = query.order_by(Expenses.transaction_date, Expenses.id).all()
+    if include_archived:
+        expenses = sorted(archived_expenses(budget_id, category or None, expense_type or None) + expenses,
+                          key=lambda expense: expense.transaction_date)
+    return expenses
+
+
 def total_expenses_category():
     """
         This method will create a query for total expenses divided by category for
         one month and return if it's available and return example of data if it's not
         : return:  all available expense in the specified  budget if it's available or example data if it's not
     """
-    total_category = {}
-    for cat in category_choice():
-        expenses = Expenses.query.with_entities(func.sum(Expenses.expense_amount).label('expenses_by_cat')). \
-            filter(Expenses.budget_id == selected_budget()).filter(Expenses.category == cat[0]). \
-            filter(extract('year', Expenses.transaction_date) == datetime.now().year,
-                   extract('month', Expenses.transaction_date) == datetime.now().month).first()
-        if expenses[0]:
-            total_category[cat[1]] = expenses[0]
+    total_category = category_totals(selected_budget())
     if len(total_category) > 0:
         return total_category
     else:
-        return {"ex1": 5, 'ex2': 10, 'ex3': 3}
+        return dict(EXAMPLE_CATEGORY_TOTALS)
+
+
+def category_totals(budget_id, categories=None):
+    """
+        This method will read the current month spend of a budget by category from the spend rollup
+        : param: budget_id integer budget id
+        : param: categories optional list of category keys to limit the totals to
+        : return: dict of category label -> total amount in the budget currency of the categories that have
+                  expenses
+    """
+    today = date.today()
+    conversion = Conversion(CategorySpend.currency, Budget.currency, CategorySpend.year, CategorySpend.month)
+    query = conversion.join_query(
+        db.session.query(CategorySpend.category, func.sum(conversion.cents(CategorySpend.spent_cents))).
+        join(Budget, Budget.id == CategorySpend.budget_id)). \
+        filter(CategorySpend.budget_id == budget_id, CategorySpend.year == today.year,
+               CategorySpend.month == today.month)
+    if categories is not None:
+        query = query.filter(CategorySpend.category.in_(categories))
+    totals = dict(query.group_by(CategorySpend.category).all())
+    return {label: from_cents(totals[key]) for key, label in category_choice() if totals.get(key)}
+
+
+def monthly_bars(budget_id):
+    """
+        This method will return the series of the monthly bar chart, the income that counts in every month
+        (by the income effective dates) next to the spend of the month, of the given budget only
+        : param: budget_id integer budget id
+        : return: tuple of lists (months, income bars, expenses bars)
+    """
+    series = budget_series(db.session, budget_id)
+    return ([totals.label for totals in series], [from_cents(totals.income_cents) for totals in series],
+            [from_cents(totals.spent_cents) for totals in series])
+
+
+class BudgetOverview(object):
+    """
+        one row of the all budgets overview
+    """
+    __slots__ = ('budget_id', 'budget_name', 'income', 'net_income', 'month_spend', 'savings_rate')
+
+    def __init__(self, budget_id, budget_name, income_cents, net_income_cents, month_spend_cents):
+        self.budget_id = budget_id
+        self.budget_name = budget_name
+        self.income = from_cents(income_cents)
+        self.net_income = from_cents(net_income_cents)
+        self.month_spend = from_cents(month_spend_cents)
+        # savings rate is the part of the income after tax that is left after this month spend
+        if self.net_income:
+            self.savings_rate = (self.net_income - self.month_spend) / self.net_income * 100
+        else:
+            self.savings_rate = None
 
 
-def total_expenses_month():
+def budgets_overview_data():
     """
-        This method will create a query for total expenses in specified month and year
-        : return: query object for total expenses in specified month and year
+        This method will create one grouped query for the income, income after tax and current month spend of
+        every budget of the current user, the incomes are the ones that count in the current month
+        : return: list of BudgetOverview rows ordered by budget id, amounts in the currency of every budget
     """
-    mendObj = Expenses.query.with_entities(func.sum(Expenses.expense_amount).label('Amount'),
-                                           extract('year', Expenses.transaction_date),
-                                           extract('month', Expenses.transaction_date)). \
-        group_by(extract('year', Expenses.transaction_date),
-                 extract('month', Expenses.transaction_date)).all()
-    return mendObj
+    month_start = date.today().replace(day=1)
+    # income after tax is summed as cents * (10000 - tax basis points) and divided once at the end
+    conversion = Conversion(Income.currency, Budget.currency, month_start.year, month_start.month)
+    income = conversion.cents(Income.income_amount_month_cents)
+    incomes = conversion.join_query(
+        db.session.query(Income.budget_id.label('budget_id'), func.sum(income).label('income'),
+                         func.sum(income * (10000 - Income.income_tax_bp)).label('net_income')).
+        join(Budget, Budget.id == Income.budget_id)).filter(Budget.user_id == current_user.id). \
+        filter(income_in_month(month_start.year, month_start.month)). \
+        group_by(Income.budget_id).subquery()
+    conversion = Conversion(CategorySpend.currency, Budget.currency, CategorySpend.year, CategorySpend.month)
+    spend = conversion.join_query(
+        db.session.query(CategorySpend.budget_id.label('budget_id'),
+                         func.sum(conversion.cents(CategorySpend.spent_cents)).label('month_spend')).
+        join(Budget, Budget.id == CategorySpend.budget_id)).filter(Budget.user_id == current_user.id). \
+        filter(CategorySpend.year == month_start.year, CategorySpend.month == month_start.month). \
+        group_by(CategorySpend.budget_id).subquery()
+    rows = db.session.query(Budget.id, Budget.budget_name, incomes.c.income, incomes.c.net_income,
+                            spend.c.month_spend). \
+        outerjoin(incomes, incomes.c.budget_id == Budget.id). \
+        outerjoin(spend, spend.c.budget_id == Budget.id). \
+        filter(Budget.user_id == current_user.id, Budget.deleted_at.is_(None)).order_by(Budget.id).all()
+    return [BudgetOverview(budget_id, name, income, ((net_income or 0) + 5000) // 10000, spend)
+            for budget_id, name, income, net_income, spend in rows]
 
 
 def budget_deleter():
     """
-       This method will delete the current budget and clear the data connected to this budget
+       This method will delete the current budget, the budget is hidden right away and the data connected
+       to this budget is cleared by the background purge
     """
-    Budget.query.filter_by(id=selected_budget()).delete()
-    Income.query.filter_by(budget_id=selected_budget()).delete()
-    Expenses.query.filter_by(budget_id=selected_budget()).delete()
     select_user = UserSelect.query.filter_by(user_id=current_user.id).first()
+    budget = Budget.active().filter_by(id=select_user.selected_budget_id, user_id=current_user.id).first()
     select_user.selected_budget_id = 0
+    if budget is not None:
+        budget.deleted_at = datetime.utcnow()
     db.session.commit()
+    if budget is not None:
+        schedule_purge(budget.id)
+
+
+def mutation_done(message, endpoint):
+    """
+        This method will answer a successful add, edit or delete post. the pages post their forms in the
+        background (X-Requested-With: XMLHttpRequest) and get the message back as json, the open dashboards
+        pick up the change from the live stream. a normal post is redirected like before
+        : param: message string shown to the user
+        : param: endpoint string endpoint to redirect to
+        : return: json response or redirect
+    """
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify(message=message)
+    flash(message)
+    return redirect(url_for(endpoint))
+
+
+def submitted(field):
+    """
+        This method will return the value of an optional form field
+        : param: field wtforms field
+        : return: the field data or None when the field was left empty
+    """
+    if not field.raw_data or field.raw_data[0] in ('', None):
+        return None
+    return field.data
+
+
+def live_url():
+    """
+        This method will return the live stream url of the selected budget for the page to listen to
+        : return: url string or None when no budget is selected
+    """
+    budget_id = selected_budget()
+    return url_for('users.budget_live', budget_id=budget_id) if budget_id else None
+
+
+def live_value(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def budget_deltas(budget_id, message):
+    """
+        This method will turn a change message of the budget into the chart updates the dashboard applies
+        : param: budget_id integer budget id
+        : param: message dict published by live.publish_live_changes
+        : return: generator of (event name, data)
+    """
+    if message.get('reload') or message.get('deleted'):
+        yield 'reload', {}
+        return
+    for model, row, name in ((Expenses, expense_table_row, 'expenses'), (Income, income_table_row, 'incomes')):
+        if message[name]:
+            changed = model.query.filter(model.budget_id == budget_id, model.id.in_(message[name])).all()
+            yield name, {'rows': [[live_value(value) for value in row(obj)] for obj in changed]}
+        if message[f'deleted_{name}']:
+            yield f'{name}-deleted', {'ids': message[f'deleted_{name}']}
+    if message['categories']:
+        totals = category_totals(budget_id, message['categories'])
+        # categories left without expenses are sent as 0 so the pie drops them
+        labels = [category_choice(category) for category in message['categories']]
+        yield 'categories', {'totals': {label: float(totals.get(label, 0)) for label in labels},
+                             'examples': list(EXAMPLE_CATEGORY_TOTALS)}
+    if message.get('alerts'):
+        yield 'alerts', {'messages': [f"{category_choice(alert['category'])} is over its limit for "
+                                      f"{alert['year']}-{alert['month']:02d}: {from_cents(alert['spent_cents'])} "
+                                      f"of {from_cents(alert['limit_cents'])}" for alert in message['alerts']]}
+    if message['totals']:
+        months, income_bars, expenses_bars = monthly_bars(budget_id)
+        yield 'months', {'months': months, 'income': [live_value(value) for value in income_bars],
+                         'spend': [live_value(value) for value in expenses_bars]}
+
+
+def budget_events(budget_id):
+    """
+        This method will wait for the changes of a budget and yield them as server-sent events
+        : param: budget_id integer budget id
+        : return: generator of event strings
+    """
+    keepalive = current_app.config['LIVE_KEEPALIVE']
+    # the stream ends after LIVE_STREAM_SECONDS to give its worker thread back, the browser reconnects after
+    # the retry delay
+    closes = time.monotonic() + current_app.config['LIVE_STREAM_SECONDS']
+    with broker().subscribe(budget_channel(budget_id, current_shard())) as subscription:
+        yield f"retry: {current_app.config['LIVE_RETRY_MS']}\n\n"
+        while time.monotonic() < closes:
+            message = subscription.get(timeout=min(keepalive, max(closes - time.monotonic(), 0)))
+            if message is None:
+                yield ": keepalive\n\n"  # a comment line, it also finds out when the page was closed
+                continue
+            for event_name, data in budget_deltas(budget_id, message):
+                yield sse(event_name, data)
+            db.session.rollback()  # end the read transaction, the next change must see fresh data
@@ -79,6 +79,10 @@ def run_migrations_online():
     )
 
     with connectable.connect() as connection:
+        # the app turns sqlite foreign keys on for every connection, batch migrations recreate
+        # tables and would cascade deletes into the child tables, so turn them off while migrating
+        if connection.dialect.name == 'sqlite':
+            connection.execute('PRAGMA foreign_keys=OFF')
         context.configure(
             connection=connection,
             target_metadata=target_metadata,
@@ -0,0 +1,27 @@
+"""budget soft delete
+
+Revision ID: 3f1c2a7d9b10
+Revises: da4499a8d4e3
+Create Date: 2026-10-19 09:12:41.118302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b10'
+down_revision = 'da4499a8d4e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('budget', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_budget_deleted_at'), 'budget', ['deleted_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_budget_deleted_at'), table_name='budget')
+    with op.batch_alter_table('budget') as batch_op:
+        batch_op.drop_column('deleted_at')
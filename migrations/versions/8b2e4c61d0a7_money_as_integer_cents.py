@@ -0,0 +1,53 @@
+"""money as integer cents
+
+Revision ID: 8b2e4c61d0a7
+Revises: 3f1c2a7d9b10
+Create Date: 2026-10-19 10:03:15.402871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4c61d0a7'
+down_revision = '3f1c2a7d9b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('income', sa.Column('income_amount_month_cents', sa.BigInteger(), nullable=False, server_default='0'))
+    op.add_column('income', sa.Column('income_tax_bp', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('income', sa.Column('currency', sa.String(length=3), nullable=False, server_default='USD'))
+    op.add_column('expenses', sa.Column('expense_amount_cents', sa.BigInteger(), nullable=False, server_default='0'))
+    op.add_column('expenses', sa.Column('currency', sa.String(length=3), nullable=False, server_default='USD'))
+
+    # convert the existing float amounts, rounded half away from zero to the cent
+    op.execute("UPDATE income SET income_amount_month_cents = CAST(ROUND(income_amount_month * 100) AS BIGINT), "
+               "income_tax_bp = CAST(ROUND(COALESCE(income_tax, 0) * 100) AS INTEGER)")
+    op.execute("UPDATE expenses SET expense_amount_cents = CAST(ROUND(expense_amount * 100) AS BIGINT)")
+
+    with op.batch_alter_table('income') as batch_op:
+        batch_op.drop_column('income_amount_month')
+        batch_op.drop_column('income_tax')
+    with op.batch_alter_table('expenses') as batch_op:
+        batch_op.drop_column('expense_amount')
+
+
+def downgrade():
+    op.add_column('income', sa.Column('income_amount_month', sa.Float(), nullable=False, server_default='0'))
+    op.add_column('income', sa.Column('income_tax', sa.Float(), nullable=True))
+    op.add_column('expenses', sa.Column('expense_amount', sa.Float(), nullable=False, server_default='0'))
+
+    op.execute("UPDATE income SET income_amount_month = income_amount_month_cents / 100.0, "
+               "income_tax = income_tax_bp / 100.0")
+    op.execute("UPDATE expenses SET expense_amount = expense_amount_cents / 100.0")
+
+    with op.batch_alter_table('income') as batch_op:
+        batch_op.drop_column('income_amount_month_cents')
+        batch_op.drop_column('income_tax_bp')
+        batch_op.drop_column('currency')
+    with op.batch_alter_table('expenses') as batch_op:
+        batch_op.drop_column('expense_amount_cents')
+        batch_op.drop_column('currency')
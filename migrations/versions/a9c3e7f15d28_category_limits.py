@@ -0,0 +1,56 @@
+"""category limits and spend rollup
+
+Revision ID: a9c3e7f15d28
+Revises: f2a6c9d4e871
+Create Date: 2026-10-19 17:02:45.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3e7f15d28'
+down_revision = 'f2a6c9d4e871'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('category_limit',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('budget_id', sa.Integer(), nullable=False),
+                    sa.Column('category', sa.String(length=64), nullable=False),
+                    sa.Column('limit_cents', sa.BigInteger(), nullable=False),
+                    sa.ForeignKeyConstraint(['budget_id'], ['budget.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('budget_id', 'category')
+                    )
+    spend = op.create_table('category_spend',
+                            sa.Column('id', sa.Integer(), nullable=False),
+                            sa.Column('budget_id', sa.Integer(), nullable=False),
+                            sa.Column('year', sa.Integer(), nullable=False),
+                            sa.Column('month', sa.Integer(), nullable=False),
+                            sa.Column('category', sa.String(length=64), nullable=False),
+                            sa.Column('spent_cents', sa.BigInteger(), nullable=False),
+                            sa.Column('expense_count', sa.Integer(), nullable=False),
+                            sa.Column('over_limit_since', sa.DateTime(), nullable=True),
+                            sa.ForeignKeyConstraint(['budget_id'], ['budget.id'], ondelete='CASCADE'),
+                            sa.PrimaryKeyConstraint('id'),
+                            sa.UniqueConstraint('budget_id', 'year', 'month', 'category')
+                            )
+    # the rollup starts from the existing expenses, there are no limits yet so nothing is over
+    expenses = sa.table('expenses', sa.column('budget_id', sa.Integer), sa.column('category', sa.String),
+                        sa.column('expense_amount_cents', sa.BigInteger), sa.column('transaction_date', sa.DateTime))
+    year = sa.extract('year', expenses.c.transaction_date)
+    month = sa.extract('month', expenses.c.transaction_date)
+    totals = sa.select([expenses.c.budget_id, year, month, expenses.c.category,
+                        sa.func.sum(expenses.c.expense_amount_cents), sa.func.count()]). \
+        group_by(expenses.c.budget_id, year, month, expenses.c.category)
+    op.get_bind().execute(spend.insert().from_select(
+        ['budget_id', 'year', 'month', 'category', 'spent_cents', 'expense_count'], totals))
+
+
+def downgrade():
+    op.drop_table('category_spend')
+    op.drop_table('category_limit')
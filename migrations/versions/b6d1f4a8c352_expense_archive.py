@@ -0,0 +1,38 @@
+"""expense archive
+
+Revision ID: b6d1f4a8c352
+Revises: a9c3e7f15d28
+Create Date: 2026-10-19 18:20:07.540913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6d1f4a8c352'
+down_revision = 'a9c3e7f15d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('expense_archive',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('budget_id', sa.Integer(), nullable=False),
+                    sa.Column('year', sa.Integer(), nullable=False),
+                    sa.Column('month', sa.Integer(), nullable=False),
+                    sa.Column('expense_count', sa.Integer(), nullable=False),
+                    sa.Column('total_cents', sa.BigInteger(), nullable=False),
+                    sa.Column('archive_format', sa.Integer(), nullable=False),
+                    sa.Column('data', sa.LargeBinary(), nullable=False),
+                    sa.Column('archived_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['budget_id'], ['budget.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('budget_id', 'year', 'month')
+                    )
+
+
+def downgrade():
+    # restore the archived months first (flask archive restore), their expenses are only in this table
+    op.drop_table('expense_archive')
@@ -0,0 +1,74 @@
+"""change log per user versions
+
+Revision ID: b7e3d9f1a264
+Revises: e9f4a2c7b581
+Create Date: 2026-10-20 10:12:37.481920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3d9f1a264'
+down_revision = 'e9f4a2c7b581'
+branch_labels = None
+depends_on = None
+
+LOG_COLUMNS = ('user_id', 'budget_id', 'table_name', 'row_id', 'operation', 'changed_at')
+
+
+def replace_log_table(per_user, rows):
+    # the version column changes from the primary key to a per user counter, the table is copied into a new one
+    op.drop_index('ix_change_log_user_version', table_name='change_log')
+    if per_user:
+        op.create_table('change_log_new',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('version', sa.Integer(), nullable=False),
+                        sa.Column('user_id', sa.Integer(), nullable=False),
+                        sa.Column('budget_id', sa.Integer(), nullable=True),
+                        sa.Column('table_name', sa.String(length=32), nullable=False),
+                        sa.Column('row_id', sa.Integer(), nullable=False),
+                        sa.Column('operation', sa.String(length=1), nullable=False),
+                        sa.Column('changed_at', sa.DateTime(), nullable=False),
+                        sa.PrimaryKeyConstraint('id')
+                        )
+        op.execute(f"INSERT INTO change_log_new (id, version, {', '.join(LOG_COLUMNS)}) {rows}")
+    else:
+        op.create_table('change_log_new',
+                        sa.Column('version', sa.Integer(), nullable=False),
+                        sa.Column('user_id', sa.Integer(), nullable=True),
+                        sa.Column('budget_id', sa.Integer(), nullable=True),
+                        sa.Column('table_name', sa.String(length=32), nullable=False),
+                        sa.Column('row_id', sa.Integer(), nullable=False),
+                        sa.Column('operation', sa.String(length=1), nullable=False),
+                        sa.Column('changed_at', sa.DateTime(), nullable=False),
+                        sa.PrimaryKeyConstraint('version'),
+                        sqlite_autoincrement=True
+                        )
+        op.execute(f"INSERT INTO change_log_new (version, {', '.join(LOG_COLUMNS)}) {rows}")
+    op.drop_table('change_log')
+    op.rename_table('change_log_new', 'change_log')
+    op.create_index('ix_change_log_user_version', 'change_log', ['user_id', 'version'], unique=per_user)
+
+
+def upgrade():
+    # the global versions only go up, so they are valid per user versions and the clients keep their cursor.
+    # the entries without a user were never returned by /api/sync
+    replace_log_table(True, f"SELECT version, version, {', '.join(LOG_COLUMNS)} FROM change_log "
+                            f"WHERE user_id IS NOT NULL")
+    op.create_table('change_counter',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('version', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('user_id')
+                    )
+    op.execute("INSERT INTO change_counter (user_id, version) "
+               "SELECT user_id, MAX(version) FROM change_log GROUP BY user_id")
+
+
+def downgrade():
+    # the ids keep the order of the entries of every user
+    op.drop_table('change_counter')
+    replace_log_table(False, f"SELECT id, {', '.join(LOG_COLUMNS)} FROM change_log")
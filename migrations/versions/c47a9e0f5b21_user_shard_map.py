@@ -0,0 +1,33 @@
+"""user shard map
+
+Revision ID: c47a9e0f5b21
+Revises: 8b2e4c61d0a7
+Create Date: 2026-10-19 11:20:07.554190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a9e0f5b21'
+down_revision = '8b2e4c61d0a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_shard',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.String(length=64), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index(op.f('ix_user_shard_shard'), 'user_shard', ['shard'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_shard_shard'), table_name='user_shard')
+    op.drop_table('user_shard')
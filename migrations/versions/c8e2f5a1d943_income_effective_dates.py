@@ -0,0 +1,32 @@
+"""income effective dates
+
+Revision ID: c8e2f5a1d943
+Revises: b6d1f4a8c352
+Create Date: 2026-10-19 20:41:13.208566
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e2f5a1d943'
+down_revision = 'b6d1f4a8c352'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # no dates means the income counts in every month, like the incomes before this revision
+    op.add_column('income', sa.Column('effective_from', sa.Date(), nullable=True))
+    op.add_column('income', sa.Column('effective_to', sa.Date(), nullable=True))
+
+
+def downgrade():
+    # the batch rebuild of the table can't reflect the lower() index and would drop it without a word
+    op.drop_index('ix_income_budget_description', table_name='income')
+    with op.batch_alter_table('income') as batch_op:
+        batch_op.drop_column('effective_to')
+        batch_op.drop_column('effective_from')
+    op.create_index('ix_income_budget_description', 'income',
+                    ['budget_id', sa.text('lower(income_description)')], unique=False)
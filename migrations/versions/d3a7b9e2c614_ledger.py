@@ -0,0 +1,58 @@
+"""ledger
+
+Revision ID: d3a7b9e2c614
+Revises: c8e2f5a1d943
+Create Date: 2026-10-19 21:37:52.119034
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a7b9e2c614'
+down_revision = 'c8e2f5a1d943'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the existing incomes and expenses get their opening entries from `flask ledger open`
+    op.create_table('ledger_entry',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('budget_id', sa.Integer(), nullable=False),
+                    sa.Column('table_name', sa.String(length=32), nullable=False),
+                    sa.Column('row_id', sa.Integer(), nullable=False),
+                    sa.Column('operation', sa.String(length=1), nullable=False),
+                    sa.Column('entry_date', sa.Date(), nullable=False),
+                    sa.Column('category', sa.String(length=64), nullable=True),
+                    sa.Column('amount_cents', sa.BigInteger(), nullable=False),
+                    sa.Column('currency', sa.String(length=3), nullable=False),
+                    sa.Column('description', sa.String(length=128), nullable=True),
+                    sa.Column('changes', sa.Text(), nullable=True),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.Column('recorded_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['budget_id'], ['budget.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_ledger_entry_budget_date', 'ledger_entry', ['budget_id', 'entry_date'], unique=False)
+    op.create_index('ix_ledger_entry_budget_row', 'ledger_entry', ['budget_id', 'table_name', 'row_id'],
+                    unique=False)
+    op.create_table('ledger_snapshot',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('budget_id', sa.Integer(), nullable=False),
+                    sa.Column('as_of', sa.Date(), nullable=False),
+                    sa.Column('spent_cents', sa.BigInteger(), nullable=False),
+                    sa.Column('categories', sa.Text(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['budget_id'], ['budget.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('budget_id', 'as_of')
+                    )
+
+
+def downgrade():
+    op.drop_table('ledger_snapshot')
+    op.drop_index('ix_ledger_entry_budget_row', table_name='ledger_entry')
+    op.drop_index('ix_ledger_entry_budget_date', table_name='ledger_entry')
+    op.drop_table('ledger_entry')
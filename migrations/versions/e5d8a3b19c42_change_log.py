@@ -0,0 +1,43 @@
+"""change log
+
+Revision ID: e5d8a3b19c42
+Revises: c47a9e0f5b21
+Create Date: 2026-10-19 13:02:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5d8a3b19c42'
+down_revision = 'c47a9e0f5b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('budget_id', sa.Integer(), nullable=True),
+    sa.Column('table_name', sa.String(length=32), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('operation', sa.String(length=1), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('version'),
+    sqlite_autoincrement=True
+    )
+    op.create_index('ix_change_log_user_version', 'change_log', ['user_id', 'version'], unique=False)
+    # the rows that already exist are inserts for a client syncing from version 0
+    op.execute("INSERT INTO change_log (user_id, budget_id, table_name, row_id, operation, changed_at) "
+               "SELECT user_id, id, 'budget', id, 'I', CURRENT_TIMESTAMP FROM budget WHERE deleted_at IS NULL")
+    for table in ('income', 'expenses'):
+        op.execute(f"INSERT INTO change_log (user_id, budget_id, table_name, row_id, operation, changed_at) "
+                   f"SELECT budget.user_id, {table}.budget_id, '{table}', {table}.id, 'I', CURRENT_TIMESTAMP "
+                   f"FROM {table} JOIN budget ON budget.id = {table}.budget_id WHERE budget.deleted_at IS NULL")
+
+
+def downgrade():
+    op.drop_index('ix_change_log_user_version', table_name='change_log')
+    op.drop_table('change_log')
@@ -0,0 +1,88 @@
+"""exchange rates
+
+Revision ID: e9f4a2c7b581
+Revises: d3a7b9e2c614
+Create Date: 2026-10-19 23:14:52.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e9f4a2c7b581'
+down_revision = 'd3a7b9e2c614'
+branch_labels = None
+depends_on = None
+
+SPEND_COLUMNS = ('id', 'budget_id', 'year', 'month', 'category', 'spent_cents', 'expense_count', 'over_limit_since')
+
+
+def spend_table(name, unique):
+    # the rollup has a currency column when its rows are per currency
+    currency = [sa.Column('currency', sa.String(length=3), nullable=False, server_default='USD')] \
+        if 'currency' in unique else []
+    return op.create_table(name,
+                           sa.Column('id', sa.Integer(), nullable=False),
+                           sa.Column('budget_id', sa.Integer(), nullable=False),
+                           sa.Column('year', sa.Integer(), nullable=False),
+                           sa.Column('month', sa.Integer(), nullable=False),
+                           sa.Column('category', sa.String(length=64), nullable=False),
+                           *currency,
+                           sa.Column('spent_cents', sa.BigInteger(), nullable=False),
+                           sa.Column('expense_count', sa.Integer(), nullable=False),
+                           sa.Column('over_limit_since', sa.DateTime(), nullable=True),
+                           sa.ForeignKeyConstraint(['budget_id'], ['budget.id'], ondelete='CASCADE'),
+                           sa.PrimaryKeyConstraint('id'),
+                           sa.UniqueConstraint(*unique)
+                           )
+
+
+def replace_spend_table(unique, rows):
+    # the unique constraint of the rollup has no name to drop, the table is copied into a new one instead
+    spend_table('category_spend_new', unique)
+    op.execute(f"INSERT INTO category_spend_new ({', '.join(SPEND_COLUMNS)}) {rows}")
+    op.drop_table('category_spend')
+    op.rename_table('category_spend_new', 'category_spend')
+
+
+def upgrade():
+    op.create_table('rate_version',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('checksum', sa.String(length=64), nullable=False),
+                    sa.Column('source', sa.String(length=255), nullable=False),
+                    sa.Column('base_currency', sa.String(length=3), nullable=False),
+                    sa.Column('valid_from', sa.Date(), nullable=False),
+                    sa.Column('valid_to', sa.Date(), nullable=False),
+                    sa.Column('rate_count', sa.Integer(), nullable=False),
+                    sa.Column('active', sa.Boolean(), nullable=False),
+                    sa.Column('loaded_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_rate_version_active'), 'rate_version', ['active'], unique=False)
+    op.create_table('exchange_rate',
+                    sa.Column('version_id', sa.Integer(), nullable=False),
+                    sa.Column('currency', sa.String(length=3), nullable=False),
+                    sa.Column('year', sa.Integer(), nullable=False),
+                    sa.Column('month', sa.Integer(), nullable=False),
+                    sa.Column('rate_micros', sa.BigInteger(), nullable=False),
+                    sa.ForeignKeyConstraint(['version_id'], ['rate_version.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('version_id', 'currency', 'year', 'month')
+                    )
+    # the budgets so far show their totals in dollars, the only currency of the forms. budgets synced with
+    # other currencies get their rollup per currency from `flask rollup rebuild`
+    op.add_column('budget', sa.Column('currency', sa.String(length=3), nullable=False, server_default='USD'))
+    replace_spend_table(('budget_id', 'year', 'month', 'category', 'currency'),
+                        f"SELECT {', '.join(SPEND_COLUMNS)} FROM category_spend")
+
+
+def downgrade():
+    # the spend of a category in several currencies is added up again, like before this revision
+    replace_spend_table(('budget_id', 'year', 'month', 'category'),
+                        "SELECT MIN(id), budget_id, year, month, category, SUM(spent_cents), SUM(expense_count), "
+                        "MIN(over_limit_since) FROM category_spend GROUP BY budget_id, year, month, category")
+    with op.batch_alter_table('budget') as batch_op:
+        batch_op.drop_column('currency')
+    op.drop_table('exchange_rate')
+    op.drop_index(op.f('ix_rate_version_active'), table_name='rate_version')
+    op.drop_table('rate_version')
@@ -0,0 +1,28 @@
+"""lookup indexes
+
+Revision ID: f2a6c9d4e871
+Revises: e5d8a3b19c42
+Create Date: 2026-10-19 15:41:12.603318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a6c9d4e871'
+down_revision = 'e5d8a3b19c42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_income_budget_description', 'income',
+                    ['budget_id', sa.text('lower(income_description)')], unique=False)
+    op.create_index('ix_expenses_budget_description', 'expenses',
+                    ['budget_id', sa.text('lower(expense_description)')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_expenses_budget_description', table_name='expenses')
+    op.drop_index('ix_income_budget_description', table_name='income')